@@ -22,6 +22,7 @@
 
 import json
 import logging
+import re
 import urlparse
 from urllib import unquote
 
@@ -29,8 +30,10 @@ from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.http import JsonResponse, HttpResponseRedirect
-from django.urls import resolve
-from django.utils.encoding import smart_text
+from django.urls import resolve, reverse, get_script_prefix
+from django.utils.cache import get_conditional_response
+from django.utils.encoding import force_text, smart_text
+from django.utils.http import quote_etag
 from oauth2_provider.generators import BaseHashGenerator
 from oauthlib.common import UNICODE_ASCII_CHARACTER_SET
 from oauthlib.common import generate_client_id as oauthlib_generate_client_id
@@ -43,6 +46,7 @@ import combined_search_strategies
 from apiv2.authentication import OAuth2Authentication, TokenAuthentication, SessionAuthentication
 from apiv2.exceptions import RequiresHttpsException, UnauthorizedException, ServerErrorException, BadRequestException, \
     NotFoundException
+from apiv2.models import get_cached_ac_analysis
 from examples import examples
 from search.views import search_prepare_query
 from similarity.client import SimilarityException
@@ -103,10 +107,38 @@ class FreesoundAPIViewMixin(object):
     client_name = None
     protocol = None
     contains_www = None
+    etag = None
 
     def log_message(self, message):
         return log_message_helper(message, resource=self)
 
+    def get_not_modified_response(self, request, versions):
+        """Computes the ETag of the response and returns a 304 response if it matches the one sent by the client
+
+        The ETag is computed from the requested URL (which includes the parameters that alter the response like
+        'fields' or 'descriptors'), the response format, the user and the given versions. Versions should be cheap to
+        obtain values that change whenever the representation of the requested resource changes (e.g. modification
+        dates, moderation states and counters), so that no serialization is needed to decide whether the resource
+        has changed. The ETag is also added to the response in finalize_response.
+
+        Args:
+            request (rest_framework.request.Request): request object
+            versions (tuple): values that identify the current version of the requested resource
+
+        Returns:
+            HttpResponseNotModified or None: 304 response if the client already has the current version of the
+                resource, None otherwise
+        """
+        etag_data = u'%s|%s|%s|%r' % (request.build_absolute_uri(), request.accepted_renderer.format,
+                                      request.user.id, versions)
+        self.etag = quote_etag(create_hash(etag_data.encode('utf-8'), add_secret=False, limit=32))
+        return get_conditional_response(request, etag=self.etag)
+
+    def add_etag_header(self, response):
+        if self.etag is not None and response.status_code in (200, 304) and not response.has_header('ETag'):
+            response['ETag'] = self.etag
+        return response
+
     def get_request_information(self, request):
         # Get request information and store it as class variable
         # This information is mainly useful for logging
@@ -126,7 +158,8 @@ class FreesoundAPIViewMixin(object):
         browsing the API interactively (with the browser), we want this behvaiour top be applied.
         """
 
-        if isinstance(response.accepted_renderer, BrowsableAPIRenderer):
+        renderer = getattr(response, 'accepted_renderer', getattr(request, 'accepted_renderer', None))
+        if isinstance(renderer, BrowsableAPIRenderer):
             if request.get_host().startswith('www'):
                 domain = "%s://%s" % ('https' if not settings.DEBUG else 'http', Site.objects.get_current().domain)
                 return_url = urlparse.urljoin(domain, request.get_full_path())
@@ -160,7 +193,7 @@ class GenericAPIView(RestFrameworkGenericAPIView, FreesoundAPIViewMixin):
         """
         response = super(GenericAPIView, self).finalize_response(request, response, *args, **kwargs)
         response = self.redirect_if_needed(request, response)
-        return response
+        return self.add_etag_header(response)
 
 
 class OauthRequiredAPIView(RestFrameworkGenericAPIView, FreesoundAPIViewMixin):
@@ -216,6 +249,8 @@ class WriteRequiredGenericAPIView(RestFrameworkGenericAPIView, FreesoundAPIViewM
 class ListAPIView(RestFrameworkListAPIView, FreesoundAPIViewMixin):
     throttling_rates_per_level = settings.APIV2_BASIC_THROTTLING_RATES_PER_LEVELS
     authentication_classes = (OAuth2Authentication, TokenAuthentication, SessionAuthentication)
+    # Whether the 'cursor' parameter can be used to paginate the list (see apiv2.pagination.CustomPagination)
+    cursor_pagination = False
 
     def initial(self, request, *args, **kwargs):
         super(ListAPIView, self).initial(request, *args, **kwargs)
@@ -225,7 +260,17 @@ class ListAPIView(RestFrameworkListAPIView, FreesoundAPIViewMixin):
         # See comment in GenericAPIView.finalize_response
         response = super(ListAPIView, self).finalize_response(request, response, *args, **kwargs)
         response = self.redirect_if_needed(request, response)
-        return response
+        return self.add_etag_header(response)
+
+    def get_not_modified_list_response(self, request, queryset, *aggregates):
+        """Same as get_not_modified_response but using aggregates of the listed objects as versions (e.g. number of
+        objects and last modification date). Aggregates need to scan the whole list, so no ETag is computed when
+        cursor pagination is used as the point of it is to only read the requested page.
+        """
+        if self.paginator.is_cursor_request(request, self):
+            return None
+        versions = queryset.aggregate(*aggregates)
+        return self.get_not_modified_response(request, tuple(sorted(versions.items())))
 
 
 class RetrieveAPIView(RestFrameworkRetrieveAPIView, FreesoundAPIViewMixin):
@@ -240,7 +285,7 @@ class RetrieveAPIView(RestFrameworkRetrieveAPIView, FreesoundAPIViewMixin):
         # See comment in GenericAPIView.finalize_response
         response = super(RetrieveAPIView, self).finalize_response(request, response, *args, **kwargs)
         response = self.redirect_if_needed(request, response)
-        return response
+        return self.add_etag_header(response)
 
 
 ##################
@@ -343,24 +388,45 @@ def api_search(
 ###############
 
 
+class LogMessage(object):
+    """
+    Message of an API log record. The fields of the message are gathered when it is created, but the message is only
+    formatted (serializing the fields as json) when the log record is emitted, which, if the record goes through a
+    utils.logging_handlers.QueueHandler, happens outside of the request thread. The formatted message has the form
+    expected by utils.logging_filters.APILogsFilter: '<message> #!# <data json> #!# <info json>'.
+    """
+    __slots__ = ('message', 'data_dict', 'info_dict')
+
+    def __init__(self, message, data_dict, info_dict):
+        self.message = message
+        self.data_dict = data_dict
+        self.info_dict = info_dict
+
+    def __unicode__(self):
+        return u'%s #!# %s #!# %s' % (force_text(self.message), json.dumps(self.data_dict), json.dumps(self.info_dict))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
 def log_message_helper(message, data_dict=None, info_dict=None, resource=None, request=None):
     """
-    In this helper a string is generated in the right format to be parsed by graylog, containing a key which
+    In this helper a LogMessage is generated in the right format to be parsed by graylog, containing a key which
     indicates the operation and two dicts with the following information:
     - If data_dict is None the first dict contains the query data taken from the request params
     - If info_dict is None the second dict contains more data from the api client
     """
     if data_dict is None:
         if resource is not None:
-            data_dict = resource.request.query_params.copy()
-            data_dict.pop('token', None)  # Remove token from req params if it exists (we don't need it)
+            # Remove token from req params if it exists (we don't need it)
+            data_dict = {key: value for key, value in resource.request.query_params.items() if key != 'token'}
     if info_dict is None:
         if resource is not None:
             info_dict = build_info_dict(resource=resource)
         if request is not None and info_dict is None:
             info_dict = build_info_dict(request=request)
 
-    return '%s #!# %s #!# %s' % (message, json.dumps(data_dict), json.dumps(info_dict))
+    return LogMessage(message, data_dict, info_dict)
 
 
 def build_info_dict(resource=None, request=None):
@@ -415,6 +481,89 @@ def prepend_base(rel, dynamic_resolve=True, use_https=False, request_is_secure=F
         return "http://%s%s" % (Site.objects.get_current().domain, rel)
 
 
+# Values used to reverse a URL once when building its template. They are later replaced by named placeholders.
+URL_TEMPLATE_SENTINEL_BASE = 9071531000
+# Argument values that are known to be left untouched by the quoting done in reverse(). Values not matching these
+# patterns are rendered using reverse() to make sure the resulting URL is exactly the same.
+URL_TEMPLATE_ARGUMENT_PATTERNS = {
+    'username': re.compile(r'^[A-Za-z0-9_.@+-]+\Z'),
+}
+URL_TEMPLATE_DEFAULT_ARGUMENT_PATTERN = re.compile(r'^[0-9]+\Z')
+
+_url_templates = dict()
+_location_url_bases = dict()
+
+
+def get_url_template(url_name, argument_names, request_is_secure=False):
+    """Returns a format string which renders the same URL as prepend_base(reverse(url_name, kwargs=...)).
+
+    The template is computed once per process for every combination of url name, scheme and domain, so that the
+    expensive calls to reverse() and resolve() (done in prepend_base to decide whether the resource requires https)
+    are not repeated for every serialized object.
+
+    Args:
+        url_name (str): name of the url pattern.
+        argument_names (tuple): names of the keyword arguments of the url pattern.
+        request_is_secure (bool): whether the URL is built for a request made using https.
+
+    Returns:
+        str: template with a '%(name)s' placeholder per argument, or None if no template can be built for that url.
+    """
+    key = (url_name, argument_names, request_is_secure, Site.objects.get_current().domain, get_script_prefix())
+    if key not in _url_templates:
+        sentinels = {name: str(URL_TEMPLATE_SENTINEL_BASE + i) for i, name in enumerate(argument_names)}
+        template = prepend_base(reverse(url_name, kwargs=sentinels), request_is_secure=request_is_secure)
+        template = template.replace('%', '%%')
+        for name, sentinel in sentinels.items():
+            if template.count(sentinel) != 1:
+                template = None
+                break
+            template = template.replace(sentinel, '%%(%s)s' % name)
+        _url_templates[key] = template
+    return _url_templates[key]
+
+
+def prepend_base_to_reverse(url_name, request_is_secure=False, **kwargs):
+    """Equivalent to prepend_base(reverse(url_name, kwargs=kwargs), request_is_secure=request_is_secure) but
+    using a precomputed URL template (see get_url_template)."""
+    template = get_url_template(url_name, tuple(sorted(kwargs.keys())), request_is_secure=request_is_secure)
+    if template is not None:
+        values = {}
+        for name, value in kwargs.items():
+            value = u'%s' % value
+            pattern = URL_TEMPLATE_ARGUMENT_PATTERNS.get(name, URL_TEMPLATE_DEFAULT_ARGUMENT_PATTERN)
+            if pattern.match(value) is None:
+                break
+            values[name] = value
+        else:
+            return template % values
+    return prepend_base(reverse(url_name, kwargs=kwargs), request_is_secure=request_is_secure)
+
+
+def prepend_base_to_location(rel, location_name, request_is_secure=False):
+    """Equivalent to prepend_base(rel, request_is_secure=request_is_secure) for URLs returned by the locations
+    function of an object (e.g. sound.locations('preview.HQ.mp3.url')).
+
+    URLs of the same location only differ in the object ids in the file name, and are therefore resolved to the
+    same url pattern. The scheme and domain to prepend are thus computed once per location name and domain.
+
+    Args:
+        rel (str): relative URL as returned by the locations function.
+        location_name (str): name of the location used to get rel (e.g. 'preview.HQ.mp3.url').
+        request_is_secure (bool): whether the URL is built for a request made using https.
+
+    Returns:
+        str: absolute URL.
+    """
+    key = (location_name, request_is_secure, Site.objects.get_current().domain)
+    base = _location_url_bases.get(key, None)
+    if base is None:
+        url = prepend_base(rel, request_is_secure=request_is_secure)
+        base = url[:len(url) - len(rel)]
+        _location_url_bases[key] = base
+    return base + rel
+
+
 def get_authentication_details_form_request(request):
     auth_method_name = None
     user = None
@@ -504,19 +653,31 @@ def get_formatted_examples_for_view(view_name, url_name, max=10):
 # Similarity utils
 ##################
 
-def get_analysis_data_for_queryset_or_sound_ids(view, queryset=None, sound_ids=[]):
+def get_analysis_data_for_queryset_or_sound_ids(view, queryset=None, sound_ids=[], all_fields_by_default=False):
     # Get analysis data for all requested sounds and save it to a class variable so the serializer can access it and
-    # we only need one request to the similarity service
-
-    analysis_data_required = 'analysis' in view.request.query_params.get('fields', '').split(',')
-    if analysis_data_required:
+    # we only need one request to the similarity service. Serialized Audio Commons analysis are also loaded from the
+    # cache with a single request (if 'all_fields_by_default', analysis data is also loaded when no fields are
+    # specified).
+
+    requested_fields = view.request.query_params.get('fields', '')
+    if not requested_fields and all_fields_by_default:
+        requested_fields = 'analysis,ac_analysis'
+    requested_fields = requested_fields.split(',')
+    analysis_data_required = 'analysis' in requested_fields
+    ac_analysis_data_required = 'ac_analysis' in requested_fields
+    if analysis_data_required or ac_analysis_data_required:
         # Get ids of the particular sounds we need
-        if queryset:
+        if queryset is not None:
             paginated_queryset = view.paginate_queryset(queryset)
             ids = [int(sound.id) for sound in paginated_queryset]
         else:
             ids = [int(sid) for sid in sound_ids]
 
+    if ac_analysis_data_required:
+        # Sounds whose analysis is not cached are serialized (and cached) by the serializer
+        view.sound_ac_analysis_data = get_cached_ac_analysis(ids)
+
+    if analysis_data_required:
         # Get descriptor values for the required ids
         # Required descriptors are indicated with the parameter 'descriptors'.
         # If 'descriptors' is empty, we return nothing
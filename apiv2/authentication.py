@@ -24,7 +24,9 @@ from rest_framework import exceptions
 from rest_framework.authentication import get_authorization_header
 from rest_framework.authentication import BaseAuthentication, SessionAuthentication as DjangoRestFrameworkSessionAuthentication
 from oauth2_provider.ext.rest_framework import OAuth2Authentication as Oauth2ProviderOauth2Authentication
-from apiv2.models import ApiV2Client
+from django.conf import settings
+from django.core.cache import cache
+from apiv2.models import ApiV2Client, get_token_credentials_cache_key, get_access_token_credentials_cache_key
 
 
 class SessionAuthentication(DjangoRestFrameworkSessionAuthentication):
@@ -45,13 +47,35 @@ class OAuth2Authentication(Oauth2ProviderOauth2Authentication):
         We override this method to check the status of related ApiV2Client.
         Check that ApiV2Client associatied to the given acess_token has not been disabled.
         """
-        try:
-            super_response = super(OAuth2Authentication, self).authenticate(request)
-        except ValueError:
-            # If the request contains html entities that don't decode to valid UTF8,
-            # an exception is raised during oauth validation, even if it's on a field/parameter unrelated to oauth (#793)
-            # TODO: Check if this is still needed with Python3/oauthlib2
-            super_response = None
+        # Resolved access tokens (including the related user and ApiV2Client) are cached for a short time so that
+        # authenticated requests do not need to query the database. Cached entries are removed when the ApiV2Client
+        # or the access token change (see apiv2.models).
+        access_token_string = None
+        auth = get_authorization_header(request).split()
+        if len(auth) == 2 and auth[0] == b'Bearer':
+            access_token_string = auth[1]
+
+        super_response = None
+        if access_token_string is not None:
+            access_token = cache.get(get_access_token_credentials_cache_key(access_token_string))
+            if access_token is not None and not access_token.is_expired():
+                super_response = (access_token.user, access_token)
+
+        if super_response is None:
+            try:
+                super_response = super(OAuth2Authentication, self).authenticate(request)
+            except ValueError:
+                # If the request contains html entities that don't decode to valid UTF8,
+                # an exception is raised during oauth validation, even if it's on a field/parameter unrelated to oauth (#793)
+                # TODO: Check if this is still needed with Python3/oauthlib2
+                super_response = None
+
+            if super_response is not None and access_token_string is not None:
+                # Load related ApiV2Client (and its oauth client) before caching
+                access_token = super_response[1]
+                access_token.application.apiv2_client.oauth_client
+                cache.set(get_access_token_credentials_cache_key(access_token_string), access_token,
+                          settings.APIV2_CREDENTIALS_CACHE_TIMEOUT)
 
         if super_response is not None:
             # super_response[1] -> access_token
@@ -98,10 +122,17 @@ class TokenAuthentication(BaseAuthentication):
         return self.authenticate_credentials(auth[1])
 
     def authenticate_credentials(self, key):
-        try:
-            token = self.model.objects.get(key=key)
-        except self.model.DoesNotExist:
-            raise exceptions.AuthenticationFailed('Invalid token')
+        # Resolved tokens (including the related user) are cached for a short time so that authenticated requests do
+        # not need to query the database. Cached entries are removed when the ApiV2Client or its user change (see
+        # apiv2.models).
+        cache_key = get_token_credentials_cache_key(key)
+        token = cache.get(cache_key)
+        if token is None:
+            try:
+                token = self.model.objects.select_related('user', 'oauth_client').get(key=key)
+            except self.model.DoesNotExist:
+                raise exceptions.AuthenticationFailed('Invalid token')
+            cache.set(cache_key, token, settings.APIV2_CREDENTIALS_CACHE_TIMEOUT)
 
         if not token.user.is_active:
             raise exceptions.AuthenticationFailed('User inactive or deleted')
@@ -20,6 +20,14 @@
 #     See AUTHORS file.
 #
 
+import math
+import time
+from collections import deque
+from functools import partial
+from itertools import islice
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
 from utils.similarity_utilities import api_search as similarity_api_search
 from utils.search.solr import Solr, SolrException, SolrResponseInterpreter
 from similarity.client import SimilarityException
@@ -29,6 +37,9 @@ from urllib import unquote
 from django.conf import settings
 
 
+PARTIAL_RESULTS_NOTE = 'The combined search took too long and results might be incomplete.'
+
+
 def merge_all(search_form, target_file=None, extra_parameters=None):
     """
     Merge all strategy will get all results from solr and all results from gaia and then combine the ids
@@ -43,11 +54,14 @@ def merge_all(search_form, target_file=None, extra_parameters=None):
     gaia_page_size = extra_parameters.get('cs_gaia_page_size', 9999999)  # We can get ALL gaia results at once
     max_gaia_pages = extra_parameters.get('cs_max_gaia_pages', 1)
 
-    # Get all gaia results
-    gaia_ids, gaia_count, distance_to_target_data, note = get_gaia_results(search_form, target_file, page_size=gaia_page_size, max_pages=max_gaia_pages)
+    max_workers, deadline = get_concurrency_parameters(extra_parameters)
 
-    # Get 'max_pages' pages of size 'page_size' from solr results
-    solr_ids, solr_count = get_solr_results(search_form, page_size=solr_page_size, max_pages=max_solr_pages)
+    # Get all gaia results and 'max_pages' pages of size 'page_size' from solr results
+    gaia_ids, gaia_count, distance_to_target_data, note, solr_ids, solr_count, partial_results = \
+        get_gaia_and_solr_results(search_form, target_file, gaia_page_size, max_gaia_pages, solr_page_size,
+                                  max_solr_pages, max_workers, deadline)
+    if partial_results:
+        note = add_partial_results_note(note)
 
     if len(solr_ids) == solr_count and len(gaia_ids) == gaia_count:
         # Got complete results, maybe we should log that?
@@ -88,6 +102,8 @@ def filter_both(search_form, target_file=None, extra_parameters=None):
     gaia_filter_id_max_pages = extra_parameters.get('cs_gaia_filter_id_max_pages', 7)
     gaia_max_pages = extra_parameters.get('cs_max_gaia_pages', 1)
     gaia_page_size = extra_parameters.get('cs_gaia_page_size', 9999999)  # We can get ALL gaia results at once
+    max_workers, deadline = get_concurrency_parameters(extra_parameters)
+    partial_results = False
 
     if search_form.cleaned_data['target'] or target_file:
         # First search into gaia and then into solr (get all gaia results)
@@ -95,9 +111,14 @@ def filter_both(search_form, target_file=None, extra_parameters=None):
         valid_ids_pages = [gaia_ids[i:i+solr_filter_id_block_size] for i in range(0, len(gaia_ids), solr_filter_id_block_size) if (i/solr_filter_id_block_size) < solr_filter_id_max_pages]
         solr_ids = list()
         solr = Solr(settings.SOLR_URL)
-        for valid_ids_page in valid_ids_pages:
-            page_solr_ids, solr_count = get_solr_results(search_form, page_size=len(valid_ids_page), max_pages=1, valid_ids=valid_ids_page, solr=solr)
-            solr_ids += page_solr_ids
+        # Query solr for all blocks concurrently
+        tasks = [partial(get_solr_results, search_form, page_size=len(valid_ids_page), max_pages=1,
+                         valid_ids=valid_ids_page, solr=solr) for valid_ids_page in valid_ids_pages]
+        try:
+            for page_solr_ids, solr_count in iterate_concurrently(tasks, max_workers, deadline):
+                solr_ids += page_solr_ids
+        except TimeBudgetExceeded:
+            partial_results = True
 
         if gaia_count <= solr_filter_id_block_size * solr_filter_id_max_pages:
             # Got complete results, maybe we should log that?
@@ -105,14 +126,15 @@ def filter_both(search_form, target_file=None, extra_parameters=None):
             pass
     else:
         # First search into solr and then into gaia
-        # These queries are SLOW because we need to get many pages from solr
-        solr_ids, solr_count = get_solr_results(search_form, page_size=solr_page_size, max_pages=solr_max_pages)
+        # These queries are SLOW because we need to get many pages from solr (pages are retrieved concurrently)
 
         # Now we should split solr ids in blocks and iteratively query gaia restricting the results to those ids
         # present in the current block. However given that gaia results can be retrieved
         # all at once very quickly, we optimize this bit by retrieving them all at once and avoiding many requests
-        # to similarity server.
-        gaia_ids, gaia_count, distance_to_target_data, note = get_gaia_results(search_form, target_file, page_size=gaia_page_size, max_pages=gaia_max_pages)
+        # to similarity server. Gaia results are retrieved at the same time as solr pages.
+        gaia_ids, gaia_count, distance_to_target_data, note, solr_ids, solr_count, partial_results = \
+            get_gaia_and_solr_results(search_form, target_file, gaia_page_size, gaia_max_pages, solr_page_size,
+                                      solr_max_pages, max_workers, deadline)
         '''
         # That would be the code without the optimization:
         valid_ids_pages = [solr_ids[i:i+gaia_filter_id_block_size] for i in range(0, len(solr_ids), gaia_filter_id_block_size) if (i/gaia_filter_id_block_size) < gaia_filter_id_max_pages]
@@ -128,6 +150,8 @@ def filter_both(search_form, target_file=None, extra_parameters=None):
             #print 'COMPLETE results (starting with solr)'
             pass
 
+    if partial_results:
+        note = add_partial_results_note(note)
 
     if search_form.cleaned_data['target'] or target_file:
         # Combined search, sort by gaia_ids
@@ -162,6 +186,8 @@ def merge_optimized(search_form, target_file=None, extra_parameters=None):
     solr_page_size = extra_parameters.get('cs_solr_page_size', 200)
     gaia_max_pages = extra_parameters.get('cs_max_gaia_pages', 1)
     gaia_page_size = extra_parameters.get('cs_gaia_page_size', 9999999)  # We can get ALL gaia results at once
+    max_workers, deadline = get_concurrency_parameters(extra_parameters)
+    partial_results = False
 
     num_requested_results = search_form.cleaned_data['page_size']
     params_for_next_page = dict()
@@ -175,30 +201,39 @@ def merge_optimized(search_form, target_file=None, extra_parameters=None):
             last_checked_valid_id_position = 0
         gaia_ids, gaia_count, distance_to_target_data, note = get_gaia_results(search_form, target_file, page_size=gaia_page_size, max_pages=gaia_max_pages, offset=last_checked_valid_id_position)
         if len(gaia_ids):
-            # Now divide gaia results in blocks of "solr_filter_id_block_size" results and iteratively query solr limiting the
-            # results to those ids in the common block to obtain common results for the search.
-            # Once we get as many results as "num_requested_results" or we exceed a maximum number
-            # of iterations (solr_filter_id_max_pages), return what we got and update 'cs_lcvidp' parameter for further calls.
+            # Now divide gaia results in blocks of "solr_filter_id_block_size" results and query solr limiting the
+            # results to those ids in the common block to obtain common results for the search. Blocks are queried
+            # concurrently but processed in order. Once we get as many results as "num_requested_results" or we exceed
+            # a maximum number of iterations (solr_filter_id_max_pages), outstanding blocks are cancelled and we
+            # return what we got and update 'cs_lcvidp' parameter for further calls.
             valid_ids_pages = [gaia_ids[i:i+solr_filter_id_block_size] for i in range(0, len(gaia_ids), solr_filter_id_block_size)]
+            valid_ids_pages = valid_ids_pages[:solr_filter_id_max_pages + 1]
             solr_ids = list()
             checked_gaia_ids = list()
             solr = Solr(settings.SOLR_URL)
-            for count, valid_ids_page in enumerate(valid_ids_pages):
-                page_solr_ids, solr_count = get_solr_results(search_form, page_size=len(valid_ids_page), max_pages=1, valid_ids=valid_ids_page, solr=solr)
-                solr_ids += page_solr_ids
-                checked_gaia_ids += valid_ids_page
-                if len(solr_ids) >= num_requested_results:
-                    debug_note = 'Found enough results in %i solr requests' % (count + 1)
-                    #print 'Did %i requests to solr' % (count + 1)
-                    break
-                if count + 1 > solr_filter_id_max_pages:
-                    debug_note = 'Did %i solr requests (still not enough results)' % (count + 1)
-                    #print 'Too many requests and not enough results'
-                    break
+            tasks = [partial(get_solr_results, search_form, page_size=len(valid_ids_page), max_pages=1,
+                             valid_ids=valid_ids_page, solr=solr) for valid_ids_page in valid_ids_pages]
+            try:
+                for count, (page_solr_ids, solr_count) in enumerate(iterate_concurrently(tasks, max_workers, deadline)):
+                    solr_ids += page_solr_ids
+                    checked_gaia_ids += valid_ids_pages[count]
+                    if len(solr_ids) >= num_requested_results:
+                        debug_note = 'Found enough results in %i solr requests' % (count + 1)
+                        #print 'Did %i requests to solr' % (count + 1)
+                        break
+                    if count + 1 > solr_filter_id_max_pages:
+                        debug_note = 'Did %i solr requests (still not enough results)' % (count + 1)
+                        #print 'Too many requests and not enough results'
+                        break
+            except TimeBudgetExceeded:
+                partial_results = True
+                debug_note = 'Time budget exceeded after checking %i gaia results in solr' % len(checked_gaia_ids)
 
             combined_ids = list()
+            solr_ids_set = set(solr_ids)
+            new_last_checked_valid_id_position = 0
             for index, sid in enumerate(checked_gaia_ids):
-                if sid in solr_ids:
+                if sid in solr_ids_set:
                     combined_ids.append(sid)
                 new_last_checked_valid_id_position = index + 1
                 if len(combined_ids) == num_requested_results:
@@ -230,32 +265,42 @@ def merge_optimized(search_form, target_file=None, extra_parameters=None):
                 params_for_next_page['no_more_results'] = True
         else:
             # Now query solr starting at the last retrieved solr result position (parameter 'cs_lrsidp') and iteratively combine the results of
-            # each page of the query with gaia ids. Once we reach the desired  "num_requested_results", return what we got and
-            # update 'cs_lrsidp' parameter for further queries. Set a maximum number of iterations (solr_max_requests) to prevent a virtually
+            # each page of the query with gaia ids. Pages are requested concurrently but combined in order. Once we reach the desired
+            # "num_requested_results", outstanding pages are cancelled and we return what we got and update 'cs_lrsidp' parameter
+            # for further queries. Set a maximum number of iterations (solr_max_requests) to prevent a virtually
             # infinite query if not enough results are found (num_requested_results is not reached).
             combined_ids = list()
             new_last_retrieved_solr_id_pos = last_retrieved_solr_id_pos
             stop_main_for_loop = False
             n_requests_made = 0
-            for i in range(0, solr_max_requests):
-                if stop_main_for_loop:
-                    continue
-                offset = last_retrieved_solr_id_pos + i * solr_page_size
-                solr_ids, solr_count = get_solr_results(search_form, page_size=solr_page_size, max_pages=1, offset=offset)
-                n_requests_made += 1
-                common_ids = list(set(solr_ids).intersection(gaia_ids))
-                for index, sid in enumerate(solr_ids):
-                    new_last_retrieved_solr_id_pos += 1
-                    if sid in common_ids:
-                        combined_ids.append(sid)
-                    if len(combined_ids) == num_requested_results:
-                        stop_main_for_loop = True
-                        break
-                    if new_last_retrieved_solr_id_pos == solr_count:
+            gaia_ids_set = set(gaia_ids)
+            tasks = [partial(get_solr_results, search_form, page_size=solr_page_size, max_pages=1,
+                             offset=last_retrieved_solr_id_pos + i * solr_page_size) for i in range(0, solr_max_requests)]
+            try:
+                for solr_ids, solr_count in iterate_concurrently(tasks, max_workers, deadline):
+                    n_requests_made += 1
+                    if not solr_ids:
+                        # We went past the last solr result
                         params_for_next_page['no_more_results'] = True
-                        stop_main_for_loop = True
                         break
-            if n_requests_made == solr_max_requests and len(combined_ids) < num_requested_results:
+                    for sid in solr_ids:
+                        new_last_retrieved_solr_id_pos += 1
+                        if sid in gaia_ids_set:
+                            combined_ids.append(sid)
+                        if len(combined_ids) == num_requested_results:
+                            stop_main_for_loop = True
+                            break
+                        if new_last_retrieved_solr_id_pos == solr_count:
+                            params_for_next_page['no_more_results'] = True
+                            stop_main_for_loop = True
+                            break
+                    if stop_main_for_loop:
+                        break
+            except TimeBudgetExceeded:
+                partial_results = True
+            if partial_results:
+                debug_note = 'Time budget exceeded after %i solr requests' % n_requests_made
+            elif n_requests_made == solr_max_requests and len(combined_ids) < num_requested_results:
                 debug_note = 'Did %i solr requests (still not enough results)' % n_requests_made
                 #print 'Too many requests and not enough results'
             else:
@@ -263,10 +308,112 @@ def merge_optimized(search_form, target_file=None, extra_parameters=None):
                 #print 'Did %i requests to solr' % n_requests_made
             params_for_next_page['cs_lrsidp'] = new_last_retrieved_solr_id_pos
 
+    if partial_results:
+        note = add_partial_results_note(note)
+
     # Combine results
     return combined_ids, len(combined_ids), distance_to_target_data, None, note, params_for_next_page, debug_note
 
 
+class TimeBudgetExceeded(Exception):
+    pass
+
+
+def limit_concurrency_parameters(extra_parameters):
+    """Clamps the 'cs_max_workers' and 'cs_time_budget' extra parameters (if present) so that clients can lower but
+    never exceed settings.APIV2_COMBINED_SEARCH_MAX_WORKERS and settings.APIV2_COMBINED_SEARCH_TIME_BUDGET. The
+    given dictionary is updated and returned."""
+    if 'cs_max_workers' in extra_parameters:
+        extra_parameters['cs_max_workers'] = min(max(1, extra_parameters['cs_max_workers']),
+                                                 settings.APIV2_COMBINED_SEARCH_MAX_WORKERS)
+    if 'cs_time_budget' in extra_parameters:
+        extra_parameters['cs_time_budget'] = min(max(0, extra_parameters['cs_time_budget']),
+                                                 settings.APIV2_COMBINED_SEARCH_TIME_BUDGET)
+    return extra_parameters
+
+
+def get_concurrency_parameters(extra_parameters):
+    """Returns the maximum number of concurrent requests to solr/gaia and the time (as returned by time.time()) at
+    which a combined search should stop waiting for these requests and return partial results. Both can be
+    lowered with 'cs_max_workers' and 'cs_time_budget' (in seconds) extra parameters."""
+    extra_parameters = limit_concurrency_parameters(dict(extra_parameters))
+    max_workers = extra_parameters.get('cs_max_workers', settings.APIV2_COMBINED_SEARCH_MAX_WORKERS)
+    time_budget = extra_parameters.get('cs_time_budget', settings.APIV2_COMBINED_SEARCH_TIME_BUDGET)
+    return max_workers, time.time() + time_budget
+
+
+def add_partial_results_note(note):
+    if note:
+        return '%s %s' % (note, PARTIAL_RESULTS_NOTE)
+    return PARTIAL_RESULTS_NOTE
+
+
+def iterate_concurrently(tasks, max_workers, deadline):
+    """Runs the given tasks using a pool of at most 'max_workers' threads and yields their results in the same
+    order as the tasks. Tasks are only started when there is a free worker and the results of previous tasks are
+    being consumed, so when iteration is stopped (either because the caller stops consuming results or because
+    the deadline has been reached) outstanding tasks are cancelled. Exceptions raised in tasks are re-raised when
+    consuming their results.
+
+    Args:
+        tasks (list): callables without arguments (e.g. functools.partial objects).
+        max_workers (int): maximum number of tasks running at the same time.
+        deadline (float): time (as returned by time.time()) after which TimeBudgetExceeded is raised instead of
+            waiting for more results.
+
+    Returns:
+        generator: results of the tasks.
+    """
+    if not tasks:
+        return
+    pool = ThreadPool(processes=min(max_workers, len(tasks)))
+    try:
+        pending_tasks = iter(tasks)
+        running_tasks = deque([pool.apply_async(task) for task in islice(pending_tasks, max_workers)])
+        while running_tasks:
+            remaining_time = deadline - time.time()
+            if remaining_time <= 0:
+                raise TimeBudgetExceeded
+            try:
+                result = running_tasks.popleft().get(timeout=remaining_time)
+            except TimeoutError:
+                raise TimeBudgetExceeded
+            for task in islice(pending_tasks, 1):
+                running_tasks.append(pool.apply_async(task))
+            yield result
+    finally:
+        # Don't wait for running tasks, pool threads will end after finishing them
+        pool.close()
+
+
+def get_gaia_and_solr_results(search_form, target_file, gaia_page_size, gaia_max_pages, solr_page_size,
+                              solr_max_pages, max_workers, deadline):
+    """Gets gaia results together with the first page of solr results, and then the rest of solr pages (up to
+    'solr_max_pages'). All requests are done concurrently. If the deadline is reached, the results obtained until
+    then are returned and 'partial_results' is set to True.
+
+    Returns:
+        tuple: (gaia_ids, gaia_count, distance_to_target_data, note, solr_ids, solr_count, partial_results)
+    """
+    gaia_ids, gaia_count, distance_to_target_data, note = list(), 0, dict(), None
+    solr_ids, solr_count = list(), 0
+    tasks = [partial(get_gaia_results, search_form, target_file, page_size=gaia_page_size, max_pages=gaia_max_pages),
+             partial(get_solr_results, search_form, page_size=solr_page_size, max_pages=1)]
+    try:
+        gaia_results, (solr_ids, solr_count) = iterate_concurrently(tasks, max_workers, deadline)
+        gaia_ids, gaia_count, distance_to_target_data, note = gaia_results
+
+        # Now that solr count is known, only request the pages that have results
+        n_solr_pages = min(solr_max_pages, int(math.ceil(float(solr_count) / solr_page_size)))
+        tasks = [partial(get_solr_results, search_form, page_size=solr_page_size, max_pages=1, start_page=page)
+                 for page in range(2, n_solr_pages + 1)]
+        for page_solr_ids, _ in iterate_concurrently(tasks, max_workers, deadline):
+            solr_ids += page_solr_ids
+    except TimeBudgetExceeded:
+        return gaia_ids, gaia_count, distance_to_target_data, note, solr_ids, solr_count, True
+    return gaia_ids, gaia_count, distance_to_target_data, note, solr_ids, solr_count, False
+
+
 def get_gaia_results(search_form, target_file, page_size, max_pages, start_page=1, valid_ids=None, offset=None):
     gaia_ids = list()
     gaia_count = None
@@ -57,6 +57,11 @@ examples = {
         ('Getting only id and tags for a particular sound', ['apiv2/sounds/1234/?fields=id,tags']),
         ('Getting sound name and spectral centroid values (second example gets normalized centroid values)', ['apiv2/sounds/1234/?fields=name,analysis&descriptors=lowlevel.spectral_centroid', 'apiv2/sounds/1234/?fields=name,analysis&descriptors=lowlevel.spectral_centroid&normalized=1']),
     ],
+    'SoundBulkInstance': [
+        ('Complete information of several sounds', ['apiv2/sounds/bulk/?ids=1234,213524']),
+        ('Getting only id and tags for several sounds', ['apiv2/sounds/bulk/?ids=1234,213524&fields=id,tags']),
+        ('Getting sound names and spectral centroid values', ['apiv2/sounds/bulk/?ids=1234,213524&fields=name,analysis&descriptors=lowlevel.spectral_centroid']),
+    ],
     'SoundAnalysis': [
         ('Full analysis information', ['apiv2/sounds/1234/analysis/']),
         ('Getting only tristimulus descriptor', ['apiv2/sounds/1234/analysis/?descriptors=sfx.tristimulus']),
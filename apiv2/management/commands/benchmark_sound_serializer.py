@@ -0,0 +1,74 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.urls import reverse
+
+from apiv2.serializers import SoundListSerializer
+from sounds.models import Sound
+
+
+class Command(BaseCommand):
+    help = 'Measures the time needed to serialize a page of sounds with the APIv2 SoundListSerializer. ' \
+           'Sounds are loaded before timing, so only serialization time is reported.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-p', '--page_size',
+            action='store',
+            dest='page_size',
+            default=settings.APIV2['MAX_PAGE_SIZE'],
+            type=int,
+            help='Number of sounds per page (default: MAX_PAGE_SIZE)')
+        parser.add_argument(
+            '-r', '--repetitions',
+            action='store',
+            dest='repetitions',
+            default=20,
+            type=int,
+            help='Number of times each page is serialized, the best timing is reported (default: 20)')
+        parser.add_argument(
+            '-f', '--fields',
+            action='store',
+            dest='fields',
+            default=','.join(SoundListSerializer.Meta.fields),
+            help='Fields to serialize (default: all sound fields)')
+
+    def handle(self, *args, **options):
+        sound_ids = list(Sound.public.order_by('-id').values_list('id', flat=True)[:options['page_size']])
+        sounds = list(Sound.objects.bulk_query_id(sound_ids))
+        if not sounds:
+            self.stdout.write('No sounds available to serialize')
+            return
+
+        factory = RequestFactory()
+        for secure in [False, True]:
+            request = factory.get(reverse('apiv2-sound-text-search'), {'fields': options['fields']}, secure=secure)
+            timings = []
+            for _ in range(options['repetitions']):
+                start = time.time()
+                _ = SoundListSerializer(sounds, many=True, context={'request': request}).data
+                timings.append(time.time() - start)
+            self.stdout.write('%s request, %i sounds: best %.2f ms/page, mean %.2f ms/page' % (
+                'https' if secure else 'http', len(sounds), min(timings) * 1000, sum(timings) / len(timings) * 1000))
@@ -0,0 +1,106 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.urls import reverse
+
+from utils.filesystem import md5file
+from utils.upload_handlers import StreamingFileUploadHandler
+
+
+class Command(BaseCommand):
+    help = 'Measures the throughput of receiving a file uploaded to the APIv2 upload resource and placing it in an ' \
+           'uploads directory with its md5, using the StreamingFileUploadHandler (current) and Django\'s default ' \
+           'upload handlers followed by a copy of the file and md5file (previous). The generation of the request is ' \
+           'not timed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-s', '--size',
+            action='store',
+            dest='size',
+            default=100,
+            type=int,
+            help='Size of the uploaded file in MB (default: 100)')
+        parser.add_argument(
+            '-r', '--repetitions',
+            action='store',
+            dest='repetitions',
+            default=5,
+            type=int,
+            help='Number of uploads for each upload handler, the best timing is reported (default: 5)')
+        parser.add_argument(
+            '-d', '--directory',
+            action='store',
+            dest='directory',
+            default=None,
+            help='Directory where the uploads directory is created, use one in the same filesystem as UPLOADS_PATH '
+                 'for realistic results (default: a temporary directory)')
+
+    @staticmethod
+    def previous_upload(request, directory):
+        audiofile = request.FILES['audiofile']
+        path = os.path.join(directory, audiofile.name)
+        with open(path, 'wb') as destination:
+            for chunk in audiofile.chunks():
+                destination.write(chunk)
+        audiofile.close()
+        return md5file(path)
+
+    @staticmethod
+    def current_upload(request, directory):
+        request.upload_handlers = [
+            StreamingFileUploadHandler(max_file_size=settings.UPLOAD_MAX_FILE_SIZE_COMBINED, request=request)]
+        audiofile = request.FILES['audiofile']
+        audiofile.file.close()
+        shutil.move(audiofile.path, os.path.join(directory, audiofile.name))
+        audiofile.remove_on_close = False
+        return audiofile.md5
+
+    def handle(self, *args, **options):
+        content = os.urandom(options['size'] * 1024 * 1024)
+        factory = RequestFactory()
+        directory = tempfile.mkdtemp(dir=options['directory'])
+        try:
+            md5s = set()
+            for label, upload in [('previous', self.previous_upload), ('current', self.current_upload)]:
+                timings = []
+                for _ in range(options['repetitions']):
+                    request = factory.post(reverse('apiv2-uploads-upload'),
+                                           {'audiofile': SimpleUploadedFile('benchmark.wav', content)})
+                    start = time.time()
+                    md5s.add(upload(request, directory))
+                    timings.append(time.time() - start)
+                    os.remove(os.path.join(directory, 'benchmark.wav'))
+                self.stdout.write('%s, %i MB file: best %.1f MB/s, mean %.1f MB/s' % (
+                    label, options['size'], options['size'] / min(timings),
+                    options['size'] * len(timings) / sum(timings)))
+            if len(md5s) != 1:
+                self.stdout.write('Upload handlers computed different md5s: %s' % ', '.join(md5s))
+        finally:
+            shutil.rmtree(directory)
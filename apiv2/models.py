@@ -18,12 +18,20 @@
 #     See AUTHORS file.
 #
 
+from django.apps import apps
 from django.db import models
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
-from oauth2_provider.models import Application
+from django.core.cache import cache
+from oauth2_provider.models import Application, AccessToken
 from django.conf import settings
 from django.urls import reverse
 from django.contrib.sites.models import Site
+from django.utils import timezone
+
+from utils.encryption import create_hash
 
 
 class ApiV2Client(models.Model):
@@ -101,3 +109,115 @@ class ApiV2Client(models.Model):
     @property
     def version(self):
         return "V2"
+
+
+def get_token_credentials_cache_key(key):
+    """Returns the cache key used to store the ApiV2Client resolved from a token (see TokenAuthentication)"""
+    return 'apiv2-token-credentials-%s' % create_hash(key, limit=32)
+
+
+def get_access_token_credentials_cache_key(token):
+    """Returns the cache key used to store the AccessToken resolved from an OAuth2 access token string
+    (see OAuth2Authentication)"""
+    return 'apiv2-oauth2-credentials-%s' % create_hash(token, limit=32)
+
+
+def invalidate_cached_credentials(keys=(), access_tokens=()):
+    cache_keys = [get_token_credentials_cache_key(key) for key in keys]
+    cache_keys += [get_access_token_credentials_cache_key(token) for token in access_tokens]
+    if cache_keys:
+        cache.delete_many(cache_keys)
+
+
+@receiver(post_save, sender=ApiV2Client)
+@receiver(post_delete, sender=ApiV2Client)
+def invalidate_api_client_cached_credentials(sender, instance, **kwargs):
+    # Status, throttling level or any other property of the client might have changed, so remove the cached
+    # credentials for its token and access tokens
+    invalidate_cached_credentials(
+        keys=[instance.key],
+        access_tokens=AccessToken.objects.filter(application_id=instance.oauth_client_id)
+                                         .values_list('token', flat=True))
+
+
+@receiver(post_delete, sender=AccessToken)
+def invalidate_access_token_cached_credentials(sender, instance, **kwargs):
+    invalidate_cached_credentials(access_tokens=[instance.token])
+
+
+@receiver(post_save, sender=User)
+def invalidate_inactive_user_cached_credentials(sender, instance, **kwargs):
+    if not instance.is_active:
+        invalidate_cached_credentials(
+            keys=ApiV2Client.objects.filter(user=instance).values_list('key', flat=True),
+            access_tokens=AccessToken.objects.filter(Q(user=instance) | Q(application__user=instance))
+                                             .values_list('token', flat=True))
+
+
+# Version of the format of the cached Audio Commons analysis, increase it if the way in which analysis are serialized
+# changes so that old cached values are not used
+AC_ANALYSIS_CACHE_VERSION = 1
+
+
+def get_ac_analysis_cache_key(sound_id):
+    """Returns the cache key used to store the serialized Audio Commons analysis of a sound"""
+    return 'apiv2-ac-analysis-%i-v%i' % (int(sound_id), AC_ANALYSIS_CACHE_VERSION)
+
+
+def serialize_ac_analysis(analysis):
+    """Returns the Audio Commons analysis of a sound as included in API responses
+
+    Args:
+        analysis (dict or None): analysis data as stored in the corresponding SoundAnalysis object
+
+    Returns:
+        dict or None: analysis data with descriptor names prefixed so these better match the names used in filters,
+            or None if there is no analysis data
+    """
+    if not analysis:
+        return None
+    return {'{0}{1}'.format(settings.AUDIOCOMMONS_DESCRIPTOR_PREFIX, key): value for key, value in analysis.items()}
+
+
+def cache_ac_analysis(analyses):
+    """Stores the serialized Audio Commons analysis of several sounds in the cache
+
+    Args:
+        analyses (dict): serialized analysis data (or None if a sound has no analysis) keyed by sound id
+    """
+    # Sounds without analysis are stored as an empty dictionary to distinguish them from cache misses
+    cache.set_many({get_ac_analysis_cache_key(sound_id): analysis if analysis is not None else {}
+                    for sound_id, analysis in analyses.items()}, settings.APIV2_AC_ANALYSIS_CACHE_TIMEOUT)
+
+
+def get_cached_ac_analysis(sound_ids):
+    """Gets the serialized Audio Commons analysis of several sounds from the cache with a single request
+
+    Args:
+        sound_ids (list): ids of the sounds
+
+    Returns:
+        dict: serialized analysis data (or None if the sound has no analysis) keyed by sound id. Only sounds whose
+            analysis was found in the cache are included.
+    """
+    cache_keys = {get_ac_analysis_cache_key(sound_id): int(sound_id) for sound_id in sound_ids}
+    return {cache_keys[key]: analysis or None for key, analysis in cache.get_many(cache_keys.keys()).items()}
+
+
+def touch_sound(sound_id):
+    """Updates the modification date of a sound (which is part of its ETag) when its Audio Commons analysis changes"""
+    apps.get_model('sounds', 'Sound').objects.filter(id=sound_id).update(modified=timezone.now())
+
+
+@receiver(post_save, sender='sounds.SoundAnalysis')
+def update_cached_ac_analysis(sender, instance, **kwargs):
+    if instance.extractor == settings.AUDIOCOMMONS_EXTRACTOR_NAME:
+        cache_ac_analysis({instance.sound_id: serialize_ac_analysis(instance.get_analysis())})
+        touch_sound(instance.sound_id)
+
+
+@receiver(post_delete, sender='sounds.SoundAnalysis')
+def delete_cached_ac_analysis(sender, instance, **kwargs):
+    if instance.extractor == settings.AUDIOCOMMONS_EXTRACTOR_NAME:
+        cache.delete(get_ac_analysis_cache_key(instance.sound_id))
+        touch_sound(instance.sound_id)
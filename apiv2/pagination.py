@@ -1,8 +1,131 @@
-from rest_framework import pagination
+import base64
+from collections import OrderedDict
+from urllib import urlencode
+from urlparse import parse_qs
+
 from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
 class CustomPagination(pagination.PageNumberPagination):
+    """
+    Page number pagination which also supports an opt-in keyset (cursor) mode. When the 'cursor' request parameter
+    is present (an empty value means first page), results are ordered by ('-created', '-id') and pages are obtained
+    by filtering on the (created, id) values of the last returned object instead of using OFFSET. In cursor mode
+    responses include opaque 'next' and 'previous' links but no 'count', so no COUNT(*) query is needed and the cost
+    of getting a page does not depend on how deep the page is.
+
+    Cursor mode is only available in views with 'cursor_pagination = True', whose querysets must have 'created' and
+    'id' fields. Other views ignore the 'cursor' parameter and use page number pagination.
+    """
     page_size = settings.APIV2['PAGE_SIZE']
     page_size_query_param = settings.APIV2['PAGE_SIZE_QUERY_PARAM']
     max_page_size = settings.APIV2['MAX_PAGE_SIZE']
+    cursor_query_param = 'cursor'
+    cursor_template = 'rest_framework/pagination/previous_and_next.html'
+    invalid_cursor_message = 'Invalid cursor'
+    use_cursor = False
+
+    def is_cursor_request(self, request, view):
+        return getattr(view, 'cursor_pagination', False) and self.cursor_query_param in request.query_params
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.use_cursor = self.is_cursor_request(request, view)
+        if not self.use_cursor:
+            return super(CustomPagination, self).paginate_queryset(queryset, request, view=view)
+
+        self.request = request
+        self.template = self.cursor_template
+        self.cursor_page_size = self.get_page_size(request)
+        created, object_id, reverse = self.decode_cursor(request)
+
+        if reverse:
+            # Get objects before the cursor position (in the ('-created', '-id') order)
+            queryset = queryset.order_by('created', 'id')
+            if created is not None:
+                queryset = queryset.filter(created__gte=created)\
+                    .filter(Q(created__gt=created) | Q(created=created, id__gt=object_id))
+        else:
+            # Get objects after the cursor position
+            queryset = queryset.order_by('-created', '-id')
+            if created is not None:
+                queryset = queryset.filter(created__lte=created)\
+                    .filter(Q(created__lt=created) | Q(created=created, id__lt=object_id))
+
+        # Get one extra object to know if there are more objects after the page
+        results = list(queryset[:self.cursor_page_size + 1])
+        has_more = len(results) > self.cursor_page_size
+        results = results[:self.cursor_page_size]
+        if reverse:
+            results.reverse()
+            self.has_next = created is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = created is not None
+        self.page_results = results
+        return results
+
+    def get_paginated_response(self, data):
+        if not self.use_cursor:
+            return super(CustomPagination, self).get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_next_link(self):
+        if not self.use_cursor:
+            return super(CustomPagination, self).get_next_link()
+        if not self.has_next or not self.page_results:
+            return None
+        return self.encode_cursor(self.page_results[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.use_cursor:
+            return super(CustomPagination, self).get_previous_link()
+        if not self.has_previous or not self.page_results:
+            return None
+        return self.encode_cursor(self.page_results[0], reverse=True)
+
+    def decode_cursor(self, request):
+        """
+        Returns the (created, id, reverse) position encoded in the cursor request parameter. Empty cursor means the
+        beginning of the list.
+        """
+        encoded = request.query_params.get(self.cursor_query_param, '')
+        if not encoded:
+            return None, None, False
+        try:
+            querystring = base64.urlsafe_b64decode(str(encoded))
+            tokens = parse_qs(querystring, keep_blank_values=True)
+            created = parse_datetime(tokens['c'][0])
+            object_id = int(tokens['i'][0])
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if created is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created, object_id, reverse
+
+    def encode_cursor(self, obj, reverse):
+        tokens = OrderedDict([('c', obj.created.isoformat()), ('i', obj.id)])
+        if reverse:
+            tokens['r'] = 1
+        encoded = base64.urlsafe_b64encode(urlencode(tokens))
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_html_context(self):
+        if not self.use_cursor:
+            return super(CustomPagination, self).get_html_context()
+        return {
+            'previous_url': self.get_previous_link(),
+            'next_url': self.get_next_link(),
+        }
@@ -25,7 +25,8 @@ from django.contrib.auth.models import User
 from django.urls import reverse
 from rest_framework import serializers
 
-from apiv2_utils import prepend_base
+from apiv2.models import serialize_ac_analysis, cache_ac_analysis, get_cached_ac_analysis
+from apiv2_utils import prepend_base, prepend_base_to_reverse, prepend_base_to_location
 from bookmarks.models import BookmarkCategory, Bookmark
 from comments.models import Comment
 from sounds.models import Sound, Pack, SoundAnalysis
@@ -53,6 +54,7 @@ class AbstractSoundSerializer(serializers.HyperlinkedModelSerializer):
 
     def __init__(self, *args, **kwargs):
         super(AbstractSoundSerializer, self).__init__(*args, **kwargs)
+        self.request_is_secure = self.context['request'].is_secure()
         requested_fields = self.context['request'].GET.get("fields", self.default_fields)
         if not requested_fields:  # If parameter is in url but parameter is empty, set to default
             requested_fields = self.default_fields
@@ -104,8 +106,8 @@ class AbstractSoundSerializer(serializers.HyperlinkedModelSerializer):
     url = serializers.SerializerMethodField()
     def get_url(self, obj):
         username = self.get_username(obj)
-        return prepend_base(reverse('sound', args=[username, obj.id]),
-                            request_is_secure=self.context['request'].is_secure())
+        return prepend_base_to_reverse('sound', username=username, sound_id=obj.id,
+                                       request_is_secure=self.request_is_secure)
 
     username = serializers.SerializerMethodField()
     def get_username(self, obj):
@@ -140,8 +142,8 @@ class AbstractSoundSerializer(serializers.HyperlinkedModelSerializer):
     def get_pack(self, obj):
         try:
             if obj.pack_id:
-                return prepend_base(reverse('apiv2-pack-instance', args=[obj.pack_id]),
-                                    request_is_secure=self.context['request'].is_secure())
+                return prepend_base_to_reverse('apiv2-pack-instance', pk=obj.pack_id,
+                                               request_is_secure=self.request_is_secure)
             else:
                 return None
         except:
@@ -154,38 +156,30 @@ class AbstractSoundSerializer(serializers.HyperlinkedModelSerializer):
         except AttributeError:
             return None
 
+    def get_location_url(self, obj, location_name):
+        return prepend_base_to_location(obj.locations(location_name), location_name,
+                                        request_is_secure=self.request_is_secure)
+
     previews = serializers.SerializerMethodField()
     def get_previews(self, obj):
         return {
-            'preview-hq-mp3': prepend_base(obj.locations("preview.HQ.mp3.url"),
-                                           request_is_secure=self.context['request'].is_secure()),
-            'preview-hq-ogg': prepend_base(obj.locations("preview.HQ.ogg.url"),
-                                           request_is_secure=self.context['request'].is_secure()),
-            'preview-lq-mp3': prepend_base(obj.locations("preview.LQ.mp3.url"),
-                                           request_is_secure=self.context['request'].is_secure()),
-            'preview-lq-ogg': prepend_base(obj.locations("preview.LQ.ogg.url"),
-                                           request_is_secure=self.context['request'].is_secure()),
+            'preview-hq-mp3': self.get_location_url(obj, "preview.HQ.mp3.url"),
+            'preview-hq-ogg': self.get_location_url(obj, "preview.HQ.ogg.url"),
+            'preview-lq-mp3': self.get_location_url(obj, "preview.LQ.mp3.url"),
+            'preview-lq-ogg': self.get_location_url(obj, "preview.LQ.ogg.url"),
         }
 
     images = serializers.SerializerMethodField()
     def get_images(self, obj):
         return {
-            'waveform_m': prepend_base(obj.locations("display.wave.M.url"),
-                                       request_is_secure=self.context['request'].is_secure()),
-            'waveform_l': prepend_base(obj.locations("display.wave.L.url"),
-                                       request_is_secure=self.context['request'].is_secure()),
-            'spectral_m': prepend_base(obj.locations("display.spectral.M.url"),
-                                       request_is_secure=self.context['request'].is_secure()),
-            'spectral_l': prepend_base(obj.locations("display.spectral.L.url"),
-                                       request_is_secure=self.context['request'].is_secure()),
-            'waveform_bw_m': prepend_base(obj.locations("display.wave_bw.M.url"),
-                                          request_is_secure=self.context['request'].is_secure()),
-            'waveform_bw_l': prepend_base(obj.locations("display.wave_bw.L.url"),
-                                          request_is_secure=self.context['request'].is_secure()),
-            'spectral_bw_m': prepend_base(obj.locations("display.spectral_bw.M.url"),
-                                          request_is_secure=self.context['request'].is_secure()),
-            'spectral_bw_l': prepend_base(obj.locations("display.spectral_bw.L.url"),
-                                          request_is_secure=self.context['request'].is_secure()),
+            'waveform_m': self.get_location_url(obj, "display.wave.M.url"),
+            'waveform_l': self.get_location_url(obj, "display.wave.L.url"),
+            'spectral_m': self.get_location_url(obj, "display.spectral.M.url"),
+            'spectral_l': self.get_location_url(obj, "display.spectral.L.url"),
+            'waveform_bw_m': self.get_location_url(obj, "display.wave_bw.M.url"),
+            'waveform_bw_l': self.get_location_url(obj, "display.wave_bw.L.url"),
+            'spectral_bw_m': self.get_location_url(obj, "display.spectral_bw.M.url"),
+            'spectral_bw_l': self.get_location_url(obj, "display.spectral_bw.L.url"),
         }
 
 
@@ -197,47 +191,46 @@ class AbstractSoundSerializer(serializers.HyperlinkedModelSerializer):
     def get_analysis_frames(self, obj):
         if obj.analysis_state != 'OK':
             return None
-        return prepend_base(obj.locations('analysis.frames.url'),
-                            request_is_secure=self.context['request'].is_secure())
+        return self.get_location_url(obj, 'analysis.frames.url')
 
     analysis_stats = serializers.SerializerMethodField()
     def get_analysis_stats(self, obj):
         if obj.analysis_state != 'OK':
             return None
-        return prepend_base(reverse('apiv2-sound-analysis', args=[obj.id]),
-                            request_is_secure=self.context['request'].is_secure())
+        return prepend_base_to_reverse('apiv2-sound-analysis', pk=obj.id,
+                                       request_is_secure=self.request_is_secure)
 
     similar_sounds = serializers.SerializerMethodField()
     def get_similar_sounds(self, obj):
         if obj.similarity_state != 'OK':
             return None
-        return prepend_base(reverse('apiv2-similarity-sound', args=[obj.id]),
-                            request_is_secure=self.context['request'].is_secure())
+        return prepend_base_to_reverse('apiv2-similarity-sound', pk=obj.id,
+                                       request_is_secure=self.request_is_secure)
 
     download = serializers.SerializerMethodField()
     def get_download(self, obj):
-        return prepend_base(reverse('apiv2-sound-download', args=[obj.id]),
-                            request_is_secure=self.context['request'].is_secure())
+        return prepend_base_to_reverse('apiv2-sound-download', pk=obj.id,
+                                       request_is_secure=self.request_is_secure)
 
     rate = serializers.SerializerMethodField()
     def get_rate(self, obj):
-        return prepend_base(reverse('apiv2-user-create-rating', args=[obj.id]),
-                            request_is_secure=self.context['request'].is_secure())
+        return prepend_base_to_reverse('apiv2-user-create-rating', pk=obj.id,
+                                       request_is_secure=self.request_is_secure)
 
     bookmark = serializers.SerializerMethodField()
     def get_bookmark(self, obj):
-        return prepend_base(reverse('apiv2-user-create-bookmark', args=[obj.id]),
-                            request_is_secure=self.context['request'].is_secure())
+        return prepend_base_to_reverse('apiv2-user-create-bookmark', pk=obj.id,
+                                       request_is_secure=self.request_is_secure)
 
     comment = serializers.SerializerMethodField()
     def get_comment(self, obj):
-        return prepend_base(reverse('apiv2-user-create-comment', args=[obj.id]),
-                            request_is_secure=self.context['request'].is_secure())
+        return prepend_base_to_reverse('apiv2-user-create-comment', pk=obj.id,
+                                       request_is_secure=self.request_is_secure)
 
     ratings = serializers.SerializerMethodField()
     def get_ratings(self, obj):
-        return prepend_base(reverse('apiv2-sound-ratings', args=[obj.id]),
-                            request_is_secure=self.context['request'].is_secure())
+        return prepend_base_to_reverse('apiv2-sound-ratings', pk=obj.id,
+                                       request_is_secure=self.request_is_secure)
 
     avg_rating = serializers.SerializerMethodField()
     def get_avg_rating(self, obj):
@@ -245,8 +238,8 @@ class AbstractSoundSerializer(serializers.HyperlinkedModelSerializer):
 
     comments = serializers.SerializerMethodField()
     def get_comments(self, obj):
-        return prepend_base(reverse('apiv2-sound-comments', args=[obj.id]),
-                            request_is_secure=self.context['request'].is_secure())
+        return prepend_base_to_reverse('apiv2-sound-comments', pk=obj.id,
+                                       request_is_secure=self.request_is_secure)
 
     geotag = serializers.SerializerMethodField()
     def get_geotag(self, obj):
@@ -259,6 +252,22 @@ class AbstractSoundSerializer(serializers.HyperlinkedModelSerializer):
     def get_ac_analysis(self, obj):
         raise NotImplementedError  # Should be implemented in subclasses
 
+    def load_and_cache_ac_analysis(self, obj):
+        # Serialize analysis data already loaded in the provided object (see SoundManager.bulk_query) or get it from
+        # the related SoundAnalysis object corresponding to the Audio Commons extractor, and store it in the cache
+        analysis = None
+        if hasattr(obj, 'ac_analysis'):
+            analysis = obj.ac_analysis
+        else:
+            # No ac analysis data already loaded in the object, load it with an extra query
+            try:
+                analysis = obj.analyses.get(extractor=settings.AUDIOCOMMONS_EXTRACTOR_NAME).get_analysis()
+            except SoundAnalysis.DoesNotExist:
+                pass
+        ac_analysis = serialize_ac_analysis(analysis)
+        cache_ac_analysis({obj.id: ac_analysis})
+        return ac_analysis
+
 
 class SoundListSerializer(AbstractSoundSerializer):
 
@@ -276,12 +285,25 @@ class SoundListSerializer(AbstractSoundSerializer):
             return None
 
     def get_ac_analysis(self, obj):
-        # Get ac analysis data form the object itself as it will have been included in the Sound
-        # by SoundManager.bulk_query
-        if obj.ac_analysis:
-            return {'{0}{1}'.format(settings.AUDIOCOMMONS_DESCRIPTOR_PREFIX, key): value
-                    for key, value in obj.ac_analysis.items()}
-        return None
+        # Get ac analysis data from the view class if it was found in the cache (see
+        # get_analysis_data_for_queryset_or_sound_ids), otherwise serialize it from the object itself as it will have
+        # been included in the Sound by SoundManager.bulk_query
+        try:
+            return self.context['view'].sound_ac_analysis_data[obj.id]
+        except (AttributeError, KeyError):
+            return self.load_and_cache_ac_analysis(obj)
+
+
+class SoundBulkInstanceSerializer(SoundListSerializer):
+    """
+    Serializer used in the bulk sound instance resource. It has the same default fields as SoundSerializer, but like
+    SoundListSerializer it expects analysis data to have been loaded in the view for all sounds at once.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # Skip SoundListSerializer.__init__ as it would set the default fields of sound lists
+        self.default_fields = DEFAULT_FIELDS_IN_SOUND_DETAIL
+        AbstractSoundSerializer.__init__(self, *args, **kwargs)
 
 
 class SoundSerializer(AbstractSoundSerializer):
@@ -308,27 +330,12 @@ class SoundSerializer(AbstractSoundSerializer):
             return None
 
     def get_ac_analysis(self, obj):
-        # Retreive analysis data already loaded in the provided object of get it from related SoundAnalysis object
-        # corresponding to the Audio Commons extractor.
-
-        analysis_items = {}
-        if hasattr(obj, 'ac_analysis'):
-            if obj.ac_analysis is not None:
-                analysis_items = obj.ac_analysis.items()
-        else:
-            # No ac analysis data already loaded in the object, load it with an extra query
-            try:
-                analysis_items = obj.analyses.get(extractor=settings.AUDIOCOMMONS_EXTRACTOR_NAME).get_analysis().items()
-            except SoundAnalysis.DoesNotExist:
-                # Do nothing, will lead to end of the method returning None
-                pass
-
-        if analysis_items:
-            # Add Audio Commons descirptor prefix so names better match with the names used in filters
-            return {'{0}{1}'.format(settings.AUDIOCOMMONS_DESCRIPTOR_PREFIX, key): value
-                    for key, value in analysis_items}
-        else:
-            return None
+        # Retrieve serialized analysis data from the cache, or from analysis data already loaded in the provided object
+        # or from the related SoundAnalysis object corresponding to the Audio Commons extractor.
+        cached_ac_analysis = get_cached_ac_analysis([obj.id])
+        if obj.id in cached_ac_analysis:
+            return cached_ac_analysis[obj.id]
+        return self.load_and_cache_ac_analysis(obj)
 
 
 ##################
@@ -17,20 +17,45 @@
 # Authors:
 #     See AUTHORS file.
 #
-from django.test import TestCase, SimpleTestCase, RequestFactory
+import datetime
+import hashlib
+import os
+import re
+import threading
+import time
+
+import mock
+from django.test import TestCase, SimpleTestCase, RequestFactory, override_settings
 from django.urls import reverse
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-
-from apiv2.models import ApiV2Client
-from apiv2.apiv2_utils import ApiSearchPaginator
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from oauth2_provider.models import AccessToken
+from rest_framework.exceptions import AuthenticationFailed
+
+from apiv2.models import ApiV2Client, get_ac_analysis_cache_key
+from apiv2.apiv2_utils import ApiSearchPaginator, prepend_base, prepend_base_to_reverse
+from apiv2 import combined_search_strategies
+from apiv2.authentication import TokenAuthentication, OAuth2Authentication
+from apiv2.throttling import ClientBasedThrottlingBurst, ClientBasedThrottlingSustained, IpBasedThrottling
 from apiv2.serializers import SoundListSerializer, DEFAULT_FIELDS_IN_SOUND_LIST, SoundSerializer
+from bookmarks.models import Bookmark, BookmarkCategory
+from comments.models import Comment
 from forms import SoundCombinedSearchFormAPI
-from sounds.models import Sound
-from utils.test_helpers import create_user_and_sounds
+from ratings.models import SoundRating
+from sounds.models import Sound, Pack, SoundAnalysis
+from utils.test_helpers import create_user_and_sounds, override_uploads_path_with_temp_directory, \
+    override_file_upload_temp_dir_with_temp_directory, override_upload_proxy_store_path_with_temp_directory
+from utils.upload_handlers import StreamingFileUploadHandler
 
-from exceptions import BadRequestException
+from exceptions import BadRequestException, Throttled
 
 
 class TestAPiViews(TestCase):
@@ -363,3 +388,846 @@ class TestSoundSerializer(TestCase):
             dummy_request = self.factory.get(reverse('apiv2-sound-instance', args=[self.sound.id]))
             serialized_sound = SoundSerializer(self.sound, context={'request': dummy_request}).data
             self.assertItemsEqual(serialized_sound.keys(), SoundSerializer.Meta.fields)
+
+
+class TestUrlTemplates(TestCase):
+
+    fixtures = ['licenses', 'sounds']
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_prepend_base_to_reverse(self):
+        # URLs built from templates must be exactly the same as those built with reverse and prepend_base
+        for request_is_secure in [False, True]:
+            for username in ['Anton', 'user.name@example+1_-', u'usu\xe0ri', 'user name', '..']:
+                self.assertEqual(
+                    prepend_base_to_reverse('sound', username=username, sound_id=1234,
+                                            request_is_secure=request_is_secure),
+                    prepend_base(reverse('sound', args=[username, 1234]), request_is_secure=request_is_secure))
+            for url_name in ['apiv2-sound-download', 'apiv2-similarity-sound', 'apiv2-pack-instance']:
+                self.assertEqual(
+                    prepend_base_to_reverse(url_name, pk=98765, request_is_secure=request_is_secure),
+                    prepend_base(reverse(url_name, args=[98765]), request_is_secure=request_is_secure))
+
+        # Resources requiring https use https even if request is not secure
+        self.assertTrue(prepend_base_to_reverse('apiv2-sound-download', pk=1).startswith('https://'))
+        self.assertTrue(prepend_base_to_reverse('apiv2-similarity-sound', pk=1).startswith('http://'))
+
+    def test_templates_follow_site_domain(self):
+        prepend_base_to_reverse('apiv2-pack-instance', pk=1)
+        site = Site.objects.get_current()
+        site.domain = 'other.example.com'
+        site.save()
+        self.assertEqual(prepend_base_to_reverse('apiv2-pack-instance', pk=1),
+                         'http://other.example.com%s' % reverse('apiv2-pack-instance', args=[1]))
+
+    def test_serializer_urls_unchanged(self):
+        sounds = list(Sound.objects.bulk_query_id(list(Sound.objects.all().values_list('id', flat=True)[0:5])))
+        fields_parameter = ','.join(SoundListSerializer.Meta.fields)
+        for secure in [False, True]:
+            dummy_request = self.factory.get(reverse('apiv2-sound-text-search'), {'fields': fields_parameter},
+                                             secure=secure)
+            serialized_sounds = SoundListSerializer(sounds, many=True, context={'request': dummy_request}).data
+            for sound, serialized_sound in zip(sounds, serialized_sounds):
+                self.assertEqual(serialized_sound['url'], prepend_base(
+                    reverse('sound', args=[sound.username, sound.id]), request_is_secure=secure))
+                self.assertEqual(serialized_sound['download'], prepend_base(
+                    reverse('apiv2-sound-download', args=[sound.id]), request_is_secure=secure))
+                self.assertEqual(serialized_sound['comments'], prepend_base(
+                    reverse('apiv2-sound-comments', args=[sound.id]), request_is_secure=secure))
+                self.assertEqual(serialized_sound['previews']['preview-hq-mp3'], prepend_base(
+                    sound.locations('preview.HQ.mp3.url'), request_is_secure=secure))
+                self.assertEqual(serialized_sound['images']['spectral_bw_l'], prepend_base(
+                    sound.locations('display.spectral_bw.L.url'), request_is_secure=secure))
+
+
+class TestCombinedSearchStrategies(SimpleTestCase):
+
+    def setUp(self):
+        self.gaia_ids = range(1, 3001)
+        self.search_form = mock.Mock(cleaned_data={
+            'target': '1', 'query': None, 'filter': 'tag:dog', 'descriptors_filter': None, 'page': 1,
+            'page_size': 15})
+        self.solr_requests = []
+        self.lock = threading.Lock()
+
+    def fake_gaia_results(self, search_form, target_file, page_size, max_pages, start_page=1, valid_ids=None,
+                          offset=None):
+        gaia_ids = self.gaia_ids[offset or 0:]
+        return gaia_ids, len(gaia_ids), dict([(sid, 0.0) for sid in gaia_ids]), None
+
+    def fake_solr_results(self, search_form, page_size, max_pages, start_page=1, valid_ids=None, solr=None,
+                          offset=None, delay=0.0):
+        with self.lock:
+            self.solr_requests.append(valid_ids[0])
+        if delay and valid_ids[0] != self.gaia_ids[0]:
+            # Only the first block is fast
+            time.sleep(delay)
+        # One in 100 sounds matches the solr query
+        solr_ids = [sid for sid in valid_ids if sid % 100 == 0]
+        return solr_ids, len(solr_ids)
+
+    def test_iterate_concurrently(self):
+        tasks = [lambda x=x: x * 2 for x in range(20)]
+        results = combined_search_strategies.iterate_concurrently(tasks, 4, time.time() + 10)
+        self.assertEqual(list(results), [x * 2 for x in range(20)])
+
+        def failing_task():
+            raise ValueError
+        with self.assertRaises(ValueError):
+            list(combined_search_strategies.iterate_concurrently([failing_task], 4, time.time() + 10))
+
+        with self.assertRaises(combined_search_strategies.TimeBudgetExceeded):
+            list(combined_search_strategies.iterate_concurrently([lambda: time.sleep(1)], 4, time.time() + 0.1))
+
+    def test_merge_optimized_concurrent_blocks(self):
+        with mock.patch.object(combined_search_strategies, 'get_gaia_results', self.fake_gaia_results), \
+                mock.patch.object(combined_search_strategies, 'get_solr_results', self.fake_solr_results):
+            results, count, _, _, note, params_for_next_page, _ = combined_search_strategies.merge_optimized(
+                self.search_form, extra_parameters={'cs_solr_filter_id_block_size': 100, 'cs_solr_filter_id_max_pages': 20,
+                                                    'cs_max_workers': 2})
+
+        # Results are the same as processing blocks sequentially
+        self.assertEqual(results, range(100, 1501, 100))
+        self.assertEqual(params_for_next_page['cs_lcvidp'], 1500)
+        self.assertIsNone(note)
+        # Outstanding blocks are cancelled once enough results are found (15 blocks needed, at most 2 workers)
+        self.assertLessEqual(len(self.solr_requests), 15 + 2)
+
+    @override_settings(APIV2_COMBINED_SEARCH_MAX_WORKERS=4, APIV2_COMBINED_SEARCH_TIME_BUDGET=20)
+    def test_concurrency_parameters_limits(self):
+        # Clients can lower the concurrency limits but not raise them
+        self.assertEqual(combined_search_strategies.limit_concurrency_parameters(
+            {'cs_max_workers': 1000, 'cs_time_budget': 3600, 'cs_lcvidp': 5}),
+            {'cs_max_workers': 4, 'cs_time_budget': 20, 'cs_lcvidp': 5})
+        self.assertEqual(combined_search_strategies.limit_concurrency_parameters(
+            {'cs_max_workers': 0, 'cs_time_budget': 5}), {'cs_max_workers': 1, 'cs_time_budget': 5})
+
+        max_workers, deadline = combined_search_strategies.get_concurrency_parameters({'cs_max_workers': 1000})
+        self.assertEqual(max_workers, 4)
+        self.assertLessEqual(deadline, time.time() + 20)
+
+    def test_merge_optimized_time_budget(self):
+        with mock.patch.object(combined_search_strategies, 'get_gaia_results', self.fake_gaia_results), \
+                mock.patch.object(combined_search_strategies, 'get_solr_results',
+                                  lambda *args, **kwargs: self.fake_solr_results(*args, delay=3, **kwargs)):
+            start = time.time()
+            results, count, _, _, note, params_for_next_page, _ = combined_search_strategies.merge_optimized(
+                self.search_form, extra_parameters={'cs_solr_filter_id_block_size': 100, 'cs_time_budget': 1})
+
+        # Partial results from the first block are returned and flagged in note
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(results, [100])
+        self.assertEqual(note, combined_search_strategies.PARTIAL_RESULTS_NOTE)
+        self.assertEqual(params_for_next_page['cs_lcvidp'], 100)
+        self.assertNotIn('no_more_results', params_for_next_page)
+
+    def test_merge_all_concurrent_pages(self):
+        self.search_form.cleaned_data.update({'target': None, 'query': 'dog', 'descriptors_filter': 'filter'})
+
+        def fake_solr_pages(search_form, page_size, max_pages, start_page=1, valid_ids=None, solr=None, offset=None):
+            # Solr results are sounds with ids 10, 20, 30, ... 2500
+            solr_ids = range(10, 2501, 10)[(start_page - 1) * page_size:start_page * page_size]
+            with self.lock:
+                self.solr_requests.append(start_page)
+            return solr_ids, 250
+
+        with mock.patch.object(combined_search_strategies, 'get_gaia_results', self.fake_gaia_results), \
+                mock.patch.object(combined_search_strategies, 'get_solr_results', fake_solr_pages):
+            results, count, _, _, note, _, _ = combined_search_strategies.merge_all(
+                self.search_form, extra_parameters={'cs_solr_page_size': 20})
+
+        # 10 pages of solr results are combined with all gaia results
+        self.assertEqual(count, 200)
+        self.assertEqual(results, range(10, 151, 10))
+        self.assertIsNone(note)
+        self.assertItemsEqual(self.solr_requests, range(1, 11))
+
+
+class TestThrottling(SimpleTestCase):
+
+    def setUp(self):
+        # Use a separate local memory cache to not interfere with other tests
+        self.cache = LocMemCache('throttling-tests', {})
+        self.cache.clear()
+        self.view = mock.Mock(throttling_cost=1, throttling_rates_per_level={
+            0: ['0/minute', '0/day', '0/hour'],
+            1: ['5/minute', '8/day', '2/hour'],
+        })
+        # Don't log throttled requests (requests are mock objects)
+        for target in ['apiv2.apiv2_utils.log_message_helper', 'apiv2.exceptions.errors_logger']:
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_request(self, throttling_level=1, client_id='client', ip='1.1.1.1'):
+        request = mock.Mock(META={'HTTP_X_FORWARDED_FOR': ip})
+        request.successful_authenticator.authentication_method_name = 'Token'
+        request.auth.throttling_level = throttling_level
+        request.auth.client_id = client_id
+        return request
+
+    def make_throttle(self, throttle_class, now=1000.0):
+        throttle = throttle_class()
+        throttle.cache = self.cache
+        throttle.timer = lambda: now
+        return throttle
+
+    def test_burst_and_sustained_limits(self):
+        for i in range(5):
+            self.assertTrue(self.make_throttle(ClientBasedThrottlingBurst).allow_request(self.make_request(), self.view))
+        with self.assertRaises(Throttled) as cm:
+            self.make_throttle(ClientBasedThrottlingBurst).allow_request(self.make_request(), self.view)
+        self.assertEqual(cm.exception.detail, 'Request was throttled because of exceeding a request limit rate (5/minute)')
+
+        # Counters are independent for each client and reset in next window
+        self.assertTrue(self.make_throttle(ClientBasedThrottlingBurst).allow_request(
+            self.make_request(client_id='other_client'), self.view))
+        self.assertTrue(self.make_throttle(ClientBasedThrottlingBurst, now=1000.0 + 60).allow_request(
+            self.make_request(), self.view))
+
+        for i in range(8):
+            self.assertTrue(self.make_throttle(ClientBasedThrottlingSustained).allow_request(
+                self.make_request(), self.view))
+        with self.assertRaises(Throttled) as cm:
+            self.make_throttle(ClientBasedThrottlingSustained).allow_request(self.make_request(), self.view)
+        self.assertEqual(cm.exception.detail, 'Request was throttled because of exceeding a request limit rate (8/day)')
+
+    def test_throttling_cost(self):
+        # Requests to views with a throttling cost count as several requests
+        self.view.throttling_cost = 2
+        for i in range(2):
+            self.assertTrue(self.make_throttle(ClientBasedThrottlingBurst).allow_request(self.make_request(), self.view))
+        with self.assertRaises(Throttled):
+            self.make_throttle(ClientBasedThrottlingBurst).allow_request(self.make_request(), self.view)
+
+    def test_suspended_client(self):
+        with self.assertRaises(Throttled) as cm:
+            self.make_throttle(ClientBasedThrottlingBurst).allow_request(self.make_request(0), self.view)
+        self.assertEqual(cm.exception.detail, 'Request was throttled because the ApiV2 credential has been suspended')
+
+    def test_ip_limit(self):
+        # Two different ips are allowed per hour, and ips already seen can do more requests
+        for ip in ['1.1.1.1', '2.2.2.2', '1.1.1.1', '2.2.2.2']:
+            self.assertTrue(self.make_throttle(IpBasedThrottling).allow_request(self.make_request(ip=ip), self.view))
+        for i in range(2):
+            with self.assertRaises(Throttled) as cm:
+                self.make_throttle(IpBasedThrottling).allow_request(self.make_request(ip='3.3.3.3'), self.view)
+        self.assertEqual(cm.exception.detail,
+                         'Request was throttled because of exceeding the concurrent ip limit rate (2/hour)')
+        self.assertTrue(self.make_throttle(IpBasedThrottling).allow_request(self.make_request(ip='1.1.1.1'), self.view))
+
+    def test_concurrent_requests(self):
+        # When many requests are made at the same time, exactly 'num_requests' of them must pass the throttle
+        self.view.throttling_rates_per_level[1] = ['50/minute', '1000/day', None]
+        passed = []
+        throttled = []
+
+        def do_requests():
+            for i in range(20):
+                try:
+                    self.make_throttle(ClientBasedThrottlingBurst).allow_request(self.make_request(), self.view)
+                    passed.append(True)
+                except Throttled:
+                    throttled.append(True)
+
+        threads = [threading.Thread(target=do_requests) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(passed), 50)
+        self.assertEqual(len(throttled), 150)
+
+
+class TestCachedCredentials(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='developer', password='testpass', email='dev@freesound.org')
+        self.api_client = ApiV2Client.objects.create(user=self.user, description='', name='', url='',
+                                                     redirect_uri='https://freesound.org')
+        self.access_token = AccessToken.objects.create(
+            user=self.user, application=self.api_client.oauth_client, token='oauth2token', scope='read',
+            expires=timezone.now() + datetime.timedelta(hours=1))
+        self.factory = RequestFactory()
+
+    def token_authenticate(self):
+        request = self.factory.get(reverse('apiv2-sound-text-search'),
+                                   HTTP_AUTHORIZATION='Token %s' % self.api_client.key)
+        return TokenAuthentication().authenticate(request)
+
+    def oauth2_authenticate(self):
+        request = self.factory.get(reverse('apiv2-sound-text-search'), HTTP_AUTHORIZATION='Bearer oauth2token')
+        return OAuth2Authentication().authenticate(request)
+
+    def test_token_authentication_cached(self):
+        self.token_authenticate()
+        with self.assertNumQueries(0):
+            user, token = self.token_authenticate()
+            # Properties used when logging and throttling the request do not trigger queries either
+            self.assertEqual(token.client_id, self.api_client.client_id)
+            self.assertEqual(token.throttling_level, 1)
+        self.assertEqual(user, self.user)
+        self.assertEqual(token, self.api_client)
+
+    def test_token_authentication_invalidation(self):
+        self.token_authenticate()
+        self.api_client.status = 'REV'
+        self.api_client.save()
+        with self.assertRaisesMessage(AuthenticationFailed, 'Suspended token or token pending for approval'):
+            self.token_authenticate()
+
+        self.api_client.status = 'OK'
+        self.api_client.save()
+        self.token_authenticate()
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaisesMessage(AuthenticationFailed, 'User inactive or deleted'):
+            self.token_authenticate()
+
+        self.api_client.delete()
+        with self.assertRaisesMessage(AuthenticationFailed, 'Invalid token'):
+            self.token_authenticate()
+
+    def test_oauth2_authentication_cached(self):
+        self.oauth2_authenticate()
+        with self.assertNumQueries(0):
+            user, access_token = self.oauth2_authenticate()
+            self.assertEqual(access_token.application.apiv2_client.client_id, self.api_client.client_id)
+        self.assertEqual(user, self.user)
+        self.assertEqual(access_token, self.access_token)
+
+    def test_oauth2_authentication_invalidation(self):
+        self.oauth2_authenticate()
+        self.api_client.status = 'REV'
+        self.api_client.save()
+        with self.assertRaisesMessage(AuthenticationFailed, 'Suspended token or token pending for approval'):
+            self.oauth2_authenticate()
+
+        self.api_client.status = 'OK'
+        self.api_client.save()
+        self.oauth2_authenticate()
+        self.access_token.delete()
+        self.assertIsNone(self.oauth2_authenticate())
+
+
+class TestKeysetPagination(TestCase):
+
+    fixtures = ['licenses']
+
+    def setUp(self):
+        self.user, _, sounds = create_user_and_sounds(num_sounds=23, processing_state='OK', moderation_state='OK')
+        # Some sounds have the same creation date so results must be sorted by id as well
+        Sound.objects.filter(id__in=[sound.id for sound in sounds[5:12]]).update(
+            created=datetime.datetime(2019, 1, 1, 12, 0, 0, 123456))
+        self.expected_ids = list(Sound.objects.order_by('-created', '-id').values_list('id', flat=True))
+        self.client.login(username=self.user.username, password='testpass')
+
+    @staticmethod
+    def normalize_sql(sql):
+        # Remove parameters from sql queries so that queries for different pages can be compared
+        return re.sub(r"\b\d+\b", '?', re.sub(r"'[^']*'", '?', sql))
+
+    def get_all_pages(self, url, direction='next'):
+        ids = []
+        queries = []
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page_ids = [sound['id'] for sound in response.data['results']]
+            ids = ids + page_ids if direction == 'next' else page_ids + ids
+            queries.append([self.normalize_sql(query['sql']) for query in context.captured_queries])
+            self.assertNotIn('count', response.data)
+            url = response.data[direction]
+        return ids, queries
+
+    def test_cursor_pagination(self):
+        url = reverse('apiv2-user-sound-list', args=[self.user.username]) + '?cursor=&page_size=5&fields=id'
+        ids, queries = self.get_all_pages(url)
+        self.assertEqual(ids, self.expected_ids)
+        self.assertEqual(len(queries), 5)
+
+        # Number of queries and queries themselves are the same for all pages but the first one (which does not
+        # filter by cursor position), and no COUNT or OFFSET are used
+        for page_queries in queries[2:]:
+            self.assertEqual(page_queries, queries[1])
+        for query in [query for query in queries[1] if 'FROM "sounds_sound"' in query]:
+            self.assertNotIn('COUNT(', query)
+            self.assertNotIn('OFFSET', query)
+
+        # Go back using previous links
+        response = self.client.get(url)
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+        ids, queries = self.get_all_pages(response.data['previous'], direction='previous')
+        self.assertEqual(ids, self.expected_ids[:20])
+        for page_queries in queries[1:]:
+            self.assertEqual(page_queries, queries[0])
+
+    def test_page_parameter_still_works(self):
+        url = reverse('apiv2-user-sound-list', args=[self.user.username])
+        response = self.client.get(url, {'page': 2, 'page_size': 5, 'fields': 'id'})
+        self.assertEqual(response.data['count'], 23)
+        self.assertEqual([sound['id'] for sound in response.data['results']], self.expected_ids[5:10])
+
+    def test_invalid_cursor(self):
+        url = reverse('apiv2-user-sound-list', args=[self.user.username])
+        response = self.client.get(url, {'cursor': 'notavalidcursor'})
+        self.assertEqual(response.status_code, 404)
+
+
+    def test_cursor_ignored_in_views_without_cursor_pagination(self):
+        category = BookmarkCategory.objects.create(user=self.user, name='Category')
+        sound = Sound.objects.get(id=self.expected_ids[0])
+        Bookmark.objects.create(user=self.user, sound=sound, category=category)
+        Bookmark.objects.create(user=self.user, sound=sound)
+
+        url = reverse('apiv2-user-bookmark-categories', args=[self.user.username])
+        response = self.client.get(url, {'cursor': ''})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([category['name'] for category in response.data['results']], ['Uncategorized', 'Category'])
+
+
+class TestSoundBulkInstance(TestCase):
+
+    fixtures = ['licenses']
+
+    def setUp(self):
+        self.user, _, self.sounds = create_user_and_sounds(num_sounds=5, processing_state='OK', moderation_state='OK')
+        self.sounds[4].moderation_state = 'PE'
+        self.sounds[4].save()
+        self.client.login(username=self.user.username, password='testpass')
+        self.url = reverse('apiv2-sound-bulk-instance')
+
+    def test_sound_bulk_instance(self):
+        ids = [self.sounds[2].id, 0, self.sounds[0].id, self.sounds[4].id, self.sounds[2].id]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, {'ids': ','.join([str(sid) for sid in ids])})
+        self.assertEqual(response.status_code, 200)
+
+        # Results are returned in the requested order and not found (or not public) sounds are null
+        self.assertEqual([sound['id'] if sound else None for sound in response.data['results']],
+                         [self.sounds[2].id, None, self.sounds[0].id, None, self.sounds[2].id])
+        self.assertEqual(response.data['not_found'], [0, self.sounds[4].id])
+        # All sound fields are returned by default, like in the sound instance resource
+        self.assertItemsEqual(response.data['results'][0].keys(), SoundSerializer.Meta.fields)
+
+        # Sounds are retrieved with a single query
+        self.assertEqual(len([query for query in context.captured_queries
+                              if re.search(r'FROM\s+"?sounds_sound"?', query['sql'])]), 1)
+
+        response = self.client.get(self.url, {'ids': self.sounds[1].id, 'fields': 'id,name'})
+        self.assertEqual(response.data['results'], [{'id': self.sounds[1].id, 'name': self.sounds[1].original_filename}])
+
+    def test_sound_bulk_instance_analysis(self):
+        self.sounds[0].analysis_state = 'OK'
+        self.sounds[0].save()
+        self.sounds[1].analysis_state = 'OK'
+        self.sounds[1].save()
+        ids = '%i,%i' % (self.sounds[0].id, self.sounds[1].id)
+        with mock.patch('apiv2.apiv2_utils.get_sounds_descriptors') as get_sounds_descriptors:
+            get_sounds_descriptors.return_value = {str(self.sounds[0].id): {'rhythm': {'bpm': 120}},
+                                                   str(self.sounds[1].id): {'rhythm': {'bpm': 90}}}
+            response = self.client.get(self.url, {'ids': ids, 'fields': 'id,analysis', 'descriptors': 'rhythm.bpm'})
+
+        # Analysis data for all sounds is retrieved at once
+        self.assertEqual(get_sounds_descriptors.call_count, 1)
+        self.assertItemsEqual(get_sounds_descriptors.call_args[0][0], [self.sounds[0].id, self.sounds[1].id])
+        self.assertEqual([sound['analysis'] for sound in response.data['results']],
+                         [{'rhythm': {'bpm': 120}}, {'rhythm': {'bpm': 90}}])
+
+    def test_sound_bulk_instance_all_fields_num_queries(self):
+        # When no fields are specified all fields (including analysis) are returned, and analysis data is loaded
+        # for all sounds at once, so the number of queries does not depend on the number of sounds
+        for sound in self.sounds[:4]:
+            sound.analysis_state = 'OK'
+            sound.save()
+
+        def get_num_queries_and_response(sounds):
+            with mock.patch('apiv2.apiv2_utils.get_sounds_descriptors') as get_sounds_descriptors:
+                get_sounds_descriptors.return_value = {str(sound.id): {'rhythm': {'bpm': 120}} for sound in sounds}
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.get(self.url, {'ids': ','.join([str(sound.id) for sound in sounds]),
+                                                          'descriptors': 'rhythm.bpm'})
+            self.assertEqual(get_sounds_descriptors.call_count, 1)
+            return len(context.captured_queries), response
+
+        num_queries_two_sounds, _ = get_num_queries_and_response(self.sounds[:2])
+        num_queries_four_sounds, response = get_num_queries_and_response(self.sounds[:4])
+        self.assertEqual(num_queries_two_sounds, num_queries_four_sounds)
+        self.assertEqual([sound['analysis'] for sound in response.data['results']], [{'rhythm': {'bpm': 120}}] * 4)
+
+    @override_settings(APIV2_SOUND_BULK_INSTANCE_MAX_IDS=3)
+    def test_sound_bulk_instance_bad_request(self):
+        self.assertEqual(self.client.get(self.url).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'ids': '1,a'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'ids': '1,2,3,4'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'ids': '1,2,3'}).status_code, 200)
+
+
+class TestConditionalRequests(TestCase):
+
+    fixtures = ['licenses']
+
+    def setUp(self):
+        self.user, self.packs, self.sounds = create_user_and_sounds(num_sounds=3, num_packs=1,
+                                                                    processing_state='OK', moderation_state='OK')
+        self.sound = self.sounds[0]
+        self.other_user = User.objects.create_user(username='otheruser', password='testpass')
+        self.client.login(username=self.user.username, password='testpass')
+
+    def assertNotModified(self, url, etag, **params):
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def assertModified(self, url, etag, **params):
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response['ETag']
+
+    def test_sound_instance_conditional_get(self):
+        url = reverse('apiv2-sound-instance', args=[self.sound.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # Unchanged sound is not serialized again
+        with CaptureQueriesContext(connection) as context:
+            self.assertNotModified(url, etag)
+        self.assertEqual(len([query for query in context.captured_queries
+                              if 'sounds_sound' in query['sql']]), 1)
+
+        # Different request parameters have different ETags
+        self.assertModified(url, etag, fields='id,name')
+
+        # Sound edit
+        self.sound.description = 'New description'
+        self.sound.save()
+        etag = self.assertModified(url, etag)
+        self.assertNotModified(url, etag)
+
+        # Comment
+        self.sound.add_comment(self.other_user, 'Nice sound')
+        etag = self.assertModified(url, etag)
+
+        # Rating
+        SoundRating.objects.create(user=self.other_user, sound=self.sound, rating=8)
+        etag = self.assertModified(url, etag)
+
+        # Downloads are counted with queryset updates that do not change Sound.modified
+        Sound.objects.filter(id=self.sound.id).update(num_downloads=5)
+        etag = self.assertModified(url, etag)
+
+        # Moderation change (the sound is not public anymore)
+        self.sound.change_moderation_state('PE')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 404)
+
+    def test_sound_reprocessing_conditional_get(self):
+        url = reverse('apiv2-sound-instance', args=[self.sound.id])
+        etag = self.client.get(url)['ETag']
+
+        # Reprocessing a sound does not change its processing state but it can change its audio properties
+        self.sound.set_audio_info_fields(duration=self.sound.duration + 1.0)
+        self.sound.change_processing_state('OK')
+        etag = self.assertModified(url, etag)
+        self.assertNotModified(url, etag)
+
+        self.sound.change_processing_state('OK')
+        etag = self.assertModified(url, etag)
+
+        list_url = reverse('apiv2-user-sound-list', args=[self.user.username])
+        list_etag = self.client.get(list_url)['ETag']
+        self.sound.set_similarity_state('OK')
+        self.assertModified(url, etag)
+        self.assertModified(list_url, list_etag)
+
+    def test_sound_list_conditional_get(self):
+        url = reverse('apiv2-user-sound-list', args=[self.user.username])
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertNotModified(url, etag)
+
+        self.sounds[1].original_filename = 'New name'
+        self.sounds[1].save()
+        etag = self.assertModified(url, etag)
+
+        self.sounds[2].change_moderation_state('PE')
+        etag = self.assertModified(url, etag)
+        self.assertNotModified(url, etag)
+
+    def test_sound_comments_conditional_get(self):
+        url = reverse('apiv2-sound-comments', args=[self.sound.id])
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, etag)
+
+        self.sound.add_comment(self.other_user, 'Nice sound')
+        etag = self.assertModified(url, etag)
+        self.assertNotModified(url, etag)
+
+    @mock.patch('utils.similarity_utilities.Similarity.get_sounds_descriptors')
+    def test_sound_analysis_all_descriptors(self, similarity_get_sounds_descriptors):
+        similarity_get_sounds_descriptors.return_value = {str(self.sound.id): {'rhythm': {'bpm': 120}}}
+        url = reverse('apiv2-sound-analysis', args=[self.sound.id])
+
+        # When no descriptors are specified all descriptors are returned
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'rhythm': {'bpm': 120}})
+        similarity_get_sounds_descriptors.assert_called_once_with([str(self.sound.id)], [], False, True)
+
+    def test_pack_and_user_conditional_get(self):
+        pack = self.packs[0]
+        url = reverse('apiv2-pack-instance', args=[pack.id])
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, etag)
+        pack.description = 'New description'
+        pack.save()
+        self.assertModified(url, etag)
+
+        url = reverse('apiv2-user-instance', args=[self.user.username])
+        etag = self.client.get(url)['ETag']
+        # Unchanged user is not serialized again (sounds are only counted when serializing)
+        with CaptureQueriesContext(connection) as context:
+            self.assertNotModified(url, etag)
+        self.assertFalse([query for query in context.captured_queries if 'sounds_sound' in query['sql']])
+        self.user.profile.about = 'New about'
+        self.user.profile.save()
+        etag = self.assertModified(url, etag)
+        self.sound.add_comment(self.other_user, 'Nice sound')
+        self.assertNotModified(url, etag)
+        Comment.objects.create(user=self.user, sound=self.sounds[1], comment='Own comment')
+        self.assertModified(url, etag)
+
+    def test_user_packs_conditional_get(self):
+        url = reverse('apiv2-user-packs', args=[self.user.username])
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, etag)
+        self.packs[0].description = 'New description'
+        self.packs[0].save()
+        etag = self.assertModified(url, etag)
+        Pack.objects.create(user=self.user, name='New pack')
+        self.assertModified(url, etag)
+
+    def test_user_bookmarks_conditional_get(self):
+        category = BookmarkCategory.objects.create(user=self.user, name='Category')
+        Bookmark.objects.create(user=self.user, sound=self.sounds[1], category=category)
+        categories_url = reverse('apiv2-user-bookmark-categories', args=[self.user.username])
+        sounds_url = reverse('apiv2-user-bookmark-category-sounds', args=[self.user.username, category.id])
+        categories_etag = self.client.get(categories_url)['ETag']
+        sounds_etag = self.client.get(sounds_url)['ETag']
+        self.assertNotModified(categories_url, categories_etag)
+        self.assertNotModified(sounds_url, sounds_etag)
+
+        # New bookmark
+        Bookmark.objects.create(user=self.user, sound=self.sounds[2], category=category)
+        categories_etag = self.assertModified(categories_url, categories_etag)
+        sounds_etag = self.assertModified(sounds_url, sounds_etag)
+
+        # Bookmarked sound changes
+        self.sounds[2].description = 'New description'
+        self.sounds[2].save()
+        categories_etag = self.assertModified(categories_url, categories_etag)
+        sounds_etag = self.assertModified(sounds_url, sounds_etag)
+
+        # Category renamed
+        category.name = 'New name'
+        category.save()
+        self.assertModified(categories_url, categories_etag)
+
+    @override_settings(AUDIOCOMMONS_EXTRACTOR_NAME='ac-extractor')
+    def test_sound_ac_analysis_conditional_get(self):
+        analysis = SoundAnalysis.objects.create(sound=self.sound, extractor='ac-extractor',
+                                                analysis_data={'tempo': 100})
+        url = reverse('apiv2-sound-instance', args=[self.sound.id])
+        etag = self.client.get(url, {'fields': 'id,ac_analysis'})['ETag']
+        self.assertNotModified(url, etag, fields='id,ac_analysis')
+
+        analysis.analysis_data = {'tempo': 120}
+        analysis.save()
+        etag = self.assertModified(url, etag, fields='id,ac_analysis')
+        analysis.delete()
+        self.assertModified(url, etag, fields='id,ac_analysis')
+
+
+@override_settings(AUDIOCOMMONS_EXTRACTOR_NAME='ac-extractor')
+class TestCachedAcAnalysis(TestCase):
+
+    fixtures = ['licenses']
+
+    def setUp(self):
+        cache.clear()
+        self.user, _, self.sounds = create_user_and_sounds(num_sounds=3, processing_state='OK', moderation_state='OK')
+        for i, sound in enumerate(self.sounds[:2]):
+            SoundAnalysis.objects.create(sound=sound, extractor='ac-extractor', analysis_data={'tempo': 100 + i})
+        self.client.login(username=self.user.username, password='testpass')
+
+    def test_analysis_cached_when_saved(self):
+        self.assertEqual(cache.get(get_ac_analysis_cache_key(self.sounds[0].id)), {'ac_tempo': 100})
+
+        analysis = SoundAnalysis.objects.get(sound=self.sounds[0])
+        analysis.analysis_data = {'tempo': 120}
+        analysis.save()
+        self.assertEqual(cache.get(get_ac_analysis_cache_key(self.sounds[0].id)), {'ac_tempo': 120})
+
+        analysis.delete()
+        self.assertIsNone(cache.get(get_ac_analysis_cache_key(self.sounds[0].id)))
+
+        # Analysis of other extractors are not cached
+        SoundAnalysis.objects.create(sound=self.sounds[2], extractor='other-extractor', analysis_data={'tempo': 90})
+        self.assertIsNone(cache.get(get_ac_analysis_cache_key(self.sounds[2].id)))
+
+    def test_sound_list_ac_analysis(self):
+        url = reverse('apiv2-user-sound-list', args=[self.user.username])
+        # Sounds without analysis are cached (as having no analysis) the first time they are serialized
+        self.client.get(url, {'fields': 'id,ac_analysis'})
+        with mock.patch('apiv2.models.cache.get_many', wraps=cache.get_many) as get_many, \
+                CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, {'fields': 'id,ac_analysis', 'page_size': 10})
+
+        # Analysis for all sounds in the page are retrieved at once and no analysis objects are loaded
+        self.assertEqual(get_many.call_count, 1)
+        self.assertFalse([query for query in context.captured_queries if 'sounds_soundanalysis' in query['sql']])
+        self.assertEqual({sound['id']: sound['ac_analysis'] for sound in response.data['results']}, {
+            self.sounds[0].id: {'ac_tempo': 100},
+            self.sounds[1].id: {'ac_tempo': 101},
+            self.sounds[2].id: None
+        })
+
+    def test_sound_instance_ac_analysis_cache_miss(self):
+        cache.clear()
+        url = reverse('apiv2-sound-instance', args=[self.sounds[1].id])
+        response = self.client.get(url, {'fields': 'id,ac_analysis'})
+        self.assertEqual(response.data['ac_analysis'], {'ac_tempo': 101})
+
+        # Analysis is cached after the first request
+        self.assertEqual(cache.get(get_ac_analysis_cache_key(self.sounds[1].id)), {'ac_tempo': 101})
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, {'fields': 'id,name,ac_analysis'})
+        self.assertEqual(response.data['ac_analysis'], {'ac_tempo': 101})
+        self.assertFalse([query for query in context.captured_queries if 'sounds_soundanalysis' in query['sql']])
+
+
+class TestUploadSound(TestCase):
+
+    fixtures = ['licenses']
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='uploader', password='testpass')
+        self.api_client = ApiV2Client.objects.create(user=self.user, description='', name='', url='',
+                                                     redirect_uri='https://freesound.org')
+        AccessToken.objects.create(user=self.user, application=self.api_client.oauth_client, token='oauth2token',
+                                   scope='read write', expires=timezone.now() + datetime.timedelta(hours=1))
+        self.content = os.urandom(3 * 1024 * 1024 + 123)
+
+        # Count the bytes that the upload handler writes to disk
+        self.bytes_written = []
+        receive_data_chunk = StreamingFileUploadHandler.receive_data_chunk
+
+        def counting_receive_data_chunk(handler, raw_data, start):
+            result = receive_data_chunk(handler, raw_data, start)
+            self.bytes_written.append(len(raw_data))
+            return result
+
+        patcher = mock.patch.object(StreamingFileUploadHandler, 'receive_data_chunk',
+                                    counting_receive_data_chunk)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, data):
+        return self.client.post(reverse('apiv2-uploads-upload'), data, secure=True,
+                                HTTP_AUTHORIZATION='Bearer oauth2token')
+
+    def uploaded_file_path(self, filename):
+        return os.path.join(settings.UPLOADS_PATH, str(self.user.id), filename)
+
+    @override_uploads_path_with_temp_directory
+    @override_file_upload_temp_dir_with_temp_directory
+    def test_upload_streamed_to_uploads_directory(self):
+        with mock.patch('apiv2.views.handle_uploaded_file') as handle_uploaded_file:
+            response = self.upload({'audiofile': SimpleUploadedFile('sound.wav', self.content)})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['filename'], 'sound.wav')
+
+        # The file is written once, directly to its final location, and no temporary files are left
+        self.assertEqual(sum(self.bytes_written), len(self.content))
+        handle_uploaded_file.assert_not_called()
+        self.assertEqual(open(self.uploaded_file_path('sound.wav'), 'rb').read(), self.content)
+        self.assertEqual(os.listdir(settings.FILE_UPLOAD_TEMP_DIR), [])
+
+    @override_uploads_path_with_temp_directory
+    @override_file_upload_temp_dir_with_temp_directory
+    def test_upload_and_describe_uses_streamed_md5(self):
+        with mock.patch('apiv2.views.utils.sound_upload.create_sound') as create_sound, \
+                mock.patch('utils.sound_upload.md5file') as md5file:
+            create_sound.return_value = mock.Mock(id=1)
+            response = self.upload({'audiofile': SimpleUploadedFile('sound.wav', self.content),
+                                    'tags': 'tag1 tag2 tag3', 'description': 'Description', 'license': 'Attribution'})
+        self.assertEqual(response.status_code, 201)
+        sound_fields = create_sound.call_args[0][1]
+        self.assertEqual(sound_fields['md5'], hashlib.md5(self.content).hexdigest())
+        self.assertEqual(sound_fields['dest_path'], self.uploaded_file_path('sound.wav'))
+        md5file.assert_not_called()
+
+    @override_uploads_path_with_temp_directory
+    @override_file_upload_temp_dir_with_temp_directory
+    def test_upload_size_limits(self):
+        # Files bigger than the limit are stopped while being received (without writing more than the limit)
+        with override_settings(UPLOAD_MAX_FILE_SIZE_COMBINED=1024 * 1024):
+            response = self.upload({'audiofile': SimpleUploadedFile('sound.wav', self.content)})
+        self.assertEqual(response.status_code, 413)
+        self.assertLessEqual(sum(self.bytes_written), 1024 * 1024)
+        self.assertFalse(os.path.exists(self.uploaded_file_path('sound.wav')))
+        self.assertEqual(os.listdir(settings.FILE_UPLOAD_TEMP_DIR), [])
+
+        # If the request size is known to be too big, the request body is not even read
+        self.bytes_written = []
+        with override_settings(UPLOAD_MAX_FILE_SIZE_COMBINED=1024 * 1024, DATA_UPLOAD_MAX_MEMORY_SIZE=1024):
+            response = self.upload({'audiofile': SimpleUploadedFile('sound.wav', self.content)})
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.bytes_written, [])
+
+    @override_uploads_path_with_temp_directory
+    @override_file_upload_temp_dir_with_temp_directory
+    def test_invalid_upload_removes_file(self):
+        response = self.upload({'audiofile': SimpleUploadedFile('sound.wav', self.content), 'tags': 'tag1'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(os.path.exists(self.uploaded_file_path('sound.wav')))
+        self.assertEqual(os.listdir(settings.FILE_UPLOAD_TEMP_DIR), [])
+
+    @override_uploads_path_with_temp_directory
+    @override_upload_proxy_store_path_with_temp_directory
+    def test_upload_stored_by_proxy(self):
+        stored_path = os.path.join(settings.UPLOAD_PROXY_STORE_PATH, '0000000001')
+        with open(stored_path, 'wb') as f:
+            f.write(self.content)
+        response = self.upload({'audiofile.name': 'sound.wav', 'audiofile.path': stored_path,
+                                'audiofile.content_type': 'audio/wav', 'audiofile.md5': 'abc'})
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(os.path.exists(stored_path))
+        self.assertEqual(open(self.uploaded_file_path('sound.wav'), 'rb').read(), self.content)
+        self.assertEqual(self.bytes_written, [])
+
+        # The md5 of the stored file is computed instead of using the one in the request
+        stored_path = os.path.join(settings.UPLOAD_PROXY_STORE_PATH, '0000000002')
+        with open(stored_path, 'wb') as f:
+            f.write(self.content)
+        with mock.patch('apiv2.views.utils.sound_upload.create_sound') as create_sound:
+            create_sound.return_value = mock.Mock(id=1)
+            response = self.upload({'audiofile.name': 'sound3.wav', 'audiofile.path': stored_path,
+                                    'audiofile.md5': 'abc', 'tags': 'tag1 tag2 tag3', 'description': 'Description',
+                                    'license': 'Attribution'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(create_sound.call_args[0][1]['md5'], hashlib.md5(self.content).hexdigest())
+
+        # Files outside of the proxy store directory are ignored
+        response = self.upload({'audiofile.name': 'sound2.wav', 'audiofile.path': self.uploaded_file_path('sound.wav')})
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(os.path.exists(self.uploaded_file_path('sound.wav')))
@@ -23,10 +23,59 @@
 from rest_framework.throttling import SimpleRateThrottle
 from exceptions import Throttled
 from django.conf import settings
+from utils.encryption import create_hash
 import apiv2_utils
 
 
-class ClientBasedThrottlingBurst(SimpleRateThrottle):
+def increment_counter(cache, key, timeout, delta=1):
+    """
+    Atomically increments the counter stored in the cache with the given key by delta and returns its new value. If
+    the counter does not exist it is created with the given timeout. In the usual case (counter exists) this only
+    needs one cache round trip.
+    """
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Counter does not exist yet, create it (if another request created it in the meantime, add will fail and
+        # we can safely increment it)
+        if cache.add(key, delta, timeout):
+            return delta
+        return cache.incr(key, delta)
+
+
+class CounterBasedRateThrottle(SimpleRateThrottle):
+    """
+    Version of SimpleRateThrottle which counts requests in fixed time windows of 'duration' seconds using atomic
+    cache counters instead of storing a list with the timestamps of all requests in the cache. This avoids reading
+    and writing long lists for sustained rates (e.g. thousands of requests per day) and does not lose updates when
+    concurrent requests are made.
+    Views can define a 'throttling_cost' attribute to make each of their requests count as several requests.
+    """
+
+    def get_window_cache_key(self, key):
+        return '%s_%i' % (key, int(self.now // self.duration))
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.now = self.timer()
+        num_requests_in_window = increment_counter(self.cache, self.get_window_cache_key(self.key), self.duration,
+                                                   delta=getattr(view, 'throttling_cost', 1))
+        return num_requests_in_window <= self.num_requests
+
+    def wait(self):
+        """
+        Returns the recommended next request time in seconds (the remaining time of the current window).
+        """
+        return self.duration - self.now % self.duration
+
+
+class ClientBasedThrottlingBurst(CounterBasedRateThrottle):
     """
     This throttling class applies different throttling rates depending on the access level of the API client.
     Each access level is defined with a burst limit and a sustained limit. This class checks the burst limit.
@@ -86,7 +135,7 @@ class ClientBasedThrottlingBurst(SimpleRateThrottle):
             }
 
 
-class ClientBasedThrottlingSustained(SimpleRateThrottle):
+class ClientBasedThrottlingSustained(CounterBasedRateThrottle):
     """
     This throttling class applies different throttling rates depending on the access level of the API client.
     Each access level is defined with a burst limit and a sustained limit. This class checks the sustained limit.
@@ -146,7 +195,7 @@ class ClientBasedThrottlingSustained(SimpleRateThrottle):
             }
 
 
-class IpBasedThrottling(SimpleRateThrottle):
+class IpBasedThrottling(CounterBasedRateThrottle):
     """
     This throttling class applies different ip-based throttling rates depending on the access level of the API client.
     Depending on the client level, a maximum number of connections from different ips are allowed for a given time period.
@@ -201,22 +250,20 @@ class IpBasedThrottling(SimpleRateThrottle):
             if self.key is None:
                 return True
 
-            self.history = self.cache.get(self.key, [])
+            # Each ip is counted once per time window. A per-ip key tells whether the ip already made requests in
+            # the current window, and the window counter holds the number of different ips seen.
             self.now = self.timer()
-
-            # Drop any requests from the history which have now passed the
-            # throttle duration
-            while self.history and self.history[-1][0] <= self.now - self.duration:
-                self.history.pop()
-            self.ip_in_history = self.ip in [history_ip for history_now, history_ip in self.history]
+            window_key = self.get_window_cache_key(self.key)
+            ip_key = '%s_%s' % (window_key, create_hash(self.ip, add_secret=False, limit=32))
+            self.ip_in_history = not self.cache.add(ip_key, 1, self.duration)
 
             if self.ip_in_history:
                 return True
             else:
-                if len(self.history) >= self.num_requests:
-                    passes_throttle = self.throttle_failure()
-                else:
-                    passes_throttle = self.throttle_success()
+                passes_throttle = increment_counter(self.cache, window_key, self.duration) <= self.num_requests
+                if not passes_throttle:
+                    # Forget the ip so further requests from it in this window are throttled as well
+                    self.cache.delete(ip_key)
 
             if not passes_throttle:
                 msg = "Request was throttled because of exceeding the concurrent ip limit rate (%s)" % rate
@@ -226,15 +273,6 @@ class IpBasedThrottling(SimpleRateThrottle):
                 raise Throttled(msg=msg, request=request)
         return True
 
-    def throttle_success(self):
-        """
-        Inserts the current request's timestamp and request along with the key
-        into the cache if the ip is not already in the list.
-        """
-        self.history.insert(0, [self.now, self.ip])
-        self.cache.set(self.key, self.history, self.duration)
-        return True
-
     def get_cache_key(self, request, view):
         if self.client:
             return self.cache_format % {
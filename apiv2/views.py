@@ -33,6 +33,7 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.db import IntegrityError
+from django.db.models import Count, Max, Sum
 from django.http import HttpResponseRedirect, Http404
 from django.shortcuts import render
 from django.urls import reverse
@@ -46,6 +47,7 @@ from rest_framework.response import Response
 import utils.sound_upload
 from accounts.views import handle_uploaded_file
 from apiv2.authentication import OAuth2Authentication, TokenAuthentication, SessionAuthentication
+from apiv2.combined_search_strategies import limit_concurrency_parameters
 from apiv2.exceptions import NotFoundException, InvalidUrlException, BadRequestException, ConflictException, \
     UnauthorizedException, ServerErrorException, OtherException, APIException
 from apiv2.forms import ApiV2ClientForm, SoundCombinedSearchFormAPI, SoundTextSearchFormAPI, \
@@ -54,7 +56,7 @@ from apiv2.models import ApiV2Client
 from apiv2.serializers import SimilarityFileSerializer, UploadAndDescribeAudioFileSerializer, \
     EditSoundDescriptionSerializer, SoundDescriptionSerializer, CreateCommentSerializer, SoundCommentsSerializer, \
     CreateRatingSerializer, CreateBookmarkSerializer, BookmarkCategorySerializer, PackSerializer, UserSerializer, \
-    SoundSerializer, SoundListSerializer
+    SoundSerializer, SoundListSerializer, SoundBulkInstanceSerializer
 from apiv2_utils import GenericAPIView, ListAPIView, RetrieveAPIView, WriteRequiredGenericAPIView, \
     OauthRequiredAPIView, DownloadAPIView, get_analysis_data_for_queryset_or_sound_ids, api_search, \
     ApiSearchPaginator, get_sounds_descriptors, prepend_base, get_formatted_examples_for_view
@@ -68,10 +70,20 @@ from utils.downloads import download_sounds
 from utils.filesystem import generate_tree
 from utils.nginxsendfile import sendfile, prepare_sendfile_arguments_for_sound_download
 from utils.tags import clean_and_split_tags
+from utils.upload_handlers import StreamingFileUploadHandler, StreamedUploadedFile, get_file_uploaded_by_proxy
 
 api_logger = logging.getLogger("api")
 resources_doc_filename = 'resources_apiv2.html'
 
+# Fields of the Sound model used to compute the ETag of sound resources. These change whenever the serialized sound
+# changes (see Sound.modified)
+SOUND_VERSION_FIELDS = ('modified', 'moderation_state', 'processing_state', 'analysis_state', 'similarity_state',
+                        'num_comments', 'num_ratings', 'avg_rating', 'num_downloads', 'user__username')
+
+# Fields of the User model (and its profile) used to compute the ETag of user resources
+USER_VERSION_FIELDS = ('username', 'date_joined', 'profile__about', 'profile__home_page', 'profile__has_avatar',
+                       'profile__num_sounds', 'profile__num_posts')
+
 
 class AuthorizationView(ProviderAuthorizationView):
     login_url = '/apiv2/login/'
@@ -293,6 +305,8 @@ class CombinedSearch(GenericAPIView):
         for key, value in request.query_params.items():
             if key.startswith('cs_'):
                 extra_parameters[key] = int(value)
+        # Clients can not raise the concurrency limits (clamped values are also the ones included in next page urls)
+        limit_concurrency_parameters(extra_parameters)
 
         analysis_file = None
         if self.analysis_file:
@@ -397,9 +411,59 @@ class SoundInstance(RetrieveAPIView):
 
     def get(self, request,  *args, **kwargs):
         api_logger.info(self.log_message('sound:%i instance' % (int(kwargs['pk']))))
+        versions = self.get_queryset().filter(id=kwargs['pk']).values_list(*SOUND_VERSION_FIELDS).first()
+        if versions is not None:
+            not_modified_response = self.get_not_modified_response(request, versions)
+            if not_modified_response is not None:
+                return not_modified_response
         return super(SoundInstance, self).get(request, *args, **kwargs)
 
 
+class SoundBulkInstance(GenericAPIView):
+
+    @classmethod
+    def get_description(cls):
+        return 'Detailed information of several sounds at once.' \
+               '<br>Full documentation can be found <a href="%s/%s" target="_blank">here</a>. %s' \
+               % (prepend_base('/docs/api'), '%s#sound-bulk-instance' % resources_doc_filename,
+                  get_formatted_examples_for_view('SoundBulkInstance', 'apiv2-sound-bulk-instance', max=5))
+
+    throttling_cost = settings.APIV2_SOUND_BULK_INSTANCE_THROTTLING_COST
+
+    def get(self, request,  *args, **kwargs):
+        try:
+            ids = [int(sid) for sid in request.query_params.get('ids', '').split(',') if sid.strip()]
+        except ValueError:
+            raise BadRequestException(msg='Invalid sound ids (should be a comma separated list of numbers).',
+                                      resource=self)
+        if not ids:
+            raise BadRequestException(msg='At least one sound id should be included in the \'ids\' request '
+                                          'parameter.', resource=self)
+        if len(ids) > settings.APIV2_SOUND_BULK_INSTANCE_MAX_IDS:
+            raise BadRequestException(msg='Too many sound ids (a maximum of %i sounds can be requested at once).'
+                                          % settings.APIV2_SOUND_BULK_INSTANCE_MAX_IDS, resource=self)
+        api_logger.info(self.log_message('sounds:%s bulk instance' % ','.join([str(sid) for sid in ids])))
+
+        # Get all sounds with a single query and analysis data with a single request to the similarity service
+        sounds_dict = {sound.id: sound for sound in Sound.objects.bulk_query_id(list(set(ids)))
+                       if sound.moderation_state == 'OK' and sound.processing_state == 'OK'}
+        get_analysis_data_for_queryset_or_sound_ids(self, sound_ids=[sid for sid in sounds_dict],
+                                                    all_fields_by_default=True)
+
+        # Serialize sounds in the requested order. Sounds which do not exist (or are not public) are set to null and
+        # listed in 'not_found'.
+        results = []
+        not_found = []
+        for sid in ids:
+            if sid in sounds_dict:
+                results.append(SoundBulkInstanceSerializer(
+                    sounds_dict[sid], context=self.get_serializer_context()).data)
+            else:
+                results.append(None)
+                not_found.append(sid)
+        return Response({'results': results, 'not_found': not_found}, status=status.HTTP_200_OK)
+
+
 class SoundAnalysis(GenericAPIView):
 
     @classmethod
@@ -415,6 +479,12 @@ class SoundAnalysis(GenericAPIView):
         if request.query_params.get('descriptors', False):
             descriptors = request.query_params['descriptors'].split(',')
         api_logger.info(self.log_message('sound:%i analysis' % (int(sound_id))))
+        versions = Sound.objects.filter(id=sound_id)\
+            .values_list('analysis_state', 'similarity_state', 'processing_date').first()
+        if versions is not None:
+            not_modified_response = self.get_not_modified_response(request, versions)
+            if not_modified_response is not None:
+                return not_modified_response
         response_data = get_sounds_descriptors([sound_id],
                                                 descriptors,
                                                 request.query_params.get('normalized', '0') == '1',
@@ -494,6 +564,7 @@ class SimilarSounds(GenericAPIView):
 
 class SoundComments(ListAPIView):
     serializer_class = SoundCommentsSerializer
+    cursor_pagination = True
 
     @classmethod
     def get_description(cls):
@@ -504,6 +575,10 @@ class SoundComments(ListAPIView):
 
     def get(self, request,  *args, **kwargs):
         api_logger.info(self.log_message('sound:%i comments' % (int(self.kwargs['pk']))))
+        not_modified_response = self.get_not_modified_list_response(
+            request, self.get_queryset(), Count('id'), Max('created'))
+        if not_modified_response is not None:
+            return not_modified_response
         return super(SoundComments, self).get(request, *args, **kwargs)
 
     def get_queryset(self):
@@ -577,12 +652,22 @@ class UserInstance(RetrieveAPIView):
 
     def get(self, request,  *args, **kwargs):
         api_logger.info(self.log_message('user:%s instance' % (self.kwargs['username'])))
+        versions = self.get_queryset().filter(username=self.kwargs['username']).values_list(
+            *USER_VERSION_FIELDS).first()
+        if versions is not None:
+            # Numbers of packs and comments are not stored, but counting them is cheaper than serializing the user
+            versions += (Pack.objects.filter(user__username=self.kwargs['username']).count(),
+                         Comment.objects.filter(user__username=self.kwargs['username']).count())
+            not_modified_response = self.get_not_modified_response(request, versions)
+            if not_modified_response is not None:
+                return not_modified_response
         return super(UserInstance, self).get(request, *args, **kwargs)
 
 
 class UserSounds(ListAPIView):
     lookup_field = "username"
     serializer_class = SoundListSerializer
+    cursor_pagination = True
 
     @classmethod
     def get_description(cls):
@@ -593,6 +678,12 @@ class UserSounds(ListAPIView):
 
     def get(self, request,  *args, **kwargs):
         api_logger.info(self.log_message('user:%s sounds' % (self.kwargs['username'])))
+        not_modified_response = self.get_not_modified_list_response(
+            request, Sound.objects.filter(moderation_state="OK", processing_state="OK", user__is_active=True,
+                                          user__username=self.kwargs['username']),
+            Count('id'), Max('modified'), Sum('num_downloads'))
+        if not_modified_response is not None:
+            return not_modified_response
         return super(UserSounds, self).get(request, *args, **kwargs)
 
     def get_queryset(self):
@@ -610,6 +701,7 @@ class UserSounds(ListAPIView):
 class UserPacks(ListAPIView):
     serializer_class = PackSerializer
     queryset = Pack.objects.exclude(is_deleted=True)
+    cursor_pagination = True
 
     @classmethod
     def get_description(cls):
@@ -620,6 +712,14 @@ class UserPacks(ListAPIView):
 
     def get(self, request,  *args, **kwargs):
         api_logger.info(self.log_message('user:%s packs' % (self.kwargs['username'])))
+        if not self.paginator.is_cursor_request(request, self):
+            # Packs have no modification date, but users have few packs so the serialized fields are used as versions
+            versions = tuple(Pack.objects.filter(user__username=self.kwargs['username'], user__is_active=True)
+                             .exclude(is_deleted=True).order_by('id')
+                             .values_list('id', 'name', 'description', 'num_sounds', 'num_downloads'))
+            not_modified_response = self.get_not_modified_response(request, versions)
+            if not_modified_response is not None:
+                return not_modified_response
         return super(UserPacks, self).get(request, *args, **kwargs)
 
     def get_queryset(self):
@@ -645,6 +745,16 @@ class UserBookmarkCategories(ListAPIView):
 
     def get(self, request,  *args, **kwargs):
         api_logger.info(self.log_message('user:%s bookmark_categories' % (self.kwargs['username'])))
+        if User.objects.filter(username=self.kwargs['username'], is_active=True).exists():
+            # Versions are the (few) categories of the user and aggregates of the bookmarks (counted in categories)
+            categories = tuple(BookmarkCategory.objects.filter(user__username=self.kwargs['username'])
+                               .order_by('id').values_list('id', 'name'))
+            bookmarks = Bookmark.objects.filter(user__username=self.kwargs['username']).aggregate(
+                Count('id'), Max('created'), Max('sound__modified'))
+            not_modified_response = self.get_not_modified_response(
+                request, (categories, tuple(sorted(bookmarks.items()))))
+            if not_modified_response is not None:
+                return not_modified_response
         return super(UserBookmarkCategories, self).get(request, *args, **kwargs)
 
     def get_queryset(self):
@@ -664,6 +774,7 @@ class UserBookmarkCategories(ListAPIView):
 
 class UserBookmarkCategorySounds(ListAPIView):
     serializer_class = SoundListSerializer
+    cursor_pagination = True
 
     @classmethod
     def get_description(cls):
@@ -676,10 +787,14 @@ class UserBookmarkCategorySounds(ListAPIView):
     def get(self, request,  *args, **kwargs):
         api_logger.info(self.log_message('user:%s sounds_for_bookmark_category:%s'
                                      % (self.kwargs['username'], str(self.kwargs.get('category_id', None)))))
+        not_modified_response = self.get_not_modified_list_response(
+            request, Bookmark.objects.filter(**self.get_bookmarks_filter()),
+            Count('id'), Max('created'), Max('sound__modified'), Sum('sound__num_downloads'))
+        if not_modified_response is not None:
+            return not_modified_response
         return super(UserBookmarkCategorySounds, self).get(request, *args, **kwargs)
 
-    def get_queryset(self):
-
+    def get_bookmarks_filter(self):
         kwargs = dict()
         kwargs['user__username'] = self.kwargs['username']
 
@@ -690,13 +805,21 @@ class UserBookmarkCategorySounds(ListAPIView):
                 kwargs['category'] = None
         else:
             kwargs['category'] = None
-        try:
-            queryset = [bookmark.sound for bookmark in Bookmark.objects.select_related('sound').filter(**kwargs)]
-        except:
-            raise NotFoundException(resource=self)
+        return kwargs
+
+    def get_queryset(self):
+        # Bookmarks are paginated and then replaced by the bookmarked sounds (see paginate_queryset below)
+        queryset = Bookmark.objects.select_related('sound', 'sound__user', 'sound__pack', 'sound__license')\
+            .filter(**self.get_bookmarks_filter())
         get_analysis_data_for_queryset_or_sound_ids(self, queryset=queryset)
         return queryset
 
+    def paginate_queryset(self, queryset):
+        page = super(UserBookmarkCategorySounds, self).paginate_queryset(queryset)
+        if page is None:
+            return None
+        return [bookmark.sound for bookmark in page]
+
 
 ############
 # PACK VIEWS
@@ -715,11 +838,18 @@ class PackInstance(RetrieveAPIView):
 
     def get(self, request,  *args, **kwargs):
         api_logger.info(self.log_message('pack:%i instance' % (int(kwargs['pk']))))
+        versions = self.get_queryset().filter(id=kwargs['pk']).values_list(
+            'name', 'description', 'num_sounds', 'num_downloads', 'user__username').first()
+        if versions is not None:
+            not_modified_response = self.get_not_modified_response(request, versions)
+            if not_modified_response is not None:
+                return not_modified_response
         return super(PackInstance, self).get(request, *args, **kwargs)
 
 
 class PackSounds(ListAPIView):
     serializer_class = SoundListSerializer
+    cursor_pagination = True
 
     @classmethod
     def get_description(cls):
@@ -730,6 +860,12 @@ class PackSounds(ListAPIView):
 
     def get(self, request,  *args, **kwargs):
         api_logger.info(self.log_message('pack:%i sounds' % (int(kwargs['pk']))))
+        not_modified_response = self.get_not_modified_list_response(
+            request, Sound.objects.filter(moderation_state="OK", processing_state="OK", pack__is_deleted=False,
+                                          pack__id=self.kwargs['pk']),
+            Count('id'), Max('modified'), Sum('num_downloads'))
+        if not_modified_response is not None:
+            return not_modified_response
         return super(PackSounds, self).get(request, *args, **kwargs)
 
     def get_queryset(self):
@@ -787,14 +923,47 @@ class UploadSound(WriteRequiredGenericAPIView):
                % (prepend_base('/docs/api'), '%s#upload-sound-oauth2-required' % resources_doc_filename,
                   get_formatted_examples_for_view('UploadSound', 'apiv2-uploads-upload', max=5))
 
+    def initialize_request(self, request, *args, **kwargs):
+        # Set the upload handler before anything reads the request body (authentication and CSRF checks do), so that
+        # uploaded files are streamed to disk only once
+        self.upload_handler = StreamingFileUploadHandler(
+            max_file_size=settings.UPLOAD_MAX_FILE_SIZE_COMBINED, request=request)
+        request.upload_handlers = [self.upload_handler]
+        return super(UploadSound, self).initialize_request(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        # Reject uploads which are too big before reading the request body (the size of non-file fields is limited by
+        # DATA_UPLOAD_MAX_MEMORY_SIZE)
+        if int(request.META.get('CONTENT_LENGTH') or 0) > \
+                settings.UPLOAD_MAX_FILE_SIZE_COMBINED + settings.DATA_UPLOAD_MAX_MEMORY_SIZE:
+            raise OtherException(self.get_file_too_big_message(), status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        super(UploadSound, self).initial(request, *args, **kwargs)
+
+    @staticmethod
+    def get_file_too_big_message():
+        return 'Uploaded file is too big (the maximum file size is %i Bytes).' % settings.UPLOAD_MAX_FILE_SIZE_COMBINED
+
     def post(self, request,  *args, **kwargs):
         api_logger.info(self.log_message('upload_sound'))
-        serializer = UploadAndDescribeAudioFileSerializer(data=request.data)
+
+        data = request.data
+        if self.upload_handler.file_too_big:
+            raise OtherException(self.get_file_too_big_message(), status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                 resource=self)
+        proxy_audiofile = get_file_uploaded_by_proxy(data, 'audiofile')
+        if proxy_audiofile is not None:
+            data = data.copy()
+            data['audiofile'] = proxy_audiofile
+
+        serializer = UploadAndDescribeAudioFileSerializer(data=data)
         is_providing_description = serializer.is_providing_description(serializer.initial_data)
         if serializer.is_valid():
-            audiofile = request.FILES['audiofile']
+            audiofile = serializer.validated_data['audiofile']
             try:
-                handle_uploaded_file(self.user.id, audiofile)
+                if isinstance(audiofile, StreamedUploadedFile):
+                    audiofile.move_to_uploads_directory(self.user.id)
+                else:
+                    handle_uploaded_file(self.user.id, audiofile)
             except:
                 raise ServerErrorException(resource=self)
 
@@ -820,6 +989,7 @@ class UploadSound(WriteRequiredGenericAPIView):
                         sound_fields = {}
                         for key, item in serializer.data.items():
                             sound_fields[key] = item
+                        sound_fields['md5'] = getattr(audiofile, 'md5', None)
 
                         filename = sound_fields.get('upload_filename', audiofile.name)
                         if not 'name' in sound_fields:
@@ -1263,6 +1433,8 @@ class FreesoundApiV2Resources(GenericAPIView):
                     '11 Pending uploads': prepend_base(reverse('apiv2-uploads-pending')),
                     '12 Edit sound description': prepend_base(
                         reverse('apiv2-sound-edit', args=[0]).replace('0', '<sound_id>')),
+                    '13 Sound bulk instance': prepend_base(
+                        reverse('apiv2-sound-bulk-instance'), request_is_secure=request.is_secure()),
                 }).items(), key=lambda t: t[0]))},
                 {'User resources': OrderedDict(sorted(dict({
                     '01 User instance': prepend_base(
@@ -46,3 +46,7 @@ class Bookmark(models.Model):
     
     class Meta:
         ordering = ("-created", )
+        indexes = [
+            # Used for keyset pagination of bookmarked sounds in the API
+            models.Index(fields=['user', 'category', 'created', 'id']),
+        ]
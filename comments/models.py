@@ -39,6 +39,10 @@ class Comment(models.Model):
 
     class Meta:
         ordering = ('-created', )
+        indexes = [
+            # Used for keyset pagination of sound comments in the API
+            models.Index(fields=['sound', 'created', 'id']),
+        ]
 
 
 def on_delete_comment(sender, instance, **kwargs):
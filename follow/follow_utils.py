@@ -20,16 +20,20 @@
 #     See AUTHORS file.
 #
 
-from follow.models import FollowingUserItem, FollowingQueryItem
+from follow.models import FollowingUserItem, FollowingQueryItem, get_following_user_ids_cache_key, \
+    get_follower_user_ids_cache_key, get_following_tags_cache_key
 import sounds
 from search.views import search_prepare_query, search_prepare_sort
 from django.conf import settings
-from utils.search.solr import Solr, SolrResponseInterpreter
+from django.core.cache import cache
+from utils.search.solr import Solr
 from search.forms import SEARCH_SORT_OPTIONS_WEB
 # from utils.search.solr import Solr, SolrQuery, SolrException, SolrResponseInterpreter, SolrResponseInterpreterPaginator
 import urllib
+from collections import OrderedDict
 
 SOLR_QUERY_LIMIT_PARAM = 3
+SOLR_GROUP_QUERIES_PER_REQUEST = 50
 
 
 def get_users_following(user):
@@ -47,18 +51,49 @@ def get_tags_following(user):
     return [item.query for item in items]
 
 
+def _get_cached_set(cache_key, get_values):
+    values = cache.get(cache_key)
+    if values is None:
+        values = frozenset(get_values())
+        cache.set(cache_key, values, settings.FOLLOW_CACHE_TIME)
+    return values
+
+
+def get_following_user_ids(user):
+    """Returns the set of ids of the users followed by the given user (cached until the user follows/unfollows)"""
+    return _get_cached_set(get_following_user_ids_cache_key(user.id), lambda: FollowingUserItem.objects.filter(
+        user_from_id=user.id).values_list('user_to_id', flat=True))
+
+
+def get_follower_user_ids(user):
+    """Returns the set of ids of the users who follow the given user (cached until they follow/unfollow)"""
+    return _get_cached_set(get_follower_user_ids_cache_key(user.id), lambda: FollowingUserItem.objects.filter(
+        user_to_id=user.id).values_list('user_from_id', flat=True))
+
+
+def get_following_tag_queries(user):
+    """Returns the set of tag queries (tags separated by spaces) followed by the given user (cached until the user
+    follows/unfollows tags)"""
+    return _get_cached_set(get_following_tags_cache_key(user.id), lambda: FollowingQueryItem.objects.filter(
+        user_id=user.id).values_list('query', flat=True))
+
+
 def is_user_following_user(user_from, user_to):
-    return user_to in get_users_following(user=user_from)
+    return user_to.id in get_following_user_ids(user_from)
 
 
 def is_user_following_tag(user, slash_tag):
-    tags_following = get_tags_following(user)
     space_tag = slash_tag.replace("/", " ")
-    return space_tag in tags_following
+    return space_tag in get_following_tag_queries(user)
 
 
 def is_user_being_followed_by_user(user_from, user_to):
-    return user_to in get_users_followers(user_from)
+    return user_to.id in get_follower_user_ids(user_from)
+
+
+def get_following_tags_display_data(space_tags):
+    """Returns a list of (space_tags, slash_tags, split_tags) tuples for the given tag queries"""
+    return [(tags, tags.replace(" ", "/"), tags.split(" ")) for tags in space_tags]
 
 
 def get_vars_for_account_view(user):
@@ -71,121 +106,115 @@ def get_vars_for_home_view(user):
 
 def get_vars_for_views_helper(user, clip):
 
-    following = get_users_following(user)
-    followers = get_users_followers(user)
-    following_tags = get_tags_following(user)
+    following_count = len(get_following_user_ids(user))
+    followers_count = len(get_follower_user_ids(user))
+    following_tags_count = len(get_following_tag_queries(user))
 
-    following_count = len(following)
-    followers_count = len(followers)
-    following_tags_count = len(following_tags)
+    following_items = FollowingUserItem.objects.select_related('user_to__profile').filter(user_from=user)
+    follower_items = FollowingUserItem.objects.select_related('user_from__profile').filter(user_to=user)
+    following_tags_items = FollowingQueryItem.objects.filter(user=user)
 
     # show only the first 21 (3 rows) followers and following users and 5 following tags
     if clip:
-        following = following[:21]
-        followers = followers[:21]
-        following_tags = following_tags[:5]
-
-    space_tags = following_tags
-    split_tags = [tag.split(" ") for tag in space_tags]
-    slash_tags = [tag.replace(" ", "/") for tag in space_tags]
+        following_items = following_items[:21]
+        follower_items = follower_items[:21]
+        following_tags_items = following_tags_items[:5]
 
-    following_tags = []
-    for i in range(len(space_tags)):
-        following_tags.append((space_tags[i], slash_tags[i], split_tags[i]))
+    following = [item.user_to for item in following_items]
+    followers = [item.user_from for item in follower_items]
+    following_tags = get_following_tags_display_data([item.query for item in following_tags_items])
 
     return following, followers, following_tags, following_count, followers_count, following_tags_count
 
 
 def get_stream_sounds(user, time_lapse):
-
-    solr = Solr(settings.SOLR_URL)
+    """
+    Returns the sounds uploaded in time_lapse by the users and with the tags followed by the given user. Each followed
+    user and tag query is a group.query of a grouped Solr request (so Solr returns the SOLR_QUERY_LIMIT_PARAM latest
+    sounds and the total number of sounds of every group in one response, queries are sent in batches of
+    SOLR_GROUP_QUERIES_PER_REQUEST to keep URLs short). The Sound objects of all groups are then retrieved with a
+    single DB query.
+    """
 
     sort_str = search_prepare_sort("created desc", SEARCH_SORT_OPTIONS_WEB)
 
-    #
-    # USERS FOLLOWING
-    #
-
     users_following = get_users_following(user)
+    users_group_queries = ["username:" + user_following.username for user_following in users_following]
 
-    users_sounds = []
-    for user_following in users_following:
+    tags_following = [tag_following.split(" ") for tag_following in get_tags_following(user)]
+    tags_group_queries = [" ".join(["tag:" + tag for tag in tags]) for tags in tags_following]
 
-        filter_str = "username:" + user_following.username + " created:" + time_lapse
+    groups = get_stream_groups(users_group_queries + tags_group_queries, time_lapse, sort_str)
 
-        query = search_prepare_query(
-            "",
-            filter_str,
-            sort_str,
-            1,
-            SOLR_QUERY_LIMIT_PARAM,
-            grouping=False,
-            include_facets=False
-        )
-
-        result = SolrResponseInterpreter(solr.select(unicode(query)))
-
-        if result.num_rows != 0:
-
-            more_count = max(0, result.num_found - SOLR_QUERY_LIMIT_PARAM)
+    sound_ids = [sound_id for sound_ids, num_found in groups.values() for sound_id in sound_ids]
+    sound_objs_by_id = sounds.models.Sound.objects.select_related('license', 'user').in_bulk(sound_ids)
 
-            # the sorting only works if done like this!
-            more_url_params = [urllib.quote(filter_str), urllib.quote(sort_str[0])]
+    def build_stream_item(group_query, filter_str):
+        sound_ids, num_found = groups.get(group_query, ([], 0))
+        if not sound_ids:
+            return None
+        more_count = max(0, num_found - SOLR_QUERY_LIMIT_PARAM)
+        # the sorting only works if done like this!
+        more_url_params = [urllib.quote(filter_str), urllib.quote(sort_str[0])]
+        sound_objs = [sound_objs_by_id[sound_id] for sound_id in sound_ids if sound_id in sound_objs_by_id]
+        new_count = more_count + len(sound_ids)
+        return sound_objs, more_url_params, more_count, new_count
 
-            # this is the same link but for the email has to be "quoted"
-            more_url = u"?f=" + filter_str + u"&s=" + sort_str[0]
-            # more_url_quoted = urllib.quote(more_url)
+    #
+    # USERS FOLLOWING
+    #
 
-            sound_ids = [element['id'] for element in result.docs]
-            sound_objs = sounds.models.Sound.objects.filter(id__in=sound_ids).select_related('license', 'user')
-            new_count = more_count + len(sound_ids)
-            users_sounds.append(((user_following, False), sound_objs, more_url_params, more_count, new_count))
+    users_sounds = []
+    for user_following, group_query in zip(users_following, users_group_queries):
+        item = build_stream_item(group_query, group_query + " created:" + time_lapse)
+        if item is not None:
+            users_sounds.append(((user_following, False),) + item)
 
     #
     # TAGS FOLLOWING
     #
 
-    tags_following = get_tags_following(user)
-
     tags_sounds = []
-    for tag_following in tags_following:
+    for tags, group_query in zip(tags_following, tags_group_queries):
+        item = build_stream_item(group_query, group_query + " created:" + time_lapse)
+        if item is not None:
+            tags_sounds.append((tags,) + item)
+
+    return users_sounds, tags_sounds
 
-        tags = tag_following.split(" ")
-        tag_filter_query = ""
-        for tag in tags:
-            tag_filter_query += "tag:" + tag + " "
 
-        tag_filter_str = tag_filter_query + " created:" + time_lapse
+def get_stream_groups(group_queries, time_lapse, sort_str):
+    """
+    Returns a dictionary with the ids of the latest SOLR_QUERY_LIMIT_PARAM sounds uploaded in time_lapse and the
+    total number of sounds found for each of the given Solr group queries.
+    """
+    solr = Solr(settings.SOLR_URL)
+    unique_group_queries = list(OrderedDict.fromkeys(group_queries))
 
+    groups = dict()
+    for i in range(0, len(unique_group_queries), SOLR_GROUP_QUERIES_PER_REQUEST):
+        batch_group_queries = unique_group_queries[i:i + SOLR_GROUP_QUERIES_PER_REQUEST]
         query = search_prepare_query(
             "",
-            tag_filter_str,
+            "created:" + time_lapse,
             sort_str,
             1,
             SOLR_QUERY_LIMIT_PARAM,
             grouping=False,
             include_facets=False
         )
-
-        result = SolrResponseInterpreter(solr.select(unicode(query)))
-
-        if result.num_rows != 0:
-
-            more_count = max(0, result.num_found - SOLR_QUERY_LIMIT_PARAM)
-
-            # the sorting only works if done like this!
-            more_url_params = [urllib.quote(tag_filter_str), urllib.quote(sort_str[0])]
-
-            # this is the same link but for the email has to be "quoted"
-            more_url = u"?f=" + tag_filter_str + u"&s=" + sort_str[0]
-            # more_url_quoted = urllib.quote(more_url)
-
-            sound_ids = [element['id'] for element in result.docs]
-            sound_objs = sounds.models.Sound.objects.filter(id__in=sound_ids)
-            new_count = more_count + len(sound_ids)
-            tags_sounds.append((tags, sound_objs, more_url_params, more_count, new_count))
-
-    return users_sounds, tags_sounds
+        query.set_group_options(
+            group_query=batch_group_queries,
+            group_limit=SOLR_QUERY_LIMIT_PARAM,
+            group_sort=sort_str[0],
+            group_num_groups=False)
+
+        response = solr.select(unicode(query))
+        for group_query in batch_group_queries:
+            doclist = response['grouped'][group_query]['doclist']
+            groups[group_query] = ([int(element['id']) for element in doclist['docs']], doclist['numFound'])
+
+    return groups
 
 
 def build_time_lapse(date_from, date_to):
@@ -20,9 +20,14 @@
 import datetime
 import json
 import logging
+import os
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.db import connection
 
 from accounts.models import Profile, EmailPreferenceType
 from follow import follow_utils
@@ -33,86 +38,197 @@ from utils.management_commands import LoggingBaseCommand
 commands_logger = logging.getLogger("commands")
 console_logger = logging.getLogger('console')
 
+STREAM_EMAIL_SENT = 'sent'
+STREAM_EMAIL_NO_NEWS = 'no_news'
+STREAM_EMAIL_FAILED = 'failed'
+
+
+def send_stream_email(profile_id, solr_semaphore):
+    """Builds and sends the stream email of the given profile and returns a (profile_id, status) tuple.
+
+    This is run in a pool of worker threads, Solr queries are limited by solr_semaphore.
+    """
+    try:
+        profile = Profile.objects.select_related('user').get(id=profile_id)
+        user = profile.user
+        username = user.username
+        profile.last_attempt_of_sending_stream_email = datetime.datetime.now()
+
+        # Variable names use the terminology "week" because settings.NOTIFICATION_TIMEDELTA_PERIOD defaults to a
+        # week, but a more generic terminology could be used
+        week_first_day = profile.last_stream_email_sent
+        week_last_day = datetime.datetime.now()
+
+        week_first_day_str = week_first_day.strftime("%d %b").lstrip("0")
+        week_last_day_str = week_last_day.strftime("%d %b").lstrip("0")
+
+        extra_email_subject = unicode(week_first_day_str) + u' to ' + unicode(week_last_day_str)
+
+        # Set date range from which to get upload notifications
+        time_lapse = follow_utils.build_time_lapse(week_first_day, week_last_day)
+
+        # construct message
+        try:
+            with solr_semaphore:
+                users_sounds, tags_sounds = follow_utils.get_stream_sounds(user, time_lapse)
+        except Exception as e:
+            # If error occur do not send the email
+            console_logger.info("could not get new sounds data for {0}".format(username))
+            profile.save()  # Save last_attempt_of_sending_stream_email
+            return profile_id, STREAM_EMAIL_FAILED
+
+        if not users_sounds and not tags_sounds:
+            console_logger.info("no news sounds for {0}".format(username))
+            profile.save()  # Save last_attempt_of_sending_stream_email
+            return profile_id, STREAM_EMAIL_NO_NEWS
+
+        tvars = {'username': username,
+                 'users_sounds': users_sounds,
+                 'tags_sounds': tags_sounds}
+        text_content = render_mail_template('follow/email_stream.txt', tvars)
+
+        # Send email
+        try:
+            send_mail(settings.EMAIL_SUBJECT_STREAM_EMAILS, text_content,
+                      extra_subject=extra_email_subject, user_to=user)
+        except Exception as e:
+            # Do not send the email and do not update the last email sent field in the profile
+            profile.save()  # Save last_attempt_of_sending_stream_email
+            commands_logger.error("Unexpected error while sending stream notification email (%s)" % json.dumps(
+                {'email_to': profile.get_email_for_delivery(),
+                 'username': profile.user.username,
+                 'error': str(e)}))
+            return profile_id, STREAM_EMAIL_FAILED
+
+        # update last stream email sent date
+        profile.last_stream_email_sent = datetime.datetime.now()
+        profile.save()
+        return profile_id, STREAM_EMAIL_SENT
+
+    except Exception as e:
+        commands_logger.error("Unexpected error while preparing stream notification email (%s)" % json.dumps(
+            {'profile_id': profile_id, 'error': str(e)}))
+        return profile_id, STREAM_EMAIL_FAILED
+
 
 class Command(LoggingBaseCommand):
     """
     This command should be run periodically several times a day, and it will only send emails to users that "require it"
     """
     help = 'Send stream notifications to users who have not been notified for the last ' \
-           'settings.NOTIFICATION_TIMEDELTA_PERIOD period and whose stream has new sounds for that period'
+           'settings.NOTIFICATION_TIMEDELTA_PERIOD period and whose stream has new sounds for that period. ' \
+           'Emails are built and sent by a pool of worker threads (see option -j). Profiles are processed in id ' \
+           'order and the id of the last processed profile is stored in a checkpoint file so that the next run ' \
+           'continues where the previous one stopped. Profiles whose email failed are also stored in the ' \
+           'checkpoint file and retried first in the next run.'
     args = True  # For backwards compatibility mode
     # See: http://stackoverflow.com/questions/30244288/django-management-command-cannot-see-arguments
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-j', '--jobs',
+            action='store',
+            dest='jobs',
+            default=8,
+            help='Number of threads used to build and send the emails')
+
+        parser.add_argument(
+            '-s', '--solr_concurrency',
+            action='store',
+            dest='solr_concurrency',
+            default=4,
+            help='Maximum number of users whose stream is requested to Solr at the same time')
+
+        parser.add_argument(
+            '-c', '--checkpoint_file',
+            action='store',
+            dest='checkpoint_file',
+            default=os.path.join(tempfile.gettempdir(), 'send_stream_emails_checkpoint.json'),
+            help='File where to store the progress of the command so that interrupted runs can be resumed')
+
+    def load_checkpoint(self, checkpoint_file):
+        try:
+            checkpoint = json.load(open(checkpoint_file))
+        except (IOError, ValueError):
+            return 0, []
+        return checkpoint.get('last_profile_id', 0), checkpoint.get('failed_profile_ids', [])
+
+    def save_checkpoint(self, checkpoint_file, last_profile_id, failed_profile_ids):
+        tmp_checkpoint_file = checkpoint_file + '.tmp'
+        with open(tmp_checkpoint_file, 'w') as f:
+            json.dump({'last_profile_id': last_profile_id, 'failed_profile_ids': failed_profile_ids}, f)
+        os.rename(tmp_checkpoint_file, checkpoint_file)
+
     def handle(self, *args, **options):
         self.log_start()
 
+        checkpoint_file = options['checkpoint_file']
+        last_profile_id, retry_profile_ids = self.load_checkpoint(checkpoint_file)
+        if last_profile_id:
+            console_logger.info("Resuming from checkpoint, starting after profile with id %i" % last_profile_id)
+
         date_today_minus_notification_timedelta = datetime.datetime.now() - settings.NOTIFICATION_TIMEDELTA_PERIOD
 
         # Get all the users that have notifications active
         # and exclude the ones that have the last email sent for less than settings.NOTIFICATION_TIMEDELTA_PERIOD
-        # (because they have been sent an email already)
+        # (because they have been sent an email already). Profiles are processed in id order so that the
+        # checkpoint can store the last processed one. Profiles which failed in the previous run are retried first.
         email_type = EmailPreferenceType.objects.get(name="stream_emails")
         user_ids = email_type.useremailsetting_set.values_list('user_id')
-
-        users_enabled_notifications = Profile.objects.filter(user_id__in=user_ids).exclude(
-            last_stream_email_sent__gt=date_today_minus_notification_timedelta).order_by(
-            "-last_attempt_of_sending_stream_email")[:settings.MAX_EMAILS_PER_COMMAND_RUN]
-
-        n_emails_sent = 0
-        for profile in users_enabled_notifications:
-
-            username = profile.user.username
-            profile.last_attempt_of_sending_stream_email = datetime.datetime.now()
-
-            # Variable names use the terminology "week" because settings.NOTIFICATION_TIMEDELTA_PERIOD defaults to a
-            # week, but a more generic terminology could be used
-            week_first_day = profile.last_stream_email_sent
-            week_last_day = datetime.datetime.now()
-
-            week_first_day_str = week_first_day.strftime("%d %b").lstrip("0")
-            week_last_day_str = week_last_day.strftime("%d %b").lstrip("0")
-
-            extra_email_subject = unicode(week_first_day_str) + u' to ' + unicode(week_last_day_str)
-
-            # Set date range from which to get upload notifications
-            time_lapse = follow_utils.build_time_lapse(week_first_day, week_last_day)
-
-            # construct message
-            user = User.objects.get(username=username)
-            try:
-                users_sounds, tags_sounds = follow_utils.get_stream_sounds(user, time_lapse)
-            except Exception as e:
-                # If error occur do not send the email
-                console_logger.info("could not get new sounds data for {0}".format(username))
-                profile.save()  # Save last_attempt_of_sending_stream_email
-                continue
-
-            if not users_sounds and not tags_sounds:
-                console_logger.info("no news sounds for {0}".format(username))
-                profile.save()  # Save last_attempt_of_sending_stream_email
-                continue
-
-            tvars = {'username': username,
-                     'users_sounds': users_sounds,
-                     'tags_sounds': tags_sounds}
-            text_content = render_mail_template('follow/email_stream.txt', tvars)
-
-            # Send email
+        profiles = Profile.objects.filter(user_id__in=user_ids).exclude(
+            last_stream_email_sent__gt=date_today_minus_notification_timedelta).order_by("id")
+
+        retry_profile_ids = list(profiles.filter(id__in=retry_profile_ids).values_list(
+            'id', flat=True)[:settings.MAX_EMAILS_PER_COMMAND_RUN])
+        n_new_profiles = settings.MAX_EMAILS_PER_COMMAND_RUN - len(retry_profile_ids)
+        # One more profile is requested to know if this run reaches the end of the eligible profiles
+        new_profile_ids = list(profiles.filter(id__gt=last_profile_id).values_list(
+            'id', flat=True)[:n_new_profiles + 1])
+        cycle_finished = len(new_profile_ids) <= n_new_profiles
+        new_profile_ids = new_profile_ids[:n_new_profiles]
+        profile_ids = retry_profile_ids + new_profile_ids
+
+        solr_semaphore = threading.BoundedSemaphore(int(options['solr_concurrency']))
+
+        def process_profile(profile_id):
             try:
-                send_mail(settings.EMAIL_SUBJECT_STREAM_EMAILS, text_content,
-                          extra_subject=extra_email_subject, user_to=user)
-            except Exception as e:
-                # Do not send the email and do not update the last email sent field in the profile
-                profile.save()  # Save last_attempt_of_sending_stream_email
-                commands_logger.error("Unexpected error while sending stream notification email (%s)" % json.dumps(
-                    {'email_to': profile.get_email_for_delivery(),
-                     'username': profile.user.username,
-                     'error': str(e)}))
-                continue
-            n_emails_sent += 1
-
-            # update last stream email sent date
-            profile.last_stream_email_sent = datetime.datetime.now()
-            profile.save()
-
-        self.log_end({'n_users_notified': n_emails_sent})
+                return send_stream_email(profile_id, solr_semaphore)
+            finally:
+                # Every worker thread opens its own DB connection
+                connection.close()
+
+        pool = ThreadPool(int(options['jobs']))
+        counts = {STREAM_EMAIL_SENT: 0, STREAM_EMAIL_NO_NEWS: 0, STREAM_EMAIL_FAILED: 0}
+        failed_profile_ids = []
+        start_time = time.time()
+        try:
+            # Results are returned in order, so all profiles up to the checkpointed one have been processed (retried
+            # profiles have ids lower than the last checkpointed one)
+            results = pool.imap(process_profile, profile_ids)
+            for count, (profile_id, status) in enumerate(results):
+                counts[status] += 1
+                last_profile_id = max(last_profile_id, profile_id)
+                if status == STREAM_EMAIL_FAILED:
+                    failed_profile_ids.append(profile_id)
+                if (count + 1) % 50 == 0:
+                    self.save_checkpoint(checkpoint_file, last_profile_id,
+                                         failed_profile_ids + retry_profile_ids[count + 1:])
+        finally:
+            pool.terminate()
+
+        if cycle_finished:
+            # All eligible profiles have been processed, next run should start from the beginning (and will
+            # therefore also retry the failed ones)
+            if os.path.exists(checkpoint_file):
+                os.remove(checkpoint_file)
+        else:
+            self.save_checkpoint(checkpoint_file, last_profile_id, failed_profile_ids)
+
+        elapsed_time = time.time() - start_time
+        console_logger.info("Processed %i profiles in %.1f seconds (%.2f profiles per second): %i emails sent, "
+                            "%i without new sounds, %i failed"
+                            % (len(profile_ids), elapsed_time, len(profile_ids) / max(elapsed_time, 0.001),
+                               counts[STREAM_EMAIL_SENT], counts[STREAM_EMAIL_NO_NEWS], counts[STREAM_EMAIL_FAILED]))
+        self.log_end({'n_users_notified': counts[STREAM_EMAIL_SENT],
+                      'n_users_without_news': counts[STREAM_EMAIL_NO_NEWS],
+                      'n_failed': counts[STREAM_EMAIL_FAILED]})
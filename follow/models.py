@@ -21,7 +21,10 @@
 #
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
 
 class FollowingUserItem(models.Model):
@@ -49,3 +52,28 @@ class FollowingQueryItem(models.Model):
     class Meta:
         verbose_name_plural = 'Tags'
         unique_together = ("user", "query")
+
+
+def get_following_user_ids_cache_key(user_id):
+    return 'following-user-ids-%i' % user_id
+
+
+def get_follower_user_ids_cache_key(user_id):
+    return 'follower-user-ids-%i' % user_id
+
+
+def get_following_tags_cache_key(user_id):
+    return 'following-tags-%i' % user_id
+
+
+@receiver(post_save, sender=FollowingUserItem)
+@receiver(post_delete, sender=FollowingUserItem)
+def invalidate_cached_following_user_ids(sender, instance, **kwargs):
+    cache.delete_many([get_following_user_ids_cache_key(instance.user_from_id),
+                       get_follower_user_ids_cache_key(instance.user_to_id)])
+
+
+@receiver(post_save, sender=FollowingQueryItem)
+@receiver(post_delete, sender=FollowingQueryItem)
+def invalidate_cached_following_tags(sender, instance, **kwargs):
+    cache.delete(get_following_tags_cache_key(instance.user_id))
@@ -19,11 +19,23 @@
 # Authors:
 #     See AUTHORS file.
 #
-from django.test import TestCase
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from django.test.client import Client
-from accounts.models import Profile
+from accounts.models import Profile, EmailPreferenceType, UserEmailSetting
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from follow import follow_utils
+from follow.management.commands import send_stream_emails
 from follow.models import FollowingUserItem, FollowingQueryItem
+from utils.test_helpers import create_user_and_sounds
 
 
 class FollowTestCase(TestCase):
@@ -31,6 +43,7 @@ class FollowTestCase(TestCase):
     fixtures = ['users', 'follow']
 
     def setUp(self):
+        cache.clear()
         self.user = User.objects.create_user("testuser", password="testpass")
         self.client.login(username='testuser', password='testpass')
 
@@ -101,6 +114,9 @@ class FollowTestCase(TestCase):
         # Check that user is actually following the other user
         self.assertEqual(
             FollowingUserItem.objects.filter(user_from__username='testuser', user_to__username='User1').exists(), True)
+        user1 = User.objects.get(username='User1')
+        self.assertTrue(follow_utils.is_user_following_user(self.user, user1))
+        self.assertTrue(follow_utils.is_user_being_followed_by_user(user1, self.user))
 
         # Stop following unexisting user
         resp = self.client.get("/follow/unfollow_user/nouser/")
@@ -117,6 +133,9 @@ class FollowTestCase(TestCase):
         # Check that user is no longer following the other user
         self.assertEqual(
             FollowingUserItem.objects.filter(user_from__username='testuser', user_to__username='User1').exists(), False)
+        # Cached follow relations have been invalidated
+        self.assertFalse(follow_utils.is_user_following_user(self.user, user1))
+        self.assertFalse(follow_utils.is_user_being_followed_by_user(user1, self.user))
 
     def test_follow_tags(self):
         # Start following group of tags
@@ -130,6 +149,7 @@ class FollowTestCase(TestCase):
         # Check that user is actually following the tags
         self.assertEqual(
             FollowingQueryItem.objects.filter(user__username='testuser', query='field-recording another_tag').exists(), True)
+        self.assertTrue(follow_utils.is_user_following_tag(self.user, 'field-recording/another_tag'))
 
         # Stop following group of tags you do not already follow
         resp = self.client.get("/follow/unfollow_tags/a-tag/another_tag/")
@@ -142,8 +162,144 @@ class FollowTestCase(TestCase):
         # Check that user is no longer following the tags
         self.assertEqual(
             FollowingQueryItem.objects.filter(user__username='testuser', query='field-recording another_tag').exists(), False)
+        # Cached follow relations have been invalidated
+        self.assertFalse(follow_utils.is_user_following_tag(self.user, 'field-recording/another_tag'))
 
     def test_stream(self):
         # Stream should return OK
         resp = self.client.get("/home/stream/")
         self.assertEqual(resp.status_code, 200)
+
+
+class StreamSoundsTestCase(TestCase):
+
+    fixtures = ['licenses']
+
+    def setUp(self):
+        self.user = User.objects.create_user("testuser", password="testpass")
+        self.followed_user, _, self.sounds = create_user_and_sounds(
+            num_sounds=4, user=User.objects.create_user("followed", password="testpass"))
+        FollowingUserItem.objects.create(user_from=self.user, user_to=self.followed_user)
+        FollowingQueryItem.objects.create(user=self.user, query="field-recording birds")
+        FollowingQueryItem.objects.create(user=self.user, query="piano")
+
+    @mock.patch('follow.follow_utils.Solr.select')
+    def test_get_stream_sounds(self, select):
+        sounds = self.sounds
+        select.return_value = {'grouped': {
+            'username:followed': {'matches': 5, 'doclist': {
+                'numFound': 5, 'docs': [{'id': sounds[2].id}, {'id': sounds[0].id}, {'id': sounds[1].id}]}},
+            'tag:field-recording tag:birds': {'matches': 5, 'doclist': {
+                'numFound': 1, 'docs': [{'id': sounds[3].id}]}},
+            'tag:piano': {'matches': 5, 'doclist': {'numFound': 0, 'docs': []}},
+        }}
+        time_lapse = "[2019-05-01T00:00:00Z TO 2019-05-08T23:59:59.999Z]"
+        users_sounds, tags_sounds = follow_utils.get_stream_sounds(self.user, time_lapse)
+
+        # All followed users and tags are queried in a single Solr request
+        self.assertEqual(select.call_count, 1)
+
+        self.assertEqual(len(users_sounds), 1)
+        (user, _), sound_objs, more_url_params, more_count, new_count = users_sounds[0]
+        self.assertEqual(user, self.followed_user)
+        self.assertEqual([sound.id for sound in sound_objs], [sounds[2].id, sounds[0].id, sounds[1].id])
+        self.assertEqual(more_count, 2)
+        self.assertEqual(new_count, 5)
+
+        # Tag queries without new sounds are not included
+        self.assertEqual(len(tags_sounds), 1)
+        tags, sound_objs, more_url_params, more_count, new_count = tags_sounds[0]
+        self.assertEqual(tags, ['field-recording', 'birds'])
+        self.assertEqual([sound.id for sound in sound_objs], [sounds[3].id])
+        self.assertEqual(more_count, 0)
+        self.assertEqual(new_count, 1)
+
+    def get_solr_response(self):
+        return {'grouped': {
+            'username:followed': {'matches': 4, 'doclist': {
+                'numFound': 4, 'docs': [{'id': sound.id} for sound in self.sounds]}},
+            'tag:field-recording tag:birds': {'matches': 0, 'doclist': {'numFound': 0, 'docs': []}},
+            'tag:piano': {'matches': 0, 'doclist': {'numFound': 0, 'docs': []}},
+        }}
+
+    @mock.patch('follow.management.commands.send_stream_emails.send_mail')
+    @mock.patch('follow.follow_utils.Solr.select')
+    def test_send_stream_email(self, select, send_mail):
+        last_stream_email_sent = datetime.datetime.now() - datetime.timedelta(days=8)
+        Profile.objects.filter(user=self.user).update(last_stream_email_sent=last_stream_email_sent)
+        profile = Profile.objects.get(user=self.user)
+        solr_semaphore = mock.MagicMock()
+
+        # Errors in Solr do not send the email
+        select.side_effect = Exception('Solr error')
+        self.assertEqual(send_stream_emails.send_stream_email(profile.id, solr_semaphore),
+                         (profile.id, send_stream_emails.STREAM_EMAIL_FAILED))
+        send_mail.assert_not_called()
+        self.assertEqual(Profile.objects.get(id=profile.id).last_stream_email_sent, last_stream_email_sent)
+
+        select.side_effect = None
+        select.return_value = self.get_solr_response()
+        self.assertEqual(send_stream_emails.send_stream_email(profile.id, solr_semaphore),
+                         (profile.id, send_stream_emails.STREAM_EMAIL_SENT))
+        self.assertEqual(send_mail.call_count, 1)
+        self.assertEqual(send_mail.call_args[1]['user_to'], self.user)
+        self.assertGreater(Profile.objects.get(id=profile.id).last_stream_email_sent, last_stream_email_sent)
+        self.assertTrue(solr_semaphore.__enter__.called)
+
+
+@override_settings(MAX_EMAILS_PER_COMMAND_RUN=2)
+class SendStreamEmailsTestCase(TestCase):
+
+    def setUp(self):
+        email_type = EmailPreferenceType.objects.get(name="stream_emails")
+        self.profile_ids = []
+        for i in range(5):
+            user = User.objects.create_user("testuser%i" % i, password="testpass")
+            UserEmailSetting.objects.create(user=user, email_type=email_type)
+            self.profile_ids.append(user.profile.id)
+        self.profile_ids.sort()
+        self.statuses = {profile_id: send_stream_emails.STREAM_EMAIL_SENT for profile_id in self.profile_ids}
+        self.tmp_dir = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.tmp_dir, 'checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_command(self):
+        """Runs the command with send_stream_email mocked and returns the processed profile ids and the counts"""
+        with mock.patch('follow.management.commands.send_stream_emails.send_stream_email',
+                        side_effect=lambda profile_id, solr_semaphore: (profile_id, self.statuses[profile_id])) \
+                as send_stream_email, \
+                mock.patch.object(send_stream_emails.Command, 'log_end') as log_end:
+            call_command('send_stream_emails', checkpoint_file=self.checkpoint_file, jobs=2)
+        return [call[0][0] for call in send_stream_email.call_args_list], log_end.call_args[0][0]
+
+    def test_send_stream_emails_resume_from_checkpoint(self):
+        p = self.profile_ids
+
+        self.statuses[p[1]] = send_stream_emails.STREAM_EMAIL_NO_NEWS
+        processed, counts = self.run_command()
+        self.assertEqual(sorted(processed), p[:2])
+        self.assertEqual(counts['n_users_notified'], 1)
+        self.assertEqual(counts['n_users_without_news'], 1)
+        self.assertEqual(counts['n_failed'], 0)
+        self.assertEqual(json.load(open(self.checkpoint_file)), {'last_profile_id': p[1], 'failed_profile_ids': []})
+
+        # Next run continues after the checkpoint
+        self.statuses[p[2]] = send_stream_emails.STREAM_EMAIL_FAILED
+        processed, counts = self.run_command()
+        self.assertEqual(sorted(processed), p[2:4])
+        self.assertEqual(counts['n_users_notified'], 1)
+        self.assertEqual(counts['n_failed'], 1)
+        self.assertEqual(json.load(open(self.checkpoint_file)), {'last_profile_id': p[3], 'failed_profile_ids': [p[2]]})
+
+        # Failed profiles are retried first, and the checkpoint is removed at the end of the cycle
+        self.statuses[p[2]] = send_stream_emails.STREAM_EMAIL_SENT
+        processed, counts = self.run_command()
+        self.assertEqual(sorted(processed), [p[2], p[4]])
+        self.assertEqual(counts['n_users_notified'], 2)
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
+        # A new cycle starts from the beginning
+        processed, counts = self.run_command()
+        self.assertEqual(sorted(processed), p[:2])
@@ -20,6 +20,7 @@
 #     See AUTHORS file.
 #
 
+from django.conf import settings
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, render
 from django.contrib.auth.decorators import login_required
@@ -31,6 +32,7 @@ from django.contrib.auth.models import User
 from datetime import datetime, timedelta
 from collections import OrderedDict
 from socket import error as socket_error
+from utils.pagination import paginate
 from utils.username import redirect_if_old_username_or_404
 
 
@@ -40,11 +42,15 @@ def following_users(request, username):
     is_owner = False
     if request.user.is_authenticated:
         is_owner = request.user == user
-    following = follow_utils.get_users_following(user)
+    items = FollowingUserItem.objects.select_related('user_to__profile').filter(user_from=user).order_by('id')
+    paginator = paginate(request, items, settings.FOLLOW_ITEMS_PER_PAGE,
+                         object_count=len(follow_utils.get_following_user_ids(user)))
+    following = [item.user_to for item in paginator['page'].object_list]
 
     tvars = {'user': user,
              'following': following,
              'is_owner': is_owner}
+    tvars.update(paginator)
     return render(request, 'follow/following_users.html', tvars)
 
 
@@ -54,11 +60,15 @@ def followers(request, username):
     is_owner = False
     if request.user.is_authenticated:
         is_owner = request.user == user
-    followers = follow_utils.get_users_followers(user)
+    items = FollowingUserItem.objects.select_related('user_from__profile').filter(user_to=user).order_by('id')
+    paginator = paginate(request, items, settings.FOLLOW_ITEMS_PER_PAGE,
+                         object_count=len(follow_utils.get_follower_user_ids(user)))
+    followers = [item.user_from for item in paginator['page'].object_list]
 
     tvars = {'user': user,
              'followers': followers,
              'is_owner': is_owner}
+    tvars.update(paginator)
     return render(request, 'follow/followers.html', tvars)
 
 
@@ -68,22 +78,17 @@ def following_tags(request, username):
     is_owner = False
     if request.user.is_authenticated:
         is_owner = request.user == user
-    following = follow_utils.get_tags_following(user)
-    space_tags = following
-    split_tags = [tag.split(" ") for tag in space_tags]
-    slash_tags = [tag.replace(" ", "/") for tag in space_tags]
-
-    following_tags = []
-    for i in range(len(space_tags)):
-        following_tags.append((space_tags[i], slash_tags[i], split_tags[i]))
+    items = FollowingQueryItem.objects.filter(user=user).order_by('id')
+    paginator = paginate(request, items, settings.FOLLOW_ITEMS_PER_PAGE,
+                         object_count=len(follow_utils.get_following_tag_queries(user)))
+    following = [item.query for item in paginator['page'].object_list]
+    following_tags = follow_utils.get_following_tags_display_data(following)
 
     tvars = {'user': user,
              'following': following,
              'following_tags': following_tags,
-             'slash_tags': slash_tags,
-             'split_tags': split_tags,
-             'space_tags': space_tags,
              'is_owner': is_owner}
+    tvars.update(paginator)
     return render(request, 'follow/following_tags.html', tvars)
 
 
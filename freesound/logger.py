@@ -19,6 +19,13 @@ LOGGING = {
             'class': 'logging.StreamHandler',
             'formatter': 'standard'
         },
+        # API logs are emitted from a background thread (see utils.logging_handlers.QueueHandler). Handlers for API
+        # logs should be added to the 'api_emit' logger.
+        'api_queue': {
+            'class': 'utils.logging_handlers.QueueHandler',
+            'target_logger': 'api_emit',
+            'capacity': 10000,
+        },
     },
     'loggers': {
         'console': {
@@ -37,11 +44,16 @@ LOGGING = {
             'propagate': False,
         },
         'api': {
-            'handlers': ['stdout'],
+            'handlers': ['api_queue'],
             'level': 'INFO',
             'propagate': False,
         },
         'api_errors': {
+            'handlers': ['api_queue'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'api_emit': {
             'handlers': ['stdout'],
             'level': 'INFO',
             'propagate': False,
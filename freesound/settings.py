@@ -280,12 +280,21 @@ CRC_BUFFER_SIZE = 4096
 # Maximum combined file size for uploading files. This is set in nginx configuration
 UPLOAD_MAX_FILE_SIZE_COMBINED = 1024 * 1024 * 1024  # 1 GB
 
+# If the front-end proxy receives and stores API uploaded files itself (e.g. using nginx upload module), set this to the
+# directory where it stores them. The proxy should replace the file in the request by the fields 'audiofile.name',
+# 'audiofile.path' and 'audiofile.content_type' (see utils.upload_handlers).
+UPLOAD_PROXY_STORE_PATH = None
+
 # Minimum number of sounds that a user has to upload before enabling bulk upload feature for that user
 BULK_UPLOAD_MIN_SOUNDS = 40
 
 # Turn this option on to log every time a user downloads a pack or sound
 LOG_DOWNLOADS = False
 
+# Follow
+FOLLOW_CACHE_TIME = 60 * 60 * 24
+FOLLOW_ITEMS_PER_PAGE = 42
+
 # Followers notifications
 MAX_EMAILS_PER_COMMAND_RUN = 5000
 NOTIFICATION_TIMEDELTA_PERIOD = datetime.timedelta(days=7)
@@ -403,6 +412,8 @@ SIMILARITY_INDEXING_SERVER_PORT = 8009
 TAGRECOMMENDATION_ADDRESS = 'tagrecommendation'
 TAGRECOMMENDATION_PORT = 8010
 TAGRECOMMENDATION_CACHE_TIME = 60 * 60 * 24 * 7
+# Timeout (in seconds) of the requests to the tag recommendation service
+TAGRECOMMENDATION_TIMEOUT = 10
 
 # -------------------------------------------------------------------------------
 # Sentry settings
@@ -491,6 +502,22 @@ APIV2_RESOURCES_REQUIRING_HTTPS = ['apiv2-sound-download',
                                    'oauth2:access_token',
                                    'api-login']
 
+# Time (in seconds) that resolved API credentials (token or access token, client and user) are cached
+APIV2_CREDENTIALS_CACHE_TIMEOUT = 60
+
+# Time (in seconds) that serialized Audio Commons analysis of sounds are cached (cache is updated when analysis change)
+APIV2_AC_ANALYSIS_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+# Combined search strategies send block requests to solr and gaia concurrently using at most this number of threads.
+# If the requests take longer than the time budget (in seconds), partial results are returned and flagged in 'note'.
+APIV2_COMBINED_SEARCH_MAX_WORKERS = 4
+APIV2_COMBINED_SEARCH_TIME_BUDGET = 20
+
+# Maximum number of sound ids that can be requested at once with the bulk sound instance resource, and number of
+# requests that each bulk request counts as for throttling
+APIV2_SOUND_BULK_INSTANCE_MAX_IDS = 100
+APIV2_SOUND_BULK_INSTANCE_THROTTLING_COST = 10
+
 APIV2 = {
     'PAGE_SIZE': 15,
     'PAGE_SIZE_QUERY_PARAM': 'page_size',
@@ -18,7 +18,11 @@
 #     See AUTHORS file.
 #
 
+import json
 import logging
+import multiprocessing
+import os
+import tempfile
 
 import yaml
 
@@ -29,11 +33,75 @@ from utils.management_commands import LoggingBaseCommand
 console_logger = logging.getLogger('console')
 
 
+def read_freesound_extractor_version(path):
+    """Reads the Freesound Extractor version from an analysis statistics YAML file.
+
+    Instead of parsing the whole file, lines are scanned until the 'metadata.version.freesound_extractor' entry is
+    found. If the file does not follow the block layout written by Essentia (e.g. it is written in flow style) the
+    whole file is parsed as a fallback.
+
+    Args:
+        path (str): path of the analysis statistics file.
+
+    Returns:
+        str: the extractor version or None if the file is empty or has no 'freesound_extractor' version entry.
+
+    Raises:
+        IOError: if the file can't be read.
+    """
+    in_metadata = False
+    metadata_keys_indentation = None
+    in_version = False
+    with open(path) as f:
+        for line in f:
+            stripped_line = line.strip()
+            if not stripped_line or stripped_line.startswith('#') or stripped_line == '---':
+                continue
+            indentation = len(line) - len(line.lstrip())
+            if indentation == 0:
+                if in_metadata:
+                    # Reached the end of the metadata section without finding the version
+                    return None
+                if not stripped_line.endswith(':'):
+                    # Not the block layout we expect, parse the whole file
+                    break
+                in_metadata = stripped_line == 'metadata:'
+            elif in_metadata:
+                if metadata_keys_indentation is None:
+                    metadata_keys_indentation = indentation
+                if indentation == metadata_keys_indentation:
+                    in_version = stripped_line == 'version:'
+                elif in_version and stripped_line.startswith('freesound_extractor:'):
+                    return yaml.safe_load(stripped_line)['freesound_extractor']
+        else:
+            return None
+
+    data = yaml.load(open(path), Loader=yaml.cyaml.CLoader)
+    if data and 'freesound_extractor' in data['metadata']['version']:
+        return data['metadata']['version']['freesound_extractor']
+    return None
+
+
+def check_sound_analysis_file(sound_id_and_path):
+    """Returns a (sound_id, extractor_version, error) tuple for the given (sound_id, path) tuple.
+
+    This is run in a pool of worker processes so it must not touch the database.
+    """
+    sound_id, path = sound_id_and_path
+    try:
+        return sound_id, read_freesound_extractor_version(path), None
+    except Exception as e:
+        return sound_id, None, str(e)
+
+
 class Command(LoggingBaseCommand):
     help = "Take all sounds that haven't been added to the similarity service yet and add them. Use option --force " \
            "to force reindex ALL sounds. Use option -l to limit the maximum number of sounds to index " \
            "(to avoid collapsing similarity if using crons). Use option -ev to only index sounds with a specific" \
-           "essentia extractor version. For exampel: python manage.py similarity_update -ev 0.3 -l 1000"
+           "essentia extractor version. For exampel: python manage.py similarity_update -ev 0.3 -l 1000. " \
+           "Extractor versions are checked in parallel (see option -j) and the id of the last processed sound is " \
+           "stored in a checkpoint file so that an interrupted run continues where it stopped when run again " \
+           "with the same options."
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -64,59 +132,118 @@ class Command(LoggingBaseCommand):
             default=False,
             help='Send files to the indexing server instead of the main similarity server')
 
+        parser.add_argument(
+            '-j', '--jobs',
+            action='store',
+            dest='jobs',
+            default=4,
+            help='Number of processes used to check the extractor version of the analysis files')
+
+        parser.add_argument(
+            '-c', '--checkpoint_file',
+            action='store',
+            dest='checkpoint_file',
+            default=os.path.join(tempfile.gettempdir(), 'similarity_update_checkpoint.json'),
+            help='File where to store the progress of the command so that interrupted runs can be resumed')
+
+    def load_checkpoint(self, checkpoint_file, run_options):
+        try:
+            checkpoint = json.load(open(checkpoint_file))
+        except (IOError, ValueError):
+            return 0
+        if checkpoint.get('options') != run_options:
+            # Checkpoint belongs to a run with different options, start from the beginning
+            return 0
+        return checkpoint.get('last_sound_id', 0)
+
+    def save_checkpoint(self, checkpoint_file, run_options, last_sound_id):
+        tmp_checkpoint_file = checkpoint_file + '.tmp'
+        with open(tmp_checkpoint_file, 'w') as f:
+            json.dump({'options': run_options, 'last_sound_id': last_sound_id}, f)
+        os.rename(tmp_checkpoint_file, checkpoint_file)
+
     def handle(self,  *args, **options):
         self.log_start()
 
         limit = int(options['limit'])
         freesound_extractor_version = options['freesound_extractor_version']
+        checkpoint_file = options['checkpoint_file']
         console_logger.info("limit: %s, version: %s", limit, freesound_extractor_version)
 
+        run_options = {'force': options['force'],
+                       'indexing_server': options['indexing_server'],
+                       'freesound_extractor_version': freesound_extractor_version}
+        last_sound_id = self.load_checkpoint(checkpoint_file, run_options)
+        if last_sound_id:
+            console_logger.info("Resuming from checkpoint, starting after sound with id %i" % last_sound_id)
+
+        # Get all candidates with a single query. Only the fields needed to compute the analysis file location are
+        # loaded.
         if options['force']:
-            to_be_added = Sound.objects.filter(analysis_state='OK', moderation_state='OK').order_by('id')[:limit]
+            to_be_added = Sound.objects.filter(analysis_state='OK', moderation_state='OK')
+        else:
+            to_be_added = Sound.objects.filter(analysis_state='OK', similarity_state='PE', moderation_state='OK')
+        to_be_added = list(to_be_added.filter(id__gt=last_sound_id).only('id', 'user_id', 'type').order_by('id')[:limit])
+        sounds_paths = [(sound.id, sound.locations('analysis.statistics.path')) for sound in to_be_added]
+
+        pool = None
+        if freesound_extractor_version:
+            # Check the extractor version of the analysis files in parallel, results are returned in order
+            pool = multiprocessing.Pool(int(options['jobs']))
+            checked_files = pool.imap(check_sound_analysis_file, sounds_paths, chunksize=32)
         else:
-            to_be_added = Sound.objects.filter(
-                analysis_state='OK', similarity_state='PE', moderation_state='OK').order_by('id')[:limit]
+            checked_files = ((sound_id, None, None) for sound_id, _ in sounds_paths)
 
         N = len(to_be_added)
-        for count, sound in enumerate(to_be_added):
+        n_added = 0
+        try:
+            for count, sound in enumerate(to_be_added):
+                _, version, error = next(checked_files)
+                if count % 100 == 0 and count > 0:
+                    self.save_checkpoint(checkpoint_file, run_options, to_be_added[count - 1].id)
+
+                # Check if sound analyzed using the desired extractor
+                if freesound_extractor_version:
+                    if error is not None:
+                        console_logger.error('Sound with id %i was not indexed (no yaml file found when checking for '
+                                             'extractor version)' % sound.id)
+                        continue
 
-            # Check if sound analyzed using the desired extractor
-            if freesound_extractor_version:
-                try:
-                    data = yaml.load(open(sound.locations('analysis.statistics.path')), Loader=yaml.cyaml.CLoader)
-                except:
-                    console_logger.error('Sound with id %i was not indexed (no yaml file found when checking for '
-                                         'extractor version)' % sound.id)
-                    continue
-
-                if data:
-                    if 'freesound_extractor' in data['metadata']['version']:
-                        if data['metadata']['version']['freesound_extractor'] != freesound_extractor_version:
-                            console_logger.info(
-                                'Sound with id %i was not indexed (it was analyzed with extractor version %s)'
-                                % (sound.id, data['metadata']['version']['freesound_extractor']))
-                            continue
-                    else:
+                    if version is None:
                         console_logger.info('Sound with id %i was not indexed (it was analyzed with an unknown '
-                                            'extractor)' % sound.id)
+                                            'extractor or has an empty yaml file)' % sound.id)
                         continue
-                else:
-                    console_logger.info('Sound with id %i was not indexed (most probably empty yaml file)' % sound.id)
-                    continue
-
-            try:
-                if options['indexing_server']:
-                    result = Similarity.add_to_indeixing_server(sound.id, sound.locations('analysis.statistics.path'))
-                else:
-                    result = Similarity.add(sound.id, sound.locations('analysis.statistics.path'))
-                    sound.set_similarity_state('OK')
-                    sound.invalidate_template_caches()
-                console_logger.info("%s (%i of %i)" % (result, count+1, N))
-
-            except Exception as e:
-                if not options['indexing_server']:
-                    sound.set_similarity_state('FA')
-                console_logger.error('Unexpected error while trying to add sound (id: %i, %i of %i): \n\t%s'
-                                     % (sound.id, count+1, N, str(e)))
-
-        self.log_end({'n_sounds_added': to_be_added.count()})
+
+                    if version != freesound_extractor_version:
+                        console_logger.info(
+                            'Sound with id %i was not indexed (it was analyzed with extractor version %s)'
+                            % (sound.id, version))
+                        continue
+
+                try:
+                    if options['indexing_server']:
+                        result = Similarity.add_to_indeixing_server(sound.id, sound.locations('analysis.statistics.path'))
+                    else:
+                        result = Similarity.add(sound.id, sound.locations('analysis.statistics.path'))
+                        sound.set_similarity_state('OK')
+                        sound.invalidate_template_caches()
+                    n_added += 1
+                    console_logger.info("%s (%i of %i)" % (result, count+1, N))
+
+                except Exception as e:
+                    if not options['indexing_server']:
+                        sound.set_similarity_state('FA')
+                    console_logger.error('Unexpected error while trying to add sound (id: %i, %i of %i): \n\t%s'
+                                         % (sound.id, count+1, N, str(e)))
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        if N < limit:
+            # All candidates have been processed, next run should start from the beginning
+            if os.path.exists(checkpoint_file):
+                os.remove(checkpoint_file)
+        elif N:
+            self.save_checkpoint(checkpoint_file, run_options, to_be_added[-1].id)
+
+        self.log_end({'n_sounds_added': n_added})
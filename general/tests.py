@@ -18,11 +18,18 @@
 #     See AUTHORS file.
 #
 
+import os
+import shutil
+import tempfile
+
+import mock
 from django.core.management import call_command
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from forum.models import Thread, Post, Forum
+from general.management.commands.similarity_update import read_freesound_extractor_version
 from ratings.models import SoundRating
+from sounds.models import Sound
 from utils.test_helpers import create_user_and_sounds
 
 
@@ -123,3 +130,62 @@ class ReportCountStatusesManagementCommandTestCase(TestCase):
         self.assertEqual(sound.avg_rating, 4)
         self.assertEqual(sound.num_comments, 1)
         self.assertEqual(sound.num_downloads, 0)
+
+
+class SimilarityUpdateManagementCommandTestCase(TestCase):
+
+    fixtures = ['licenses']
+
+    def setUp(self):
+        self.analysis_path = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.analysis_path, 'checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.analysis_path)
+
+    def write_analysis_file(self, sound, content):
+        path = sound.locations('analysis.statistics.path')
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_read_freesound_extractor_version(self):
+        path = os.path.join(self.analysis_path, 'statistics.yaml')
+        for content, expected_version in [
+            ('lowlevel:\n    average_loudness: 0.9\nmetadata:\n    audio_properties:\n        version: 3\n'
+             '    version:\n        essentia: "2.1-beta2"\n        freesound_extractor: "0.3"\n'
+             'rhythm:\n    bpm: 120\n', '0.3'),
+            ('metadata:\n    version:\n        essentia: "2.1-beta2"\nrhythm:\n    bpm: 120\n', None),
+            ('{"metadata": {"version": {"freesound_extractor": "0.3"}}}', '0.3'),
+            ('', None),
+        ]:
+            with open(path, 'w') as f:
+                f.write(content)
+            self.assertEqual(read_freesound_extractor_version(path), expected_version)
+
+    @mock.patch('general.management.commands.similarity_update.Similarity.add', return_value='Dummy response')
+    def test_similarity_update_checks_version_and_resumes(self, similarity_add):
+        _, _, sounds = create_user_and_sounds(num_sounds=4)
+        Sound.objects.filter(id__in=[sound.id for sound in sounds]).update(analysis_state='OK', moderation_state='OK')
+
+        with override_settings(ANALYSIS_PATH=self.analysis_path):
+            for sound, version in zip(sounds, ['0.3', '0.2', '0.3', '0.3']):
+                self.write_analysis_file(sound, 'metadata:\n    version:\n        freesound_extractor: "%s"\n'
+                                         % version)
+
+            # Run with a limit so that only the first two sounds are processed
+            call_command('similarity_update', freesound_extractor_version='0.3', limit=2, jobs=2,
+                         checkpoint_file=self.checkpoint_file)
+            similarity_add.assert_called_once_with(sounds[0].id, sounds[0].locations('analysis.statistics.path'))
+            self.assertTrue(os.path.exists(self.checkpoint_file))
+
+            # The next run resumes after the last processed sound, so sound 1 (wrong version) is not checked again
+            similarity_add.reset_mock()
+            call_command('similarity_update', freesound_extractor_version='0.3', limit=10, jobs=2,
+                         checkpoint_file=self.checkpoint_file)
+            self.assertEqual([call[0][0] for call in similarity_add.call_args_list], [sounds[2].id, sounds[3].id])
+            self.assertFalse(os.path.exists(self.checkpoint_file))
+
+        self.assertEqual([Sound.objects.get(id=sound.id).similarity_state for sound in sounds],
+                         ['OK', 'PE', 'OK', 'OK'])
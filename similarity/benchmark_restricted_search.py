@@ -0,0 +1,74 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+"""
+Benchmark for restricted (in_ids) searches using the PCA vector index. It uses a synthetic dataset so it can be run
+without a Gaia index:
+
+    python benchmark_restricted_search.py --dataset-size 500000
+
+For reference, it also reports the time needed to build the 'point.id IN (...)' filter string that Gaia would need
+to parse and evaluate for the same candidate set.
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+from similarity_settings import PCA_DIMENSIONS, DEFAULT_NUMBER_OF_RESULTS
+from vector_index import VectorIndex
+
+
+def best_of(n_repetitions, f):
+    timings = []
+    for _ in range(n_repetitions):
+        tic = time.time()
+        f()
+        timings.append(time.time() - tic)
+    return min(timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark restricted searches on the PCA vector index.')
+    parser.add_argument('--dataset-size', type=int, default=200000)
+    parser.add_argument('--candidates', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repetitions', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    index = VectorIndex(PCA_DIMENSIONS, initial_capacity=args.dataset_size)
+    tic = time.time()
+    for sound_id, vector in enumerate(rng.randn(args.dataset_size, PCA_DIMENSIONS)):
+        index.add(sound_id, vector)
+    print('Built index with %i points in %.2f seconds' % (index.size(), time.time() - tic))
+
+    print('%12s %18s %18s' % ('candidates', 'search (ms)', 'filter string (ms)'))
+    for n_candidates in args.candidates:
+        in_ids = [int(sid) for sid in rng.choice(args.dataset_size, min(n_candidates, args.dataset_size),
+                                                 replace=False)]
+        query_vector = index.vector(in_ids[0])
+        search_time = best_of(args.repetitions, lambda: index.search_subset(
+            query_vector, in_ids, DEFAULT_NUMBER_OF_RESULTS, 0))
+        filter_time = best_of(args.repetitions, lambda: 'WHERE point.id IN ("' + '", "'.join(
+            [str(sid) for sid in in_ids]) + '")')
+        print('%12i %18.2f %18.2f' % (n_candidates, search_time * 1000, filter_time * 1000))
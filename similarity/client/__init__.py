@@ -30,6 +30,7 @@ _URL_GET_DESCRIPTOR_NAMES     = 'get_descriptor_names/'
 _URL_GET_ALL_SOUND_IDS        = 'get_all_point_names/'
 _URL_CONTAINS_POINT           = 'contains/'
 _URL_NNSEARCH                 = 'nnsearch/'
+_URL_NNSEARCH_MANY            = 'nnsearch_many/'
 _URL_API_SEARCH               = 'api_search/'
 _URL_SOUNDS_DESCRIPTORS       = 'get_sounds_descriptors/'
 _URL_SAVE                     = 'save/'
@@ -45,13 +46,16 @@ class SimilarityException(Exception):
         self.status_code = kwargs['status_code']
 
 
-def _get_url_as_json(url, data=None, timeout=None):
+def _get_url_as_json(url, data=None, timeout=None, content_type=None):
     kwargs = dict()
     if data is not None:
         kwargs['data'] = data
     if timeout is not None:
         kwargs['timeout'] = timeout
-    f = urllib2.urlopen(url.replace(" ", "%20"), **kwargs)
+    request = urllib2.Request(url.replace(" ", "%20"))
+    if content_type is not None:
+        request.add_header('Content-Type', content_type)
+    f = urllib2.urlopen(request, **kwargs)
     resp = f.read()
     return json.loads(resp)
 
@@ -79,6 +83,17 @@ class Similarity():
             url += '&offset=' + str(offset)
         return _result_or_exception(_get_url_as_json(url))
 
+    @classmethod
+    def search_many(cls, sound_ids, num_results = None, preset = None, offset = None):
+        url = _BASE_URL + _URL_NNSEARCH_MANY + '?' + 'sound_ids=' + ','.join([str(sound_id) for sound_id in sound_ids])
+        if num_results:
+            url += '&num_results=' + str(num_results)
+        if preset:
+            url += '&preset=' + preset
+        if offset:
+            url += '&offset=' + str(offset)
+        return _result_or_exception(_get_url_as_json(url))
+
     @classmethod
     def api_search(cls, target_type=None, target=None, filter=None, preset=None, metric_descriptor_names=None, num_results=None, offset=None, file=None, in_ids=None):
         url = _BASE_URL + _URL_API_SEARCH + '?'
@@ -96,10 +111,16 @@ class Similarity():
             url += '&num_results=' + str(num_results)
         if offset:
             url += '&offset=' + str(offset)
+        content_type = None
         if in_ids:
-            url += '&in_ids=' + str(in_ids)
-
-        j = _get_url_as_json(url, data=file)
+            if file is None:
+                # Send the ids in the request body so that long lists of ids do not have to go through the URL
+                file = json.dumps([int(sid) for sid in in_ids])
+                content_type = 'application/json'
+            else:
+                url += '&in_ids=' + ','.join([str(sid) for sid in in_ids])
+
+        j = _get_url_as_json(url, data=file, content_type=content_type)
         r = _result_or_exception(j)
 
         return r
@@ -29,9 +29,12 @@ from similarity_server_utils import generate_structured_dict_from_layout, get_ne
     get_nested_descriptor_names, set_nested_dictionary_value, parse_filter_list
 import similarity_settings as sim_settings
 from utils.filesystem import create_directories
+from vector_index import VectorIndex
 
 logger = logging.getLogger('similarity')
 
+PCA_DESCRIPTOR_NAME = '.pca'  # Name of the descriptor created by the 'pca' transformation (see 'resultName' below)
+
 
 class GaiaWrapper:
 
@@ -48,6 +51,7 @@ class GaiaWrapper:
         self.metrics = {}
         self.view = None
         self.view_pca = None
+        self.pca_vectors = None
         self.transformations_history = None
 
         self.__load_dataset()
@@ -91,6 +95,7 @@ class GaiaWrapper:
                 self.pca_dataset.setReferenceDataSet(self.original_dataset)
                 self.view_pca = View(self.pca_dataset)
                 self.__build_pca_metric()
+                self.__build_pca_vector_index()
 
             if self.original_dataset.history().size() <= 0:
                 logger.info('Dataset loaded, size: %s points' % (self.original_dataset.size()))
@@ -187,6 +192,24 @@ class GaiaWrapper:
         search_metric = DistanceFunctionFactory.create(str(distance), self.pca_dataset.layout(), parameters)
         self.metrics['pca'] = search_metric
 
+    def __build_pca_vector_index(self):
+        logger.info('Building PCA vector index')
+        self.pca_vectors = VectorIndex(sim_settings.PCA_DIMENSIONS, initial_capacity=self.pca_dataset.size() + 1)
+        for point in self.pca_dataset.points():
+            self.pca_vectors.add(point.name(), point.value(PCA_DESCRIPTOR_NAME))
+        self.__build_ann_index()
+
+    def __build_ann_index(self):
+        if sim_settings.USE_ANN_INDEX and self.pca_vectors is not None:
+            tic = time.time()
+            self.pca_vectors.build_ann_index(sim_settings.ANN_NUM_CLUSTERS,
+                                             n_iterations=sim_settings.ANN_KMEANS_ITERATIONS,
+                                             sample_size=sim_settings.ANN_KMEANS_SAMPLE_SIZE)
+            logger.info('Built ANN index (done in %.2f seconds)' % (time.time() - tic))
+
+    def __use_ann_index(self):
+        return sim_settings.USE_ANN_INDEX and self.pca_vectors is not None and self.pca_vectors.has_ann_index()
+
     def add_point(self, point_location, point_name):
 
         if self.original_dataset.contains(str(point_name)):
@@ -207,6 +230,9 @@ class GaiaWrapper:
                     # Add point to PCA dataset because it has been already created.
                     # PCA dataset will take care of adding the point to the original dataset as well.
                     self.pca_dataset.addPoint(p)
+                    if self.pca_vectors is not None:
+                        self.pca_vectors.add(point_name, self.pca_dataset.point(str(point_name)).value(
+                            PCA_DESCRIPTOR_NAME))
                     msg = 'Added point with name %s. Index has now %i points (pca index has %i points).' % \
                           (str(point_name), self.original_dataset.size(), self.pca_dataset.size())
                     logger.info(msg)
@@ -254,6 +280,7 @@ class GaiaWrapper:
             self.pca_dataset.setReferenceDataSet(self.original_dataset)
             self.view_pca = View(self.pca_dataset)
             self.__build_pca_metric()
+            self.__build_pca_vector_index()
 
         return {'error': False, 'result': msg}
 
@@ -265,6 +292,8 @@ class GaiaWrapper:
             else:
                 # Remove from pca dataset (pca dataset will take care of removing from original dataset too)
                 self.pca_dataset.removePoint(str(point_name))
+                if self.pca_vectors is not None:
+                    self.pca_vectors.remove(point_name)
             logger.info('Deleted point with name %s. Index has now %i points (pca index has %i points).' %
                         (str(point_name), self.original_dataset.size(), self.pca_dataset.size()))
             return {'error': False, 'result': True}
@@ -293,6 +322,8 @@ class GaiaWrapper:
         toc = time.time()
         logger.info('Finished saving index (done in %.2f seconds, index has now %i points).' %
                     ((toc - tic), self.original_dataset.size()))
+        # Rebuild the ANN index so that its clusters reflect the points added since it was last built
+        self.__build_ann_index()
         return {'error': False, 'result': path}
 
     def contains(self, point_name):
@@ -424,6 +455,16 @@ class GaiaWrapper:
             msg = "Sound with id %s doesn't exist in the dataset." % query_point
             logger.info(msg)
             return {'error': True, 'result': msg, 'status_code': sim_settings.NOT_FOUND_CODE}
+        if preset_name == 'pca' and self.__use_ann_index():
+            if not self.pca_vectors.contains(query_point):
+                msg = "Sound with id %s doesn't exist in the PCA vector index." % query_point
+                logger.info(msg)
+                return {'error': True, 'result': msg, 'status_code': sim_settings.NOT_FOUND_CODE}
+            # Approximate search on the PCA vector index
+            results, count = self.pca_vectors.search_approximate(self.pca_vectors.vector(query_point),
+                                                                 int(number_of_results), offset=int(offset),
+                                                                 n_probes=sim_settings.ANN_NUM_PROBES)
+            return {'error': False, 'result': {'results': results, 'count': count}}
         if preset_name == 'pca':
             # Search on PCA view
             search = self.view_pca.nnSearch(query_point, self.metrics[preset_name])
@@ -435,6 +476,30 @@ class GaiaWrapper:
 
         return {'error': False, 'result': {'results': results, 'count': count}}
 
+    def search_dataset_many(self, query_points, number_of_results, preset_name, offset=0):
+        preset_name = str(preset_name)
+        size = self.original_dataset.size()
+        if size < sim_settings.SIMILARITY_MINIMUM_POINTS:
+            msg = 'Not enough datapoints in the dataset (%s < %s).' % (size, sim_settings.SIMILARITY_MINIMUM_POINTS)
+            logger.info(msg)
+            return {'error': True, 'result': msg, 'status_code': sim_settings.SERVER_ERROR_CODE}
+
+        query_points = [str(query_point) for query_point in query_points]
+        logger.info('NN search for %i points (preset = %s)' % (len(query_points), preset_name))
+
+        if preset_name == 'pca' and self.pca_vectors is not None:
+            # Rank all query points in one pass over the PCA vector index
+            results = self.pca_vectors.search_many(query_points, int(number_of_results), offset=int(offset))
+        else:
+            results = dict()
+            for query_point in query_points:
+                if self.original_dataset.contains(query_point):
+                    result = self.search_dataset(query_point, number_of_results, preset_name, offset=offset)
+                    results[query_point] = result['result']
+
+        # Sounds not present in the dataset are not included in the results
+        return {'error': False, 'result': results}
+
     def api_search(self, target_type, target, filter, preset_name, metric_descriptor_names, num_results, offset,
                    in_ids):
 
@@ -455,6 +520,7 @@ class GaiaWrapper:
                 coeffs = trans_hist[-(i+1)]['Applier parameters']['coeffs']
 
         # Process target
+        target_file_parsing_type = None
         if target:
             if target_type == 'sound_id':
                 query_point = str(target)
@@ -589,12 +655,47 @@ class GaiaWrapper:
             log_message += ' with filter: %s' % str(filter)
         logger.info(log_message)
 
+        # Unfiltered searches on the PCA space can use the approximate nearest neighbours index
+        if not in_ids and not filter and target and preset_name == 'pca' and target_type in ['sound_id', 'file'] \
+                and not metric_descriptor_names and self.__use_ann_index():
+            try:
+                if target_type == 'sound_id':
+                    query_vector = self.pca_vectors.vector(query)
+                else:
+                    query_vector = query.value(PCA_DESCRIPTOR_NAME)
+                results, count = self.pca_vectors.search_approximate(query_vector, num_results, offset=offset,
+                                                                     n_probes=sim_settings.ANN_NUM_PROBES)
+            except Exception as e:
+                logger.error('Approximate search on PCA vector index failed, falling back to Gaia search (%s)' % e)
+            else:
+                return {'error': False, 'result': {'results': results, 'count': count,
+                                                   'note': self.__get_target_file_note(target_type,
+                                                                                       target_file_parsing_type)}}
+
+        # If in_ids is specified and there are no other filters, rank only those points using the PCA vector index.
+        # Otherwise (or if the index is not available) fall back to a Gaia filter restricting the results to in_ids.
+        if in_ids and not filter and preset_name == 'pca' and target_type != 'descriptor_values' \
+                and self.pca_vectors is not None:
+            try:
+                if target_type == 'sound_id':
+                    query_vector = self.pca_vectors.vector(query)
+                else:
+                    query_vector = query.value(PCA_DESCRIPTOR_NAME)
+                results, count = self.pca_vectors.search_subset(query_vector, in_ids, num_results, offset)
+            except Exception as e:
+                logger.error('Restricted search on PCA vector index failed, falling back to Gaia filter (%s)' % e)
+            else:
+                return {'error': False, 'result': {'results': results, 'count': count,
+                                                   'note': self.__get_target_file_note(target_type,
+                                                                                       target_file_parsing_type)}}
+
         # if in_ids is specified, edit the filter accordingly
         if in_ids:
+            ids_filter = 'point.id IN ("' + '", "'.join([str(sid) for sid in in_ids]) + '")'
             if not filter:
-                filter = 'WHERE point.id IN ("' + '", "'.join(in_ids) + '")'
+                filter = 'WHERE ' + ids_filter
             else:
-                filter += ' AND point.id IN ("' + '", "'.join(in_ids) + '")'
+                filter += ' AND ' + ids_filter
 
          # Set query metric
         metric = self.metrics[preset_name]
@@ -615,11 +716,14 @@ class GaiaWrapper:
         except Exception as e:
             return {'error': True, 'result': 'Similarity server error', 'status_code': sim_settings.SERVER_ERROR_CODE}
 
-        note = None
-        if target_type == 'file':
-            if target_file_parsing_type == 'walkDict':
-                note = 'The layout of the given analysis file differed from what we expected. Similarity results ' \
-                       'might not be accurate. Was the file generated with the last version of Essentia\'s ' \
-                       'Freesound extractor?'
+        note = self.__get_target_file_note(target_type, target_file_parsing_type)
 
         return {'error': False, 'result': {'results': results, 'count': count, 'note': note}}
+
+    @staticmethod
+    def __get_target_file_note(target_type, target_file_parsing_type):
+        if target_type == 'file' and target_file_parsing_type == 'walkDict':
+            return 'The layout of the given analysis file differed from what we expected. Similarity results ' \
+                   'might not be accurate. Was the file generated with the last version of Essentia\'s ' \
+                   'Freesound extractor?'
+        return None
@@ -43,6 +43,7 @@ def server_interface(resource):
         'contains': resource.contains,  # sound_id
         'get_sounds_descriptors': resource.get_sounds_descriptors,  # sound_ids, descritor_names (optional), normalization (optional)
         'nnsearch': resource.nnsearch,  # sound_id, num_results (optional), preset (optional)
+        'nnsearch_many': resource.nnsearch_many,  # sound_ids, num_results (optional), preset (optional)
         'api_search': resource.api_search,
         'save': resource.save,  # filename (optional)
     }
@@ -100,6 +101,17 @@ class SimilarityServer(resource.Resource):
 
         return json.dumps(self.gaia.search_dataset(sound_id[0], num_results[0], preset_name=preset[0], offset=offset[0]))
 
+    def nnsearch_many(self, request, sound_ids, num_results=None, preset=None, offset=[0]):
+
+        preset = ['pca']  # For the moment we only admit pca preset, in the future we may allow more presets
+
+        if not num_results:
+            num_results = [DEFAULT_NUMBER_OF_RESULTS]
+
+        sound_ids = [sound_id for sound_id in sound_ids[0].split(',') if sound_id]
+        return json.dumps(self.gaia.search_dataset_many(sound_ids, num_results[0], preset_name=preset[0],
+                                                        offset=offset[0]))
+
     def api_search(self, request, target_type=None, target=None, filter=None, preset=[DEFAULT_PRESET], metric_descriptor_names=None, num_results=[DEFAULT_NUMBER_OF_RESULTS], offset=[0], in_ids=None):
         '''
         This function is used as an interface to all search-related gaia funcionalities we use in freesound.
@@ -129,11 +141,21 @@ class SimilarityServer(resource.Resource):
             - metric_descriptor_names*: a list of descriptor names (separated by ,) that will be used as to build the distance metric (preset will be overwritten)
                 * this parameter is bypassed with the descriptor_values target type, as the list is automatically built with the descriptors specified in the target
             - num_results, offset: to control the number of returned results and the offset since the first result (so pagination is possible)
+            - in_ids: restrict the results to this list of sound ids. Ids can be passed as a comma-separated string
+              in the URL or, for long lists, as a JSON array of ints in the body of a POST request with content type
+              'application/json'. When no filter is given ids are ranked directly using the PCA vector index.
         '''
 
 
-        if in_ids:
-            in_ids = in_ids[0].split(',')
+        if request.getHeader('content-type') == 'application/json' or in_ids:
+            try:
+                if request.getHeader('content-type') == 'application/json':
+                    # Ids sent as a JSON array of ints in the request body (see Similarity.api_search in the client)
+                    in_ids = [int(sid) for sid in json.loads(request.content.getvalue())]
+                else:
+                    in_ids = [int(sid) for sid in in_ids[0].split(',') if sid]
+            except (ValueError, TypeError):
+                return json.dumps({'error': True, 'result': 'Invalid list of ids.', 'status_code': BAD_REQUEST_CODE})
 
         if not target and not filter:
             if target_type:
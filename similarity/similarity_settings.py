@@ -43,6 +43,16 @@ PCA_DESCRIPTORS = [
    "*lowlevel*dvar2"
 ]
 
+# APPROXIMATE NEAREST NEIGHBOURS SEARCH
+# If enabled, an IVF index (PCA vectors grouped in k-means clusters) is built when the index is loaded or saved and
+# used for unfiltered searches on the PCA space. Queries only rank the points in the ANN_NUM_PROBES clusters closest to
+# the query point. Searches with filters (or with descriptor values as target) always use exact Gaia search.
+USE_ANN_INDEX = False
+ANN_NUM_CLUSTERS = 1024
+ANN_NUM_PROBES = 16
+ANN_KMEANS_ITERATIONS = 10
+ANN_KMEANS_SAMPLE_SIZE = 100000
+
 # OTHER
 SIMILAR_SOUNDS_TO_CACHE = 100
 SIMILARITY_CACHE_TIME = 60*60*1
@@ -0,0 +1,86 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from similarity.vector_index import VectorIndex
+
+
+class VectorIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        # Synthetic dataset with some cluster structure, similar to what we get in the PCA space
+        rng = np.random.RandomState(0)
+        centers = rng.randn(40, 20) * 3
+        self.vectors = centers[rng.randint(0, len(centers), 4000)] + rng.randn(4000, 20)
+        self.index = VectorIndex(20, initial_capacity=16)
+        for sound_id, vector in enumerate(self.vectors):
+            self.index.add(sound_id, vector)
+
+    def recall_at_k(self, k, n_probes, query_ids):
+        hits = 0
+        for sound_id in query_ids:
+            query_vector = self.index.vector(sound_id)
+            exact, _ = self.index.search_exact(query_vector, k)
+            approximate, _ = self.index.search_approximate(query_vector, k, n_probes=n_probes)
+            hits += len(set(name for name, _ in exact).intersection(name for name, _ in approximate))
+        return float(hits) / (k * len(query_ids))
+
+    def test_search_subset(self):
+        results, count = self.index.search_subset(self.vectors[0], [0, 5, 7, 12345, 5], 2, offset=1)
+        self.assertEqual(count, 3)
+        distances = np.sqrt(((self.vectors[[0, 5, 7]] - self.vectors[0]) ** 2).sum(axis=1))
+        expected_names = [str(sound_id) for sound_id in np.array([0, 5, 7])[np.argsort(distances)]][1:3]
+        self.assertEqual([name for name, _ in results], expected_names)
+
+    def test_search_many_matches_exact_search(self):
+        results = self.index.search_many([3, 10, 999999], 10, offset=2)
+        self.assertEqual(sorted(results.keys()), ['10', '3'])
+        for sound_id in [3, 10]:
+            exact, count = self.index.search_exact(self.index.vector(sound_id), 10, offset=2)
+            self.assertEqual([name for name, _ in results[str(sound_id)]['results']], [name for name, _ in exact])
+            self.assertEqual(results[str(sound_id)]['count'], count)
+
+    def test_ann_recall(self):
+        self.index.build_ann_index(64, n_iterations=10)
+        query_ids = range(0, 4000, 40)
+
+        # Probing all clusters is equivalent to exact search
+        self.assertEqual(self.recall_at_k(10, 64, query_ids), 1.0)
+
+        recall = self.recall_at_k(10, 8, query_ids)
+        self.assertGreater(recall, 0.9, 'recall@10 with 8 of 64 clusters probed is %.3f' % recall)
+
+    def test_ann_index_is_updated(self):
+        self.index.build_ann_index(64)
+
+        # Deleted points are not returned and new points are assigned to a cluster
+        self.index.remove(1)
+        self.index.add(5000, self.vectors[2] + 0.001)
+        results, count = self.index.search_approximate(self.vectors[2], 3, n_probes=4)
+        names = [name for name, _ in results]
+        self.assertEqual(names[:2], ['2', '5000'])
+        self.assertNotIn('1', names)
+        self.assertEqual(count, 4000)
+
+        # If the probed clusters do not have enough points, results come from exact search
+        results, _ = self.index.search_approximate(self.vectors[2], 3000, n_probes=1)
+        self.assertEqual(len(results), 3000)
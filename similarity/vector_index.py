@@ -0,0 +1,273 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import numpy as np
+
+
+class VectorIndex:
+    """
+    Keeps a copy of the PCA vectors of the dataset in a contiguous numpy matrix together with a point name -> row
+    dictionary. This allows us to rank arbitrary subsets of the dataset (e.g. the candidates returned by a Solr query
+    in combined search) without having to build and evaluate a textual 'point.id IN (...)' Gaia filter.
+    Distances are euclidean, which is what the 'pca' preset uses (see presets/pca.yaml).
+    Rows of deleted points are recycled for new points so the matrix does not need to be compacted.
+    Point names are sound ids, so besides the name -> row dictionary we keep a numpy array indexed by sound id that
+    lets us resolve large lists of ids to rows in a single vectorised operation.
+    """
+
+    def __init__(self, dimension, initial_capacity=1024):
+        self.dimension = dimension
+        self.vectors = np.zeros((initial_capacity, dimension), dtype=np.float32)
+        self.row_names = [None] * initial_capacity
+        self.name_to_row = dict()
+        self.id_to_row = np.full(initial_capacity, -1, dtype=np.int64)
+        self.free_rows = []
+        self.n_rows = 0  # Number of rows used so far (including the ones that are now free)
+
+        # Approximate nearest neighbours (IVF) index, see build_ann_index()
+        self.centroids = None
+        self.row_clusters = None
+        self.cluster_rows = None
+        self.cluster_added_rows = None
+
+    def size(self):
+        return len(self.name_to_row)
+
+    def contains(self, point_name):
+        return str(point_name) in self.name_to_row
+
+    def vector(self, point_name):
+        return self.vectors[self.name_to_row[str(point_name)]]
+
+    def __grow(self):
+        new_capacity = max(1, 2 * self.vectors.shape[0])
+        vectors = np.zeros((new_capacity, self.dimension), dtype=np.float32)
+        vectors[:self.n_rows] = self.vectors[:self.n_rows]
+        self.vectors = vectors
+        self.row_names += [None] * (new_capacity - len(self.row_names))
+        if self.row_clusters is not None:
+            row_clusters = np.full(new_capacity, -1, dtype=np.int64)
+            row_clusters[:len(self.row_clusters)] = self.row_clusters
+            self.row_clusters = row_clusters
+
+    def add(self, point_name, vector):
+        point_name = str(point_name)
+        if point_name in self.name_to_row:
+            row = self.name_to_row[point_name]
+        elif self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            if self.n_rows == self.vectors.shape[0]:
+                self.__grow()
+            row = self.n_rows
+            self.n_rows += 1
+        self.vectors[row] = vector
+        self.row_names[row] = point_name
+        self.name_to_row[point_name] = row
+        self.__set_id_row(int(point_name), row)
+        if self.centroids is not None:
+            # Assign the new point to the closest cluster of the ANN index
+            cluster = int(np.argmin(self.__distances(self.centroids, self.vectors[row])))
+            self.row_clusters[row] = cluster
+            self.cluster_added_rows[cluster].append(row)
+
+    def remove(self, point_name):
+        row = self.name_to_row.pop(str(point_name), None)
+        if row is not None:
+            self.row_names[row] = None
+            self.free_rows.append(row)
+            self.__set_id_row(int(point_name), -1)
+            if self.row_clusters is not None:
+                self.row_clusters[row] = -1
+
+    def __set_id_row(self, point_id, row):
+        if point_id >= len(self.id_to_row):
+            id_to_row = np.full(max(point_id + 1, 2 * len(self.id_to_row)), -1, dtype=np.int64)
+            id_to_row[:len(self.id_to_row)] = self.id_to_row
+            self.id_to_row = id_to_row
+        self.id_to_row[point_id] = row
+
+    def rows_for_ids(self, point_ids):
+        """
+        Resolves a list of point ids (sound ids) to (deduplicated) matrix rows. Ids not present in the index are
+        ignored.
+        """
+        point_ids = np.asarray(point_ids, dtype=np.int64)
+        point_ids = point_ids[(point_ids >= 0) & (point_ids < len(self.id_to_row))]
+        rows = np.unique(self.id_to_row[point_ids])
+        return rows[rows >= 0]
+
+    def search_subset(self, query_vector, point_ids, num_results, offset=0):
+        """
+        Returns the points in 'point_ids' sorted by euclidean distance to 'query_vector' as a tuple with the list of
+        [point_name, distance] pairs in the requested page and the total number of points that could be ranked. Ties
+        are broken by row position so results are deterministic.
+        """
+        rows = self.rows_for_ids(point_ids)
+        count = len(rows)
+        if count == 0 or offset >= count:
+            return [], count
+
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        if 4 * count > self.n_rows:
+            # For big subsets it is cheaper to scan the contiguous matrix than to gather the selected rows
+            distances = self.__distances(self.vectors[:self.n_rows], query_vector)[rows]
+        else:
+            distances = self.__distances(self.vectors[rows], query_vector)
+
+        return self.__page(rows, distances, num_results, offset), count
+
+    def __page(self, rows, distances, num_results, offset):
+        """
+        Sorts the given rows by distance and returns the [point_name, distance] pairs in the requested page.
+        """
+        end = min(offset + num_results, len(rows))
+        if end < len(rows):
+            # Only fully sort the candidates that can end up in the requested page
+            candidates = np.argpartition(distances, end - 1)[:end]
+        else:
+            candidates = np.arange(len(rows))
+        candidates = candidates[np.lexsort((rows[candidates], distances[candidates]))][offset:end]
+        return [[self.row_names[rows[i]], float(distances[i])] for i in candidates]
+
+    @staticmethod
+    def __distances(vectors, query_vector):
+        differences = vectors - query_vector
+        return np.sqrt(np.einsum('ij,ij->i', differences, differences))
+
+    def search_many(self, point_names, num_results, offset=0, block_size=16):
+        """
+        Nearest neighbours search for several points of the index at once. Distances from all query points to all
+        points in the index are computed with one matrix product per block of query points, then only the candidates
+        that can end up in the requested page are ranked with exact distances. Returns a dictionary with one
+        {'results': [[point_name, distance], ...], 'count': N} entry per query point found in the index. As with Gaia
+        nnSearch, results include the query point itself.
+        """
+        query_names = [str(name) for name in point_names if str(name) in self.name_to_row]
+        output = dict()
+        count = self.size()
+        end = min(offset + num_results, count)
+        if not query_names or offset >= count:
+            for name in query_names:
+                output[name] = {'results': [], 'count': count}
+            return output
+
+        vectors = self.vectors[:self.n_rows]
+        squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+        if self.free_rows:
+            # Free rows should never be returned as results
+            squared_norms[self.free_rows] = np.inf
+        for i in range(0, len(query_names), block_size):
+            block_names = query_names[i:i + block_size]
+            block_rows = np.array([self.name_to_row[name] for name in block_names])
+            queries = vectors[block_rows]
+            approximate_distances = squared_norms[np.newaxis, :] - 2 * np.dot(queries, vectors.T)
+            if end < self.n_rows:
+                candidate_rows = np.argpartition(approximate_distances, end - 1, axis=1)[:, :end]
+            else:
+                candidate_rows = np.tile(np.arange(self.n_rows), (len(block_names), 1))
+            for name, query, rows in zip(block_names, queries, candidate_rows):
+                rows = rows[np.array([self.row_names[row] is not None for row in rows], dtype=bool)]
+                distances = self.__distances(vectors[rows], query)
+                order = np.lexsort((rows, distances))[offset:end]
+                output[name] = {'results': [[self.row_names[rows[j]], float(distances[j])] for j in order],
+                                'count': count}
+        return output
+
+    def search_exact(self, query_vector, num_results, offset=0):
+        """
+        Exact nearest neighbours search over all the points of the index. Returns a tuple with the list of
+        [point_name, distance] pairs in the requested page and the number of points in the index.
+        """
+        rows = np.sort(self.id_to_row[self.id_to_row >= 0])
+        if offset >= len(rows):
+            return [], self.size()
+        distances = self.__distances(self.vectors[:self.n_rows], np.asarray(query_vector, dtype=np.float32))[rows]
+        return self.__page(rows, distances, num_results, offset), self.size()
+
+    def has_ann_index(self):
+        return self.centroids is not None
+
+    def build_ann_index(self, n_clusters, n_iterations=10, sample_size=100000, seed=0):
+        """
+        Builds an IVF (inverted file) index for approximate nearest neighbours search: points are grouped in
+        'n_clusters' clusters using k-means (trained on a random sample of at most 'sample_size' points) and queries
+        only need to rank the points in the clusters closest to the query (see search_approximate()).
+        Points added afterwards are assigned to their closest cluster. The index should be rebuilt from time to time
+        so that clusters reflect the distribution of the points.
+        """
+        rows = np.sort(self.id_to_row[self.id_to_row >= 0])
+        n_clusters = min(n_clusters, len(rows))
+        if n_clusters == 0:
+            self.centroids = None
+            self.row_clusters = None
+            self.cluster_rows = None
+            self.cluster_added_rows = None
+            return
+
+        rng = np.random.RandomState(seed)
+        sample = self.vectors[rng.choice(rows, min(sample_size, len(rows)), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+        for _ in range(n_iterations):
+            assignments = self.__closest_centroids(sample, centroids)
+            counts = np.bincount(assignments, minlength=n_clusters)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty][:, np.newaxis]
+            # Re-seed empty clusters with random points of the sample
+            centroids[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+
+        assignments = self.__closest_centroids(self.vectors[rows], centroids)
+        self.row_clusters = np.full(self.vectors.shape[0], -1, dtype=np.int64)
+        self.row_clusters[rows] = assignments
+        order = np.argsort(assignments, kind='mergesort')
+        boundaries = np.searchsorted(assignments[order], np.arange(n_clusters + 1))
+        self.cluster_rows = [rows[order[boundaries[i]:boundaries[i + 1]]] for i in range(n_clusters)]
+        self.cluster_added_rows = [[] for _ in range(n_clusters)]
+        self.centroids = centroids
+
+    @staticmethod
+    def __closest_centroids(vectors, centroids, block_size=4096):
+        squared_norms = np.einsum('ij,ij->i', centroids, centroids)
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for i in range(0, len(vectors), block_size):
+            distances = squared_norms[np.newaxis, :] - 2 * np.dot(vectors[i:i + block_size], centroids.T)
+            assignments[i:i + block_size] = np.argmin(distances, axis=1)
+        return assignments
+
+    def search_approximate(self, query_vector, num_results, offset=0, n_probes=16):
+        """
+        Approximate nearest neighbours search using the IVF index (see build_ann_index()). Only the points of the
+        'n_probes' clusters closest to the query are ranked. If these do not contain enough points to fill the
+        requested page, an exact search is performed instead. Returns the same as search_exact().
+        """
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        n_probes = min(n_probes, len(self.centroids))
+        probes = np.argpartition(self.__distances(self.centroids, query_vector), n_probes - 1)[:n_probes]
+        rows = np.unique(np.concatenate([self.cluster_rows[cluster] for cluster in probes] +
+                                        [np.array(self.cluster_added_rows[cluster], dtype=np.int64)
+                                         for cluster in probes]))
+        # Discard rows of points which have been deleted (or whose row has been reused by a point in another cluster)
+        rows = rows[np.in1d(self.row_clusters[rows], probes)]
+        if len(rows) < offset + num_results and len(rows) < self.size():
+            return self.search_exact(query_vector, num_results, offset)
+        distances = self.__distances(self.vectors[rows], query_vector)
+        return self.__page(rows, distances, num_results, offset), self.size()
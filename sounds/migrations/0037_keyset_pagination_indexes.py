@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 00:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sounds', '0036_sound_uploaded_with_bulk_upload_progress'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pack',
+            index=models.Index(fields=[b'user', b'created', b'id'], name='sounds_pack_user_id_b65c8b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sound',
+            index=models.Index(fields=[b'user', b'created', b'id'], name='sounds_soun_user_id_aa33b2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sound',
+            index=models.Index(fields=[b'pack', b'created', b'id'], name='sounds_soun_pack_id_413343_idx'),
+        ),
+    ]
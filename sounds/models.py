@@ -491,6 +491,11 @@ class Sound(SocialModel):
     user = models.ForeignKey(User, related_name="sounds")
     created = models.DateTimeField(db_index=True, auto_now_add=True)
 
+    # "modified" is updated every time the sound is saved (e.g. when editing its description, moderating it,
+    # processing it or when comments and ratings are added). It is used to compute the ETag of the sound in the API.
+    # Note that it is not updated by queryset updates such as the one for "num_downloads".
+    modified = models.DateTimeField(null=True, blank=True, auto_now=True)
+
     # "original_filename" is the name given to the sound, which typically is similar to the filename. note that this
     # property is named in a misleading way and should probably be renamed to "name" or "sound_name".
     original_filename = models.CharField(max_length=512)
@@ -818,7 +823,7 @@ class Sound(SocialModel):
         :param str state: new state to which self.analysis_state should be set
         """
         self.analysis_state = state
-        self.save(update_fields=['analysis_state'])
+        self.save(update_fields=['analysis_state', 'modified'])
 
     def set_similarity_state(self, state):
         """
@@ -828,7 +833,7 @@ class Sound(SocialModel):
         :param str state: new state to which self.similarity_state should be set
         """
         self.similarity_state = state
-        self.save(update_fields=['similarity_state'])
+        self.save(update_fields=['similarity_state', 'modified'])
 
     def set_audio_info_fields(self, samplerate=None, bitrate=None, bitdepth=None, channels=None, duration=None):
         """
@@ -857,6 +862,8 @@ class Sound(SocialModel):
         if duration is not None:
             self.duration = duration
             update_fields.append('duration')
+        if update_fields:
+            update_fields.append('modified')
         self.save(update_fields=update_fields)
 
     def change_moderation_state(self, new_state):
@@ -904,7 +911,8 @@ class Sound(SocialModel):
             self.processing_state = new_state
             self.processing_date = datetime.datetime.now()
             self.processing_log = processing_log
-            self.save(update_fields=['processing_state', 'processing_date', 'processing_log', 'is_index_dirty'])
+            self.save(update_fields=['processing_state', 'processing_date', 'processing_log', 'is_index_dirty',
+                                      'modified'])
 
             if new_state == 'FA':
                 # Sound became processing failed, delete it from indexes
@@ -919,7 +927,7 @@ class Sound(SocialModel):
             # If processing state has not changed, only update the processing date and log
             self.processing_date = datetime.datetime.now()
             self.processing_log = processing_log
-            self.save(update_fields=['processing_date', 'processing_log'])
+            self.save(update_fields=['processing_date', 'processing_log', 'modified'])
 
         self.invalidate_template_caches()
 
@@ -1115,6 +1123,11 @@ class Sound(SocialModel):
 
     class Meta(SocialModel.Meta):
         ordering = ("-created", )
+        indexes = [
+            # Used for keyset pagination of user and pack sounds in the API
+            models.Index(fields=['user', 'created', 'id']),
+            models.Index(fields=['pack', 'created', 'id']),
+        ]
 
 
 class SoundOfTheDayManager(models.Manager):
@@ -1235,6 +1248,7 @@ def on_delete_sound(sender, instance, **kwargs):
 
         # Alter datetime objects in data to avoid serialization problems
         data['created'] = str(data['created'])
+        data['modified'] = str(data['modified'])
         data['moderation_date'] = str(data['moderation_date'])
         data['processing_date'] = str(data['processing_date'])
         data['date_recorded'] = str(data['date_recorded'])  # This field is not used
@@ -1318,6 +1332,10 @@ class Pack(SocialModel):
     class Meta(SocialModel.Meta):
         unique_together = ('user', 'name', 'is_deleted')
         ordering = ("-created",)
+        indexes = [
+            # Used for keyset pagination of user packs in the API
+            models.Index(fields=['user', 'created', 'id']),
+        ]
 
     def friendly_filename(self):
         name_slug = slugify(self.name)
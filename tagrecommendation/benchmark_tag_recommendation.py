@@ -0,0 +1,180 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+"""
+Benchmark for the candidate selection step of tag recommendation (cNMostSimilar) and for the community detection
+instance vectors. It compares the precomputed most similar tags table and tag index with the previous implementation
+(linear tag name lookups and sorting full rows of the similarity matrix), and memory-mapped loading of the CSR
+similarity matrix and most similar tags table with loading a dense similarity matrix, and the time of the requests made
+while describing a sound (one for every added tag) with and without the cache of tag sets of TagRecommender. It uses a
+generated vocabulary and similarity matrix so it can be run without recommendation data:
+
+    python benchmark_tag_recommendation.py --vocabulary-size 10000
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from tagRecommendation import TagRecommender
+from tagRecommendation.heuristics import MOST_SIMILAR_TABLE_SIZE, heuristics
+from tagRecommendation.tag_recommendation_utils import build_tag_index, build_most_similar_table
+from utils import CSRMatrix
+
+
+def previous_cNMostSimilar(input_tags, tag_names, similarity_matrix, options):
+    N = options['cNMostSimilar_N']
+    unicode_tag_names = [t.decode('utf-8') for t in tag_names]
+    candidate_tags = []
+    for tag in input_tags:
+        if tag in unicode_tag_names:
+            idx = unicode_tag_names.index(tag)
+            row_idx = np.nonzero(similarity_matrix[idx, :])[0]
+            row = similarity_matrix[idx, row_idx]
+            most_similar_idx = row.argsort()[-N-1:-1][::-1]
+            most_similar_dist = row[most_similar_idx]
+            most_similar_tags = tag_names[row_idx[most_similar_idx]]
+            rank = N
+            for count, item in enumerate(most_similar_tags):
+                if item not in input_tags:
+                    candidate_tags.append({'name': item, 'rank': rank, 'dist': most_similar_dist[count], 'from': tag})
+                    rank -= 1
+    return candidate_tags
+
+
+def previous_instance_vector(tag_names, tags):
+    instance_vector = np.zeros(len(tag_names))
+    for tag in tags:
+        w_out = np.where(tag_names == tag)[0]
+        if len(w_out) > 0:
+            instance_vector[w_out[0]] = 1
+    return instance_vector
+
+
+def instance_vector(tag_index, n_tags, tags):
+    instance_vector = np.zeros(n_tags)
+    for tag in tags:
+        pos = tag_index.get(tag, None)
+        if pos is not None:
+            instance_vector[pos] = 1
+    return instance_vector
+
+
+def generate_similarity_matrix(rng, n_tags, density):
+    similarity_matrix = rng.rand(n_tags, n_tags).astype('float32')
+    similarity_matrix[rng.rand(n_tags, n_tags) > density] = 0
+    similarity_matrix = (similarity_matrix + similarity_matrix.T) / 2
+    np.fill_diagonal(similarity_matrix, 1.0)
+    return similarity_matrix
+
+
+def mean_time(requests, f):
+    tic = time.time()
+    for input_tags in requests:
+        f(input_tags)
+    return (time.time() - tic) / len(requests)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark candidate tag selection for tag recommendation.')
+    parser.add_argument('--vocabulary-size', type=int, default=5000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--input-tags', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    tag_names = np.array(['tag%i' % i for i in range(args.vocabulary_size)])
+    similarity_matrix = generate_similarity_matrix(rng, args.vocabulary_size, args.density)
+    requests = [[tag.decode('utf-8') for tag in rng.choice(tag_names, args.input_tags, replace=False)]
+                for _ in range(args.requests)]
+
+    similarity_matrix_csr = CSRMatrix.from_dense(similarity_matrix)
+    tic = time.time()
+    most_similar_idx, most_similar_dist = build_most_similar_table(similarity_matrix_csr, MOST_SIMILAR_TABLE_SIZE)
+    print('Computed most similar tags table (%i tags, top %i) in %.2f seconds'
+          % (args.vocabulary_size, MOST_SIMILAR_TABLE_SIZE, time.time() - tic))
+
+    # Compare loading times of a dense similarity matrix and memory-mapped CSR matrix and table
+    data_dir = tempfile.mkdtemp()
+    try:
+        np.save(os.path.join(data_dir, 'SIMILARITY_MATRIX.npy'), similarity_matrix)
+        similarity_matrix_csr.save(os.path.join(data_dir, 'SIMILARITY_MATRIX_CSR'))
+        np.save(os.path.join(data_dir, 'MOST_SIMILAR_IDX.npy'), most_similar_idx)
+        np.save(os.path.join(data_dir, 'MOST_SIMILAR_DIST.npy'), most_similar_dist)
+        tic = time.time()
+        np.load(os.path.join(data_dir, 'SIMILARITY_MATRIX.npy'))
+        print('Loaded dense similarity matrix (%.1f MB) in %.3f seconds'
+              % (similarity_matrix.nbytes / 1e6, time.time() - tic))
+        tic = time.time()
+        recommender = TagRecommender()
+        recommender.load_data(data={
+            'TAG_NAMES': tag_names,
+            'MOST_SIMILAR_IDX': np.load(os.path.join(data_dir, 'MOST_SIMILAR_IDX.npy'), mmap_mode='r'),
+            'MOST_SIMILAR_DIST': np.load(os.path.join(data_dir, 'MOST_SIMILAR_DIST.npy'), mmap_mode='r'),
+        })
+        print('Loaded memory-mapped most similar tags table (%.1f MB, CSR similarity matrix is %.1f MB) in %.3f '
+              'seconds' % ((most_similar_idx.nbytes + most_similar_dist.nbytes) / 1e6,
+                           (similarity_matrix_csr.data.nbytes + similarity_matrix_csr.indices.nbytes +
+                            similarity_matrix_csr.indptr.nbytes) / 1e6, time.time() - tic))
+        tag_index = build_tag_index(tag_names)
+
+        chooseAlgorithm = recommender.heuristic['c']
+        options = heuristics['hRankPercentage015']['options']
+        for input_tags in requests[:10]:
+            assert chooseAlgorithm(input_tags, recommender.data, options) == \
+                previous_cNMostSimilar(input_tags, tag_names, similarity_matrix, options)
+
+        print('%28s %14s %14s' % ('', 'previous (ms)', 'current (ms)'))
+        print('%28s %14.3f %14.3f' % (
+            'cNMostSimilar',
+            mean_time(requests,
+                      lambda tags: previous_cNMostSimilar(tags, tag_names, similarity_matrix, options)) * 1000,
+            mean_time(requests, lambda tags: chooseAlgorithm(tags, recommender.data, options)) * 1000))
+        print('%28s %14.3f %14.3f' % (
+            'community instance vector',
+            mean_time(requests, lambda tags: previous_instance_vector(tag_names, tags)) * 1000,
+            mean_time(requests, lambda tags: instance_vector(tag_index, len(tag_names), tags)) * 1000))
+        print('%28s %14.3f' % ('recommend_tags (current)',
+                               mean_time(requests, recommender.recommend_tags) * 1000))
+
+        # Requests made while describing a sound, one for every tag that is added, with and without the cache of
+        # tag sets of the recommender
+        describe_requests = [input_tags[:i] for input_tags in requests for i in range(1, len(input_tags) + 1)]
+        uncached_recommender = TagRecommender()
+        uncached_recommender.tag_set_cache_size = 0
+        uncached_recommender.load_data(data=recommender.data)
+        recommender.load_data(data=recommender.data)
+        for input_tags in describe_requests:
+            assert recommender.recommend_tags(input_tags) == uncached_recommender.recommend_tags(input_tags)
+        recommender.load_data(data=recommender.data)
+        print('%28s %14.3f %14.3f' % (
+            'recommend_tags (describing)',
+            mean_time(describe_requests, uncached_recommender.recommend_tags) * 1000,
+            mean_time(describe_requests, recommender.recommend_tags) * 1000))
+    finally:
+        shutil.rmtree(data_dir)
+
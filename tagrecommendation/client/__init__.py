@@ -20,18 +20,29 @@
 
 from django.conf import settings
 import json
-import urllib2
+import requests
 
 _BASE_URL                     = 'http://%s:%i/tagrecommendation/' % (settings.TAGRECOMMENDATION_ADDRESS, settings.TAGRECOMMENDATION_PORT)
 _URL_RECOMMEND_TAGS           = 'recommend_tags/'
 _URL_LAST_INDEXED_ID          = 'last_indexed_id/'
 _URL_ADD_TO_INDEX             = 'add_to_index/'
+_URL_ADD_TO_INDEX_BULK        = 'add_to_index_bulk/'
+_URL_RECOMMEND_TAGS_MANY      = 'recommend_tags_many/'
 
+# Connections to the tag recommendation service are kept alive and reused between requests
+_session = requests.Session()
 
-def _get_url_as_json(url):
-    f = urllib2.urlopen(url.replace(" ","%20"))
-    resp = f.read()
-    return json.loads(resp)
+
+def _get_url_as_json(url, data=None, timeout=settings.TAGRECOMMENDATION_TIMEOUT, content_type=None):
+    headers = dict()
+    if content_type is not None:
+        headers['Content-Type'] = content_type
+    if data is not None:
+        r = _session.post(url, data=data, headers=headers, timeout=timeout)
+    else:
+        r = _session.get(url, headers=headers, timeout=timeout)
+    r.raise_for_status()
+    return r.json()
 
 
 def _result_or_exception(result):
@@ -50,6 +61,15 @@ class TagRecommendation():
             url += '&max_number_of_tags=' + str(max_number_of_tags)
         return _result_or_exception(_get_url_as_json(url))
 
+    @classmethod
+    def recommend_tags_many(cls, input_tagss, max_number_of_tags=None):
+        """Returns the recommendations for several lists of input tags (in the same order) using a single request"""
+        url = _BASE_URL + _URL_RECOMMEND_TAGS_MANY
+        if max_number_of_tags:
+            url += '?max_number_of_tags=' + str(max_number_of_tags)
+        data = json.dumps([list(input_tags) for input_tags in input_tagss], separators=(',', ':'))
+        return _result_or_exception(_get_url_as_json(url, data=data, content_type='application/json'))
+
     @classmethod
     def get_last_indexed_id(cls):
         url = _BASE_URL + _URL_LAST_INDEXED_ID
@@ -59,3 +79,10 @@ class TagRecommendation():
     def add_to_index(cls, sound_ids, sound_tagss):
         url = _BASE_URL + _URL_ADD_TO_INDEX + '?' + 'sound_ids=' + ",".join([str(sid) for sid in sound_ids]) + '&sound_tagss=' + "-!-!-".join([",".join(stags) for stags in sound_tagss])
         return _result_or_exception(_get_url_as_json(url))
+
+    @classmethod
+    def add_to_index_bulk(cls, sound_tags):
+        """Adds a list of (sound_id, tags) pairs to the index in a single POST request"""
+        url = _BASE_URL + _URL_ADD_TO_INDEX_BULK
+        data = json.dumps([[sound_id, list(tags)] for sound_id, tags in sound_tags], separators=(',', ':'))
+        return _result_or_exception(_get_url_as_json(url, data=data, timeout=60 * 5, content_type='application/json'))
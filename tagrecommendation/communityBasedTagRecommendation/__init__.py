@@ -22,8 +22,9 @@
 from tagRecommendation import TagRecommender
 from communityDetection import CommunityDetector
 from tagrecommendation_settings import RECOMMENDATION_DATA_DIR
-from utils import loadFromJson
+from utils import loadFromJson, CSRMatrix
 from numpy import load
+import os
 
 
 class CommunityBasedTagRecommender():
@@ -69,10 +70,21 @@ class CommunityBasedTagRecommender():
             self.recommenders[class_name] = TagRecommender()
             self.recommenders[class_name].set_heuristic(self.recommendation_heuristic)
 
+            # Files are memory-mapped so loading is fast and memory can be shared between processes
+            path = RECOMMENDATION_DATA_DIR + self.dataset + '_%s_SIMILARITY_MATRIX_' % class_name + self.metric + '_SUBSET'
             data = {
-                'TAG_NAMES': load(RECOMMENDATION_DATA_DIR + self.dataset + '_%s_SIMILARITY_MATRIX_' % class_name + self.metric + '_SUBSET_TAG_NAMES.npy'),
-                'SIMILARITY_MATRIX': load(RECOMMENDATION_DATA_DIR + self.dataset + '_%s_SIMILARITY_MATRIX_' % class_name + self.metric + '_SUBSET.npy'),
+                'TAG_NAMES': load(path + '_TAG_NAMES.npy', mmap_mode='r'),
             }
+            if os.path.exists(path + '_MOST_SIMILAR_IDX.npy') and os.path.exists(path + '_MOST_SIMILAR_DIST.npy'):
+                # Load the precomputed most similar tags table (the similarity matrix is not needed)
+                data['MOST_SIMILAR_IDX'] = load(path + '_MOST_SIMILAR_IDX.npy', mmap_mode='r')
+                data['MOST_SIMILAR_DIST'] = load(path + '_MOST_SIMILAR_DIST.npy', mmap_mode='r')
+            elif CSRMatrix.exists(path + '_CSR'):
+                data['SIMILARITY_MATRIX'] = CSRMatrix.load(path + '_CSR')
+            else:
+                # Data generated before similarity matrices were stored in CSR format, the most similar tags table is
+                # computed when loading
+                data['SIMILARITY_MATRIX'] = load(path + '.npy', mmap_mode='r')
 
             self.recommenders[class_name].load_data(
                 data=data,
@@ -86,4 +98,10 @@ class CommunityBasedTagRecommender():
         com_name = self.communityDetector.detectCommunity(input_tags)
         rec = self.recommenders[com_name].recommend_tags(input_tags)
 
-        return rec[0:max_number_of_tags], com_name
\ No newline at end of file
+        return rec[0:max_number_of_tags], com_name
+
+    def recommend_tags_many(self, input_tags_list, max_number_of_tags=None):
+        """Recommends tags for several lists of input tags, classifying all of them in a single classifier call"""
+        com_names = self.communityDetector.detectCommunities(input_tags_list)
+        return [(self.recommenders[com_name].recommend_tags(input_tags)[0:max_number_of_tags], com_name)
+                for input_tags, com_name in zip(input_tags_list, com_names)]
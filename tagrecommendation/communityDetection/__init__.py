@@ -19,8 +19,10 @@
 #
 
 from sklearn.externals import joblib
-from numpy import load, where, zeros
+from numpy import load, ones, zeros
+from scipy.sparse import csr_matrix
 from utils import loadFromJson
+from tagRecommendation.tag_recommendation_utils import build_tag_index
 from tagrecommendation_settings import RECOMMENDATION_DATA_DIR
 import os
 
@@ -34,6 +36,7 @@ class CommunityDetector:
     init_method = None
     selected_instances = None
     tag_names = None
+    tag_index = None
 
     def __init__(self,
                  verbose=True,
@@ -61,6 +64,7 @@ class CommunityDetector:
         self.class_name_ids = meta['class_name_ids']
         self.n_training_instances = meta['n_training_instances']
         self.tag_names = load(RECOMMENDATION_DATA_DIR + 'Classifier_TAG_NAMES.npy')
+        self.tag_index = build_tag_index(self.tag_names)
 
     def __repr__(self):
         return "Community Detector (%s, %i classes, %i instances, %s init) " % (self.clf_type,
@@ -73,16 +77,43 @@ class CommunityDetector:
 
         instance_vector = zeros(len(self.tag_names))
         for tag in tags_t:
-            w_out = where(self.tag_names == tag)[0]
-            if len(w_out) > 0:
-                pos = w_out[0]
+            pos = self.tag_index.get(tag, None)
+            if pos is not None:
                 instance_vector[pos] = 1
         return instance_vector
 
-    def detectCommunity(self, input_tags=None):
+    def load_instance_matrix_from_tags(self, tags_list):
+        """Returns a sparse (CSR) matrix with the instance vectors of the given lists of tags"""
+        rows = []
+        cols = []
+        for row, tags in enumerate(tags_list):
+            positions = set([self.tag_index[tag] for tag in tags if tag in self.tag_index])
+            rows += [row] * len(positions)
+            cols += positions
+        return csr_matrix((ones(len(rows)), (rows, cols)), shape=(len(tags_list), len(self.tag_names)))
+
+    def detectCommunities(self, input_tags_list, chunk_size=10000, progress_callback=None):
+        """Classifies several lists of tags at once (calling the classifier once per chunk of instances)
+
+        Args:
+            input_tags_list (list): list of lists of tags
+            chunk_size (int): number of instances to classify in every call to the classifier
+            progress_callback (function): called with the number of classified instances after every chunk
+
+        Returns:
+            list: names of the detected communities (in the same order as input_tags_list)
+        """
         if not self.clf:
             raise Exception("Classifier not yet trained!")
-        instance_vector = self.load_instance_vector_from_tags(input_tags)
-        cl = self.clf.predict([instance_vector])[0]
+        instance_matrix = self.load_instance_matrix_from_tags(input_tags_list)
+        communities = []
+        for start in range(0, len(input_tags_list), chunk_size):
+            # Classifiers trained with dense data can't classify sparse data, so chunks are converted to dense arrays
+            predicted = self.clf.predict(instance_matrix[start:start + chunk_size].toarray())
+            communities += [str(self.class_name_ids[unicode(cl)]) for cl in predicted]
+            if progress_callback is not None:
+                progress_callback(len(communities))
+        return communities
 
-        return str(self.class_name_ids[unicode(cl)])
\ No newline at end of file
+    def detectCommunity(self, input_tags=None):
+        return self.detectCommunities([input_tags])[0]
@@ -20,11 +20,13 @@
 
 from tagrecommendation_settings import RECOMMENDATION_TMP_DATA_DIR, RECOMMENDATION_DATA_DIR
 import fileinput, sys, os
-from utils import saveToJson, mtx2npy, loadFromJson
-from numpy import save, load, where, in1d
-from math import sqrt
-from pysparse import spmatrix
+from utils import saveToJson, loadFromJson, CSRMatrix, TagAssignmentIndex
+from numpy import save, load, where, in1d, array, arange, ones, zeros, unique, bincount, flatnonzero, repeat, \
+    searchsorted, asarray, sqrt, diff, cumsum, concatenate
+from scipy.sparse import coo_matrix, diags, save_npz, load_npz
 from communityDetection import CommunityDetector
+from tagRecommendation.heuristics import MOST_SIMILAR_TABLE_SIZE
+from tagRecommendation.tag_recommendation_utils import build_most_similar_table
 from datetime import datetime
 import urllib
 
@@ -32,7 +34,8 @@ import urllib
 class RecommendationDataProcessor:
     '''
     This class has methods to generate all the files that the tag recommendation systems needs to recommend tags.
-    To generate these files the data processor needs the Index.json file with the tag association information from freesound.
+    To generate these files the data processor needs the Index.json file with the tag association information from freesound
+    (and the Index.log file with the sounds indexed after the last compaction of Index.json, if any).
     The Index.json file must have the following form:
 
     {
@@ -52,8 +55,10 @@ class RecommendationDataProcessor:
 
     The files that are generated by the system are:
     (for every sound class: Soundscape, Music, Fx, Samples, Speech)
-    [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET.npy
+    [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_CSR_DATA/INDICES/INDPTR.npy
     [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_TAG_NAMES.npy
+    [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_MOST_SIMILAR_IDX.npy
+    [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_MOST_SIMILAR_DIST.npy
     '''
 
     verbose = None
@@ -66,123 +71,82 @@ class RecommendationDataProcessor:
 
     def tas_to_association_matrix(self, tag_threshold=0, line_limit=1000000000):
 
-        index = loadFromJson(RECOMMENDATION_DATA_DIR + "Index.json")
-        # Get tags from file
-        ts = []
-        idx = 0
-        n_original_associations = 0
-        sound_ids = []
+        # Snapshot plus the records appended to Index.log since the last compaction
+        index = TagAssignmentIndex(RECOMMENDATION_DATA_DIR + "Index.json").load()
         if self.verbose:
-            print "Reading index file (%i entries)..." % len(index.items()),
-        for sid, tags in index.items():
-            ts += tags
-            n_original_associations += len(tags)
-            sound_ids.append(sid)
-
-            idx += 1
-            if idx > line_limit:
-                break
+            print "Reading index file (%i entries)..." % len(index),
+        index_items = index.items()[0:line_limit + 1]
+        sound_ids = [sid for sid, tags in index_items]
 
         stats = {
             'n_sounds_in_matrix': len(sound_ids),
             #'biggest_id': max([int(sid) for sid in sound_ids])
         }
         saveToJson(RECOMMENDATION_TMP_DATA_DIR + 'Current_index_stats.json', stats)
+
+        # Integer-code tag assignments: for every assignment, position of the sound in sound_ids and position of the
+        # tag in the (sorted) vocabulary
+        tag_codes = dict()
+        assignment_tags = array([tag_codes.setdefault(tag, len(tag_codes))
+                                 for sid, tags in index_items for tag in tags], dtype='int64')
+        assignment_resources = repeat(arange(len(index_items)), [len(tags) for sid, tags in index_items])
+        code_tags = [None] * len(tag_codes)
+        for tag, code in tag_codes.items():
+            code_tags[code] = tag
+        unique_ts, code_positions = unique(array(code_tags, dtype=unicode), return_inverse=True)
+        assignment_tags = code_positions[assignment_tags]
+        n_original_associations = len(assignment_tags)
         if self.verbose:
             print "done!"
 
-        # Compute tag ocurrences after loading the file
-        tag_occurrences = dict()
-        unique_ts = list(set(ts))
-        for id, t in enumerate(unique_ts):
-            tag_occurrences[t] = ts.count(t)
-
-            if self.verbose:
-                sys.stdout.write("\rComputing tag occurrences %.2f%%"%(float(100*(id+1))/len(unique_ts)))
-                sys.stdout.flush()
-        print ""
-        tags = []
-        tags_ids = []
-        for id, t in enumerate(unique_ts):
-
-            if tag_occurrences[t] >= tag_threshold:
-                tags.append(t)
-                tags_ids.append(id)
-
-            if self.verbose:
-                sys.stdout.write("\rFiltering tags %.2f%%"%(float(100*(id+1))/len(unique_ts)))
-                sys.stdout.flush()
-
+        # Compute tag ocurrences and filter tags
+        tag_occurrences = bincount(assignment_tags, minlength=len(unique_ts))
+        tags_ids = flatnonzero(tag_occurrences >= tag_threshold)
+        tags = unique_ts[tags_ids]
         nTags = len(tags)
         if self.verbose:
-            print ""
             print "\tOriginal number of tags: " + str(len(unique_ts))
             print "\tTags after filtering: " + str(nTags)
 
-        # Generate resource-tags dictionary only with filtered tags
-        if self.verbose:
-            print "Reading file for resources...",
-        sys.stdout.flush()
-        res_tags = {}
-        res_user = {}
-        res_tags_no_filt = {}
-        idx = 0
-        n_filtered_associations = 0
-        for sid, stags in index.items():
-            resource = sid
-            user = None
-            assigned_tags = stags
-            assigned_tags_filt = list(set(assigned_tags).intersection(set(tags)))
-            res_tags_no_filt[resource] = assigned_tags
-            res_user[resource] = user
-            if len(assigned_tags_filt) > 0:
-                res_tags[resource] = assigned_tags_filt
-                n_filtered_associations += len(assigned_tags_filt)
-
-            idx += 1
-            if idx > line_limit:
-                break
-
-        resources = res_tags.keys()
+        # Get associations of filtered tags (only once per sound and tag) and the sounds which have filtered tags
+        tag_positions = -ones(len(unique_ts), dtype='int64')
+        tag_positions[tags_ids] = arange(nTags)
+        assignment_tags = tag_positions[assignment_tags]
+        filtered = assignment_tags >= 0
+        associations = unique(assignment_resources[filtered] * max(nTags, 1) + assignment_tags[filtered])
+        association_resources = associations // max(nTags, 1)
+        association_tags = associations % max(nTags, 1)
+        resource_positions = unique(association_resources)
+        resources = [sound_ids[position] for position in resource_positions]
         nResources = len(resources)
-        resources_ids = range(0,nResources)
-        if self.verbose:
-            print "done!"
-
-        # Generate assocoation matrix
+        n_filtered_associations = len(associations)
         if self.verbose:
             print "\tOriginal number of associations: " + str(n_original_associations)
             print "\tAssociations after filtering: " + str(n_filtered_associations)
 
+        # Generate association matrix (resources x tags)
         if self.verbose:
-            print 'Creating empty array of ' + str(nResources) + ' x ' + str(nTags) + '...',
-        M = spmatrix.ll_mat(nResources, nTags)
+            print 'Generating association matrix of ' + str(nResources) + ' x ' + str(nTags) + '...',
+        M = coo_matrix((ones(n_filtered_associations, dtype='float32'),
+                        (searchsorted(resource_positions, association_resources), association_tags)),
+                       shape=(nResources, nTags)).tocsr()
+        M.sort_indices()
+        res_tags = dict()
+        for position, resource in enumerate(resources):
+            res_tags[resource] = tags[M.indices[M.indptr[position]:M.indptr[position + 1]]].tolist()
         if self.verbose:
             print 'done!'
 
-        done = 0
-        for r_id in resources:
-            for t in res_tags[r_id]:
-                M[resources.index(r_id),tags.index(t)] = 1
-                done += 1
-                if self.verbose:
-                    sys.stdout.write("\rGenerating association matrix %.2f%%" % (float(100*done)/n_filtered_associations))
-                    sys.stdout.flush()
-        if self.verbose:
-            print ""
-
         # Save data
         if self.verbose:
             print "Saving association matrix, resource ids, tag ids and tag names"
 
         filename = "FS%.4i%.2i%.2i" % (datetime.today().year, datetime.today().month, datetime.today().day)
-        M.export_mtx(RECOMMENDATION_TMP_DATA_DIR + filename + '_ASSOCIATION_MATRIX.mtx')
+        save_npz(RECOMMENDATION_TMP_DATA_DIR + filename + '_ASSOCIATION_MATRIX.npz', M)
         save(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCE_IDS.npy',resources)
         save(RECOMMENDATION_TMP_DATA_DIR + filename + '_TAG_IDS.npy',tags_ids)
         save(RECOMMENDATION_TMP_DATA_DIR + filename + '_TAG_NAMES.npy',tags)
         saveToJson(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCES_TAGS.json',res_tags, verbose = self.verbose)
-        #saveToJson(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCES_TAGS_NO_FILTER.json',res_tags_no_filt, verbose = self.verbose)
-        #saveToJson(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCES_USER.json',res_user, verbose = self.verbose)
 
         return filename
 
@@ -193,12 +157,13 @@ class RecommendationDataProcessor:
                                                 save_sim=False,
                                                 training_set=None,
                                                 out_name_prefix="",
-                                                is_general_recommender=False):
+                                                is_general_recommender=False,
+                                                chunk_size=1000):
 
         if self.verbose:
             print "Loading association matrix and tag names, ids files..."
         try:
-            M = spmatrix.ll_mat_from_mtx(RECOMMENDATION_TMP_DATA_DIR + dataset + "_ASSOCIATION_MATRIX.mtx")
+            M = load_npz(RECOMMENDATION_TMP_DATA_DIR + dataset + "_ASSOCIATION_MATRIX.npz").tocsr()
             resource_ids = load(RECOMMENDATION_TMP_DATA_DIR + dataset + "_RESOURCE_IDS.npy")
             tag_names = load(RECOMMENDATION_TMP_DATA_DIR + dataset + "_TAG_NAMES.npy")
         except Exception:
@@ -211,60 +176,78 @@ class RecommendationDataProcessor:
             print "Computing similarity matrix from a resource subset of the whole association matrix..."
         # Get index of resources to train (usable index for M)
         resource_id_positions = where(in1d(resource_ids, training_set, assume_unique=True))[0]
-
-        # Matrix multiplication (only taking in account resources in training set and ALL tags)
-        MM = spmatrix.dot(M[resource_id_positions, :], M[resource_id_positions, :])
-
-        # Get similarity matrix
-        sim_matrix = spmatrix.ll_mat(MM.shape[0],MM.shape[0])
-        non_zero_index = MM.keys()
-        for index in non_zero_index:
+        M = M[resource_id_positions, :].astype('float64')
+
+        # Remove tags that are not used in the training set (tag occurrences are the diagonal of the co-occurrence
+        # matrix M^T M)
+        tag_occurrences = asarray(M.sum(axis=0)).ravel()
+        tag_positions = flatnonzero(tag_occurrences)
+        M = M[:, tag_positions].tocsc()
+        tag_occurrences = tag_occurrences[tag_positions]
+        nTags = len(tag_positions)
+        if metric == 'cosine':
+            # Normalising the tag columns of M, M^T M directly gives cosine similarities
+            M = M * diags(1.0 / sqrt(tag_occurrences))
+        MT = M.T.tocsr()
+
+        # Compute similarity matrix (CSR) in chunks of tags (rows) so that memory usage is bounded
+        data_chunks = []
+        indices_chunks = []
+        row_lengths = []
+        for start in range(0, nTags, chunk_size):
+            end = min(start + chunk_size, nTags)
+            MM = (MT[start:end, :] * M).tocsr()
+            MM.sort_indices()
+            rows = repeat(arange(start, end), diff(MM.indptr))
             if metric == 'cosine':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]] * (1 / (sqrt(MM[index[0], index[0]]) * sqrt(MM[index[1], index[1]])))
+                values = MM.data
             elif metric == 'coocurrence':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]]
+                values = MM.data
             elif metric == 'binary':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]]/MM[index[0], index[1]]
+                values = MM.data / MM.data
             elif metric == 'jaccard':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]] * (1 / (MM[index[0], index[0]] + MM[index[1], index[1]] - MM[index[0], index[1]]))
-
-        # Clean out similarity matrix (clean tags that are not used)
-        tag_positions = []
-        for i in range(0, sim_matrix.shape[0]):
-            if sim_matrix[i, i] != 0.0:
-                tag_positions.append(i)
+                values = MM.data * (1 / (tag_occurrences[rows] + tag_occurrences[MM.indices] - MM.data))
+            data_chunks.append(values.astype('float32'))
+            indices_chunks.append(MM.indices.astype('int32'))
+            row_lengths.append(diff(MM.indptr))
+            if self.verbose:
+                sys.stdout.write("\rComputing similarity matrix %.2f%%" % (float(100 * end) / nTags))
+                sys.stdout.flush()
+        if self.verbose:
+            print ""
 
-        # Transform sparse similarity matrix to npy format
-        sim_matrix_npy = mtx2npy(sim_matrix[tag_positions,tag_positions])
+        indptr = zeros(nTags + 1, dtype='int64')
+        if nTags:
+            indptr[1:] = cumsum(concatenate(row_lengths))
+        sim_matrix_csr = CSRMatrix(concatenate(data_chunks) if data_chunks else zeros(0, dtype='float32'),
+                                   concatenate(indices_chunks) if indices_chunks else zeros(0, dtype='int32'),
+                                   indptr)
         tag_names_sim_matrix = tag_names[tag_positions]
 
         if save_sim:
             if not is_general_recommender:
-                # Save sim
-                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_%s_SIMILARITY_MATRIX_" % out_name_prefix + metric + "_SUBSET.npy"
-                if self.verbose:
-                    print "Saving to " + path + "..."
-                save(path, sim_matrix_npy)
-
-                # Save tag names
-                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_%s_SIMILARITY_MATRIX_" % out_name_prefix + metric + "_SUBSET_TAG_NAMES.npy"
-                if self.verbose:
-                    print "Saving to " + path + "..."
-                save(path, tag_names_sim_matrix)
+                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_%s_SIMILARITY_MATRIX_" % out_name_prefix + metric + "_SUBSET"
             else:
-                # Save sim
-                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_SIMILARITY_MATRIX_" + metric + ".npy"
-                if self.verbose:
-                    print "Saving to " + path + "..."
-                save(path, sim_matrix_npy)
+                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_SIMILARITY_MATRIX_" + metric
 
-                # Save tag names
-                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_SIMILARITY_MATRIX_" + metric + "_TAG_NAMES.npy"
-                if self.verbose:
-                    print "Saving to " + path + "..."
-                save(path, tag_names_sim_matrix)
+            # Save sim
+            if self.verbose:
+                print "Saving to " + path + "_CSR_DATA/INDICES/INDPTR.npy..."
+            sim_matrix_csr.save(path + "_CSR")
 
-        return {'SIMILARITY_MATRIX': sim_matrix_npy, 'TAG_NAMES': tag_names_sim_matrix}
+            # Save tag names
+            if self.verbose:
+                print "Saving to " + path + "_TAG_NAMES.npy..."
+            save(path + "_TAG_NAMES.npy", tag_names_sim_matrix)
+
+            # Save table of most similar tags
+            if self.verbose:
+                print "Computing most similar tags and saving to " + path + "_MOST_SIMILAR_IDX/DIST.npy..."
+            most_similar_idx, most_similar_dist = build_most_similar_table(sim_matrix_csr, MOST_SIMILAR_TABLE_SIZE)
+            save(path + "_MOST_SIMILAR_IDX.npy", most_similar_idx)
+            save(path + "_MOST_SIMILAR_DIST.npy", most_similar_dist)
+
+        return {'SIMILARITY_MATRIX': sim_matrix_csr, 'TAG_NAMES': tag_names_sim_matrix}
 
     def process_tag_recommendation_data(self,
                                         resources_limit=None,
@@ -288,17 +271,20 @@ class RecommendationDataProcessor:
         except Exception as e:
             resource_class = dict()
 
-        for count, id in enumerate(instances_ids):
-            if not recompute_all_classes:
-                if id not in resource_class:
-                    resource_class[id] = cd.detectCommunity(input_tags=resources_tags[id])
-            else:
-                resource_class[id] = cd.detectCommunity(input_tags=resources_tags[id])
+        if recompute_all_classes:
+            ids_to_classify = instances_ids
+        else:
+            ids_to_classify = [id for id in instances_ids if id not in resource_class]
 
+        def print_progress(n_classified):
             if self.verbose:
-                sys.stdout.write("\rClassifying resources... %.2f%%"%(float(100*(count+1))/len(instances_ids)))
+                sys.stdout.write("\rClassifying resources... %.2f%%" % (float(100 * n_classified) / len(ids_to_classify)))
                 sys.stdout.flush()
 
+        communities = cd.detectCommunities([resources_tags[id] for id in ids_to_classify],
+                                           progress_callback=print_progress)
+        resource_class.update(zip(ids_to_classify, communities))
+
         print ""
         saveToJson(RECOMMENDATION_DATA_DIR + 'Classifier_classified_resources.json', resource_class)
         print ""
@@ -313,14 +299,14 @@ class RecommendationDataProcessor:
         )
 
         print "\nComputing data for class recommenders..."
-        instance_id_class = []
+        class_instance_ids = dict()
         distinct_classes = []
-        for count, instance_id in enumerate(instances_ids):
+        for instance_id in instances_ids:
             class_id = resource_class[instance_id]
-            instance_id_class.append([instance_id, class_id])
-
-            if class_id not in distinct_classes:
+            if class_id not in class_instance_ids:
+                class_instance_ids[class_id] = []
                 distinct_classes.append(class_id)
+            class_instance_ids[class_id].append(instance_id)
 
         print distinct_classes
 
@@ -329,10 +315,7 @@ class RecommendationDataProcessor:
 
             # All resources from the training set classified as the selected category
             # (instead of all manually labeled)
-            training_ids = []
-            for instance in instance_id_class:
-                if instance[1] == collection_id:
-                    training_ids.append(instance[0])
+            training_ids = class_instance_ids[collection_id]
             # Add limit
             training_ids = training_ids[0:resources_limit]
 
@@ -18,7 +18,13 @@
 #     See AUTHORS file.
 #
 
+from collections import OrderedDict
+
 from heuristics import heuristics
+from tag_recommendation_utils import prepare_data, get_most_similar_tags
+
+# Number of tag sets whose state (most similar tags of every tag and recommended tags) is cached by a recommender
+TAG_SET_CACHE_SIZE = 2000
 
 
 class TagRecommender:
@@ -28,13 +34,15 @@ class TagRecommender:
     data = None
     dataset = None
     metric = None
+    tag_set_cache = None
+    tag_set_cache_size = TAG_SET_CACHE_SIZE
 
     def __init__(self):
         self.set_heuristic()
 
     def __repr__(self):
         if self.data:
-            size = self.data['SIMILARITY_MATRIX'].shape[0]
+            size = len(self.data['TAG_NAMES'])
         else:
             size = -1
 
@@ -48,11 +56,44 @@ class TagRecommender:
             self.heuristic = heuristic
         else:
             raise Exception("Wrong heuristic given")
+        self.tag_set_cache = OrderedDict()
 
     def load_data(self, dataset=None, metric=None, data=None):
+        # Data must include 'TAG_NAMES' and either the precomputed most similar tags table ('MOST_SIMILAR_IDX' and
+        # 'MOST_SIMILAR_DIST') or the 'SIMILARITY_MATRIX' to compute it. The heuristic must be set before loading data.
+        if data is not None:
+            data = prepare_data(data, self.heuristic['options']['cNMostSimilar_N'])
         self.data = data
         self.dataset = dataset
         self.metric = metric
+        self.tag_set_cache = OrderedDict()
+
+    def get_tag_set_state(self, input_tags):
+        """Returns the cached state of a set of tags (a dictionary with the most similar tags of every tag and the
+        recommended tags for the order in which the tags were given), creating it if it is not cached. While describing
+        a sound tags are added one by one, so when a set is not cached the set without one of its tags usually is, and
+        only the most similar tags of the added tag are looked up. The candidate tags and their aggregation are
+        recomputed from the cached most similar tags, as ranks depend on all the input tags."""
+        key = frozenset(input_tags)
+        state = self.tag_set_cache.pop(key, None)
+        if state is None:
+            N = self.heuristic['options']['cNMostSimilar_N']
+            most_similar_tags = None
+            for tag in key:
+                subset_state = self.tag_set_cache.get(key - frozenset([tag]), None)
+                if subset_state is not None:
+                    most_similar_tags = dict(subset_state['most_similar_tags'])
+                    most_similar_tags[tag] = get_most_similar_tags(tag, self.data, N)
+                    break
+            if most_similar_tags is None:
+                most_similar_tags = {tag: get_most_similar_tags(tag, self.data, N) for tag in key}
+            state = {'most_similar_tags': most_similar_tags, 'input_tags': None, 'recommended_tags': None}
+
+        # Keep the state as the most recently used one and remove the least recently used ones
+        self.tag_set_cache[key] = state
+        while len(self.tag_set_cache) > self.tag_set_cache_size:
+            self.tag_set_cache.popitem(last=False)
+        return state
 
     def recommend_tags(self, input_tags=None):
 
@@ -63,13 +104,18 @@ class TagRecommender:
         if not self.data:
             raise Exception("No data has been loaded (use 'load_data()')")
 
+        state = self.get_tag_set_state(input_tags)
+        if state['input_tags'] == tuple(input_tags):
+            return list(state['recommended_tags'])
+
         # Prepare variables
         chooseAlgorithm = self.heuristic['c']
         aggregateAlgorithm = self.heuristic['a']
         selectAlgorithm = self.heuristic['s']
 
         # CHOOSE candidate tags
-        candidate_tags = chooseAlgorithm(input_tags, self.data['TAG_NAMES'], self.data['SIMILARITY_MATRIX'], self.heuristic['options'])
+        candidate_tags = chooseAlgorithm(input_tags, self.data, self.heuristic['options'],
+                                         most_similar_tags=state['most_similar_tags'])
 
         # AGGREGATE candidate tags
         aggregated_candiate_tags, aggregated_candiate_tags_list = aggregateAlgorithm(candidate_tags, input_tags, self.heuristic['options'])
@@ -84,7 +130,9 @@ class TagRecommender:
             else:
                 added_tags = list()
 
-        return added_tags
+        state['input_tags'] = tuple(input_tags)
+        state['recommended_tags'] = added_tags
+        return list(added_tags)
 
 
 
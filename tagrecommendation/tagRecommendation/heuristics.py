@@ -22,4 +22,7 @@ from tag_recommendation_utils import *
 
 heuristics = {
     'hRankPercentage015': {'name':'RankP@0.15','c':cNMostSimilar, 'a':aNormalizedRankSum,'s':sPercentage, 'options':{'cNMostSimilar_N':100, 'aNormalizedRankSum_factor':1.0, 'sPercentage_percentage': 0.15}},
-}
\ No newline at end of file
+}
+
+# Number of most similar tags per tag which are precomputed when generating the similarity matrices
+MOST_SIMILAR_TABLE_SIZE = max([heuristic['options']['cNMostSimilar_N'] for heuristic in heuristics.values()])
@@ -21,29 +21,72 @@
 
 import operator
 from numpy import *
-
-
-def cNMostSimilar(input_tags, tag_names, similarity_matrix, options):
+from utils import CSRMatrix
+
+
+def build_tag_index(tag_names):
+    """Returns a dictionary mapping (unicode) tag names to their position in tag_names"""
+    tag_index = dict()
+    for idx, tag in enumerate(tag_names):
+        tag_index.setdefault(tag.decode('utf-8'), idx)
+    return tag_index
+
+
+def build_most_similar_table(similarity_matrix, N):
+    """Returns two (n_tags x N) arrays with the indices of the N most similar tags of every tag (sorted by similarity)
+    and the corresponding similarities. Rows are padded with -1 indices if a tag has less than N similar tags. The
+    most similar entry of every row (the tag itself) is not included. This is computed when generating the similarity
+    matrices (CSRMatrix) so that recommendation requests do not need to sort full rows of the similarity matrix."""
+    n_tags = similarity_matrix.shape[0]
+    most_similar_idx = -ones((n_tags, N), dtype='int32')
+    most_similar_dist = zeros((n_tags, N), dtype=similarity_matrix.data.dtype)
+    for idx in range(0, n_tags):
+        row_idx, row = similarity_matrix.row(idx)
+        most_similar = row.argsort()[-N-1:-1][::-1]
+        most_similar_idx[idx, :len(most_similar)] = row_idx[most_similar]
+        most_similar_dist[idx, :len(most_similar)] = row[most_similar]
+    return most_similar_idx, most_similar_dist
+
+
+def prepare_data(data, N):
+    """Adds the tag index and the most similar tags table (if it was not loaded or it has less than N columns) to the
+    data of a recommender. The 'SIMILARITY_MATRIX' to compute the table can be a CSRMatrix or a dense array."""
+    if 'TAG_INDEX' not in data:
+        data['TAG_INDEX'] = build_tag_index(data['TAG_NAMES'])
+    if 'MOST_SIMILAR_IDX' not in data or data['MOST_SIMILAR_IDX'].shape[1] < N:
+        similarity_matrix = data['SIMILARITY_MATRIX']
+        if not isinstance(similarity_matrix, CSRMatrix):
+            similarity_matrix = CSRMatrix.from_dense(similarity_matrix)
+        data['MOST_SIMILAR_IDX'], data['MOST_SIMILAR_DIST'] = build_most_similar_table(similarity_matrix, N)
+    return data
+
+
+def get_most_similar_tags(tag, data, N):
+    """Returns the names and similarities of the N most similar tags of a tag (from the precomputed table), or None if
+    the tag does not exist in the tag matrix"""
+    idx = data['TAG_INDEX'].get(tag, None)
+    if idx is None:
+        return None
+    most_similar_idx = data['MOST_SIMILAR_IDX'][idx, :N]
+    n_similar = count_nonzero(most_similar_idx >= 0)
+    return data['TAG_NAMES'][most_similar_idx[:n_similar]], array(data['MOST_SIMILAR_DIST'][idx, :n_similar])
+
+
+def cNMostSimilar(input_tags, data, options, most_similar_tags=None):
+    # most_similar_tags is an optional dictionary with the result of get_most_similar_tags for every input tag (see
+    # TagRecommender.recommend_tags), if not given these are looked up in the precomputed table
 
     N = options['cNMostSimilar_N']
-    unicode_tag_names = [t.decode('utf-8') for t in tag_names]
+    if most_similar_tags is None:
+        most_similar_tags = {tag: get_most_similar_tags(tag, data, N) for tag in input_tags}
     candidate_tags = []
     for tag in input_tags:
         # Check that tag exists in the tag matrix, if it does not exist we cannot recommend similar tags
-        if tag in unicode_tag_names:
-            # Find N most similar tags in the row
-            idx = unicode_tag_names.index(tag)
-            #where(tag_names == tag)[0][0]
-            row_idx = nonzero(similarity_matrix[idx,:])
-            row_idx = row_idx[0]
-            row = similarity_matrix[idx,row_idx]
-            MAX = N
-            most_similar_idx = row.argsort()[-MAX-1:-1][::-1] # We pick the first N most similar tags (practically the same as no threshold but more efficient)
-            most_similar_dist = row[most_similar_idx]
-            most_similar_tags = tag_names[row_idx[most_similar_idx]]
+        if most_similar_tags[tag] is not None:
+            tag_most_similar_tags, most_similar_dist = most_similar_tags[tag]
 
             rank = N
-            for count,item in enumerate(most_similar_tags):
+            for count,item in enumerate(tag_most_similar_tags):
                 if item not in input_tags:
                     candidate_tags.append( {'name':item, 'rank':rank, 'dist':most_similar_dist[count], 'from':tag} )
                     rank -= 1
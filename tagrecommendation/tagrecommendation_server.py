@@ -35,7 +35,7 @@ from twisted.web import server, resource
 
 from communityBasedTagRecommendation import CommunityBasedTagRecommender
 import tagrecommendation_settings as tr_settings
-from utils import loadFromJson, saveToJson
+from utils import loadFromJson, read_request_body, TagAssignmentIndex
 
 
 def server_interface(resource):
@@ -47,10 +47,18 @@ def server_interface(resource):
     }
 
 
+def server_post_interface(resource):
+    return {
+        'add_to_index_bulk': resource.add_to_index_bulk,  # request body: JSON list of [sound_id, [tags]] pairs
+        'recommend_tags_many': resource.recommend_tags_many,  # request body: JSON list of lists of tags, max_number_of_tags (optional)
+    }
+
+
 class TagRecommendationServer(resource.Resource):
     def __init__(self):
         resource.Resource.__init__(self)
         self.methods = server_interface(self)
+        self.post_methods = server_post_interface(self)
         self.isLeaf = False
 
         self.load()
@@ -79,15 +87,20 @@ class TagRecommendationServer(resource.Resource):
                 'n_sounds_in_matrix': 0,
             }
 
+        if getattr(self, 'index', None) is not None:
+            self.index.close()
         try:
-            self.index = loadFromJson(tr_settings.RECOMMENDATION_DATA_DIR, 'Index.json')
-            self.index_stats['biggest_id_in_index'] = max([int(key) for key in self.index.keys()])
-            self.index_stats['n_sounds_in_index'] = len(self.index.keys())
+            self.index = TagAssignmentIndex(tr_settings.RECOMMENDATION_DATA_DIR + 'Index.json',
+                                            compaction_threshold=tr_settings.INDEX_LOG_COMPACTION_THRESHOLD).load()
         except Exception as e:
-            logger.error("Index file not present. Listening for indexing data from appservers.")
-            self.index_stats['biggest_id_in_index'] = 0
-            self.index_stats['n_sounds_in_index'] = 0
-            self.index = dict()
+            # Unreadable files are kept aside (and not overwritten by the new index) so their data can be recovered
+            self.index = TagAssignmentIndex(tr_settings.RECOMMENDATION_DATA_DIR + 'Index.json',
+                                            compaction_threshold=tr_settings.INDEX_LOG_COMPACTION_THRESHOLD)
+            moved_paths = self.index.move_files_aside()
+            logger.error("Index file could not be loaded (%s), moved to %s. Listening for indexing data from "
+                         "appservers." % (e, ', '.join(moved_paths)))
+        self.index_stats['biggest_id_in_index'] = self.index.biggest_id
+        self.index_stats['n_sounds_in_index'] = len(self.index)
 
     def error(self,message):
         return json.dumps({'Error': message})
@@ -98,6 +111,9 @@ class TagRecommendationServer(resource.Resource):
     def render_GET(self, request):
         return self.methods[request.prepath[1]](**request.args)
 
+    def render_POST(self, request):
+        return self.post_methods[request.prepath[1]](read_request_body(request), **request.args)
+
     def recommend_tags(self, input_tags, max_number_of_tags=None):
 
         try:
@@ -115,6 +131,23 @@ class TagRecommendationServer(resource.Resource):
 
         return json.dumps(result)
 
+    def recommend_tags_many(self, data, max_number_of_tags=None):
+
+        try:
+            input_tags_list = json.loads(data)
+            logger.info('Getting recommendation for %i sets of input tags' % len(input_tags_list))
+            if max_number_of_tags:
+                max_number_of_tags = int(max_number_of_tags[0])
+            recommendations = self.cbtr.recommend_tags_many(input_tags_list, max_number_of_tags=max_number_of_tags)
+            result = {'error': False, 'result': [{'tags': recommended_tags, 'community': com_name}
+                                                 for recommended_tags, com_name in recommendations]}
+
+        except Exception as e:
+            logger.error('Errors occurred while recommending tags to several sets of input tags (%s)' % e)
+            result = {'error': True, 'result': str(e)}
+
+        return json.dumps(result)
+
     def reload(self):
         logger.info('Reloading tagrecommendation server...')
         self.load()
@@ -134,17 +167,28 @@ class TagRecommendationServer(resource.Resource):
         sound_tags = [stags.split(",") for stags in sound_tagss[0].split("-!-!-")]
         logger.info('Adding %i sounds to recommendation index' % len(sound_ids))
 
-        for count, sound_id in enumerate(sound_ids):
-            sid = sound_id
-            stags = sound_tags[count]
-            self.index[sid] = stags
-
-        if len(self.index.keys()) % 1000 == 0:
-            # Every 1000 indexed sounds, save the index
-            logger.info('Saving tagrecommendation index...')
-            saveToJson(tr_settings.RECOMMENDATION_DATA_DIR + 'Index.json', self.index, verbose=False)
-            self.index_stats['biggest_id_in_index'] = max([int(key) for key in self.index.keys()])
-            self.index_stats['n_sounds_in_index'] = len(self.index.keys())
+        # Records are appended to the index log and fsynced before answering, the index is compacted into a new
+        # snapshot every INDEX_LOG_COMPACTION_THRESHOLD records
+        self.index.add(sound_ids, sound_tags)
+        self.index_stats['biggest_id_in_index'] = self.index.biggest_id
+        self.index_stats['n_sounds_in_index'] = len(self.index)
+
+        result = {'error': False, 'result': True}
+        return json.dumps(result)
+
+    def add_to_index_bulk(self, data):
+        try:
+            sound_tags = json.loads(data)
+            sound_ids = [str(int(sound_id)) for sound_id, tags in sound_tags]
+            sound_tagss = [tags for sound_id, tags in sound_tags]
+        except (ValueError, TypeError) as e:
+            logger.error('Invalid data posted to add_to_index_bulk (%s)' % e)
+            return json.dumps({'error': True, 'result': 'Invalid data, a JSON list of [sound_id, tags] was expected'})
+        logger.info('Adding %i sounds to recommendation index' % len(sound_ids))
+
+        self.index.add(sound_ids, sound_tagss)
+        self.index_stats['biggest_id_in_index'] = self.index.biggest_id
+        self.index_stats['n_sounds_in_index'] = len(self.index)
 
         result = {'error': False, 'result': True}
         return json.dumps(result)
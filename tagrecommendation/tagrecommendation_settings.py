@@ -26,6 +26,8 @@ LOGFILE = '/var/log/freesound/tagrecommendation.log'
 LISTEN_PORT = 8010
 RECOMMENDATION_DATA_DIR = '/freesound-data/tag_recommendation_models/'
 RECOMMENDATION_TMP_DATA_DIR = os.path.join(RECOMMENDATION_DATA_DIR, 'tmp')
+# Number of records in Index.log after which the index is compacted into a new Index.json snapshot
+INDEX_LOG_COMPACTION_THRESHOLD = 100000
 
 # Graylog GELF endpoint
 LOGSERVER_IP_ADDRESS = 'IP_ADDRESS'
@@ -48,16 +50,21 @@ LOG_TO_FILE = False
 # Having this classifier the recommendation server can be started. Once the server is running
 # a command from the appservers must be run so the recomendation is feeded with tag assignement data
 # from freesound which is stored in a file called Index.json. This fille incrementally stores
-# all tag assingment information from freesound. Once this file exists and has some data, the
+# all tag assingment information from freesound (newly indexed sounds are first appended to Index.log and
+# periodically compacted into Index.json). Once this file exists and has some data, the
 # "update_tagrecommendation_data.py" script can be run and will generate the following files:
 # (if running in Docker environment, you can run the script like:
 # docker-compose run tagrecommendation  bash -c "cd /code; python update_tagrecommendation_data.py"
 #
 # For every class used:
-#   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET.npy
+#   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_CSR_DATA.npy      (similarity matrix in CSR format)
+#   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_CSR_INDICES.npy
+#   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_CSR_INDPTR.npy
 #   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_TAG_NAMES.npy
+#   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_MOST_SIMILAR_IDX.npy   (precomputed most similar tags)
+#   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_MOST_SIMILAR_DIST.npy
 # Example:
-#   FREESOUND2012_CFX_SIMILARITY_MATRIX_cosine_SUBSET.npy
+#   FREESOUND2012_CFX_SIMILARITY_MATRIX_cosine_SUBSET_CSR_DATA.npy
 #   FREESOUND2012_CFX_SIMILARITY_MATRIX_cosine_SUBSET_TAG_NAMES.npy
 #   ...
 #
@@ -0,0 +1,114 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+from django.test import SimpleTestCase
+
+# The tag recommendation server module is not imported as it depends on packages only installed in the tag
+# recommendation service (twisted, scikit-learn)
+from tagrecommendation.utils import read_request_body, TagAssignmentIndex
+
+
+class TagAssignmentIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.snapshot_path = os.path.join(self.data_dir, 'Index.json')
+
+    def test_add_load_and_compact(self):
+        index = TagAssignmentIndex(self.snapshot_path, compaction_threshold=3)
+        index.add(['1', '2'], [['piano'], ['field-recording', 'birds']])
+        index.close()
+        self.assertFalse(os.path.exists(self.snapshot_path))
+
+        # Records are replayed from the log
+        index = TagAssignmentIndex(self.snapshot_path, compaction_threshold=3).load()
+        self.assertEqual(dict(index.items()), {'1': ['piano'], '2': ['field-recording', 'birds']})
+        self.assertEqual(index.biggest_id, 2)
+
+        # The log is compacted into the snapshot when it reaches compaction_threshold records
+        index.add(['7'], [['drum']])
+        index.close()
+        self.assertEqual(json.load(open(self.snapshot_path)),
+                         {'1': ['piano'], '2': ['field-recording', 'birds'], '7': ['drum']})
+        self.assertEqual(os.path.getsize(index.log_path), 0)
+        index = TagAssignmentIndex(self.snapshot_path, compaction_threshold=3).load()
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.biggest_id, 7)
+        index.close()
+
+    def test_load_ignores_interrupted_write(self):
+        index = TagAssignmentIndex(self.snapshot_path)
+        index.add(['1'], [['piano']])
+        index.close()
+        with open(index.log_path, 'a') as f:
+            f.write('["2", ["dr')
+
+        index = TagAssignmentIndex(self.snapshot_path).load()
+        self.assertEqual(dict(index.items()), {'1': ['piano']})
+        # The incomplete record is overwritten by the next write
+        index.add(['3'], [['birds']])
+        index.close()
+        self.assertEqual(dict(TagAssignmentIndex(self.snapshot_path).load().items()),
+                         {'1': ['piano'], '3': ['birds']})
+
+
+    def test_unreadable_files_are_not_overwritten(self):
+        index = TagAssignmentIndex(self.snapshot_path, compaction_threshold=2)
+        index.add(['1'], [['piano']])
+        index.close()
+        with open(self.snapshot_path, 'w') as f:
+            f.write('{"corrupt')
+        log_content = open(index.log_path).read()
+
+        index = TagAssignmentIndex(self.snapshot_path, compaction_threshold=2)
+        with self.assertRaises(ValueError):
+            index.load()
+        # Writes are refused until the files are loaded or moved aside, so the log is not truncated
+        with self.assertRaises(IOError):
+            index.add(['2'], [['drum']])
+        self.assertEqual(open(index.log_path).read(), log_content)
+
+        moved_paths = index.move_files_aside()
+        self.assertEqual(len(moved_paths), 2)
+        self.assertEqual(open([path for path in moved_paths if '.log' in path][0]).read(), log_content)
+        index.add(['2', '3'], [['drum'], ['birds']])
+        index.close()
+        self.assertEqual(json.load(open(self.snapshot_path)), {'2': ['drum'], '3': ['birds']})
+
+
+class ReadRequestBodyTest(SimpleTestCase):
+
+    def test_read_big_request_body(self):
+        body = json.dumps([[sound_id, ['tag%i' % i for i in range(10)]] for sound_id in range(1, 2001)])
+        self.assertGreater(len(body), 100 * 1024)
+
+        # Twisted stores request bodies bigger than 100000 bytes in a temporary file (not in a StringIO) and the file
+        # position might be at the end of the written data
+        content = tempfile.TemporaryFile()
+        self.addCleanup(content.close)
+        content.write(body)
+        self.assertEqual(read_request_body(mock.Mock(content=content)), body)
@@ -19,7 +19,9 @@
 #
 
 import json
-from numpy import zeros
+import os
+import time
+from numpy import zeros, lexsort, bincount, cumsum, load, save
 import sys
 
 
@@ -35,6 +37,12 @@ def saveToJson(path="", data="", verbose=True):
             print "Saving data to '" + path + "'"
         json.dump(data,f,indent=4)
 
+def read_request_body(request):
+    """Returns the body of a twisted request. Twisted stores big request bodies in a temporary file instead of a
+    StringIO, so the content is read as a file."""
+    request.content.seek(0)
+    return request.content.read()
+
 def mtx2npy(M, verbose = True):
     n = M.shape[0]
     m = M.shape[1]
@@ -57,3 +65,161 @@ def mtx2npy(M, verbose = True):
         sys.stdout.flush()
     return npy
 
+
+class CSRMatrix(object):
+    """
+    Square sparse matrix in compressed sparse row format (same layout as scipy.sparse.csr_matrix: the column indices
+    and values of row i are indices[indptr[i]:indptr[i + 1]] and data[indptr[i]:indptr[i + 1]], with column indices
+    sorted). The arrays are saved to separate .npy files so that they can be opened with numpy.load(mmap_mode='r'),
+    which makes loading instantaneous and allows processes to share the memory of the matrix.
+    """
+
+    def __init__(self, data, indices, indptr):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.shape = (len(indptr) - 1, len(indptr) - 1)
+
+    def row(self, idx):
+        """Returns the column indices and values of the non-zero elements of a row"""
+        start, end = self.indptr[idx], self.indptr[idx + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def save(self, path):
+        save(path + '_DATA.npy', self.data)
+        save(path + '_INDICES.npy', self.indices)
+        save(path + '_INDPTR.npy', self.indptr)
+
+    @staticmethod
+    def exists(path):
+        return all([os.path.exists(path + suffix) for suffix in ['_DATA.npy', '_INDICES.npy', '_INDPTR.npy']])
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        return cls(load(path + '_DATA.npy', mmap_mode=mmap_mode),
+                   load(path + '_INDICES.npy', mmap_mode=mmap_mode),
+                   load(path + '_INDPTR.npy', mmap_mode=mmap_mode))
+
+    @classmethod
+    def from_coordinates(cls, n, rows, cols, values):
+        """Creates a matrix from the coordinates and values of its non-zero elements"""
+        order = lexsort((cols, rows))
+        indptr = zeros(n + 1, 'int64')
+        indptr[1:] = cumsum(bincount(rows, minlength=n))
+        return cls(values[order], cols[order], indptr)
+
+    @classmethod
+    def from_dense(cls, M):
+        rows, cols = M.nonzero()
+        return cls.from_coordinates(M.shape[0], rows.astype('int32'), cols.astype('int32'), M[rows, cols])
+
+
+
+class TagAssignmentIndex(object):
+    """
+    Index of the tags assigned to every sound (sound_id -> list of tags) that is persisted as a JSON snapshot (the
+    Index.json file read by the RecommendationDataProcessor) plus an append-only log with one JSON record
+    [sound_id, tags] per line (Index.log). Every call to add() appends its records to the log and fsyncs it, so indexed
+    data survives a crash and the cost of indexing is proportional to the size of the batch. When the log has
+    compaction_threshold records, the whole index is written to a new snapshot and the log is truncated.
+
+    Writes are only accepted once the existing files have been loaded with load() (or moved aside with
+    move_files_aside() if they can not be loaded), so a log which was not replayed is never truncated.
+    """
+
+    def __init__(self, snapshot_path, compaction_threshold=100000):
+        self.snapshot_path = snapshot_path
+        self.log_path = os.path.splitext(snapshot_path)[0] + '.log'
+        self.compaction_threshold = compaction_threshold
+        self.index = dict()
+        self.biggest_id = 0
+        self.n_log_records = 0
+        self._log_size = None  # Size of the valid part of the log, unknown until the log is loaded
+        self._log_file = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def items(self):
+        return self.index.items()
+
+    def load(self):
+        """Loads the snapshot and replays the log on top of it"""
+        self.close()
+        self.index = loadFromJson(self.snapshot_path) if os.path.exists(self.snapshot_path) else dict()
+        self.n_log_records = 0
+        self._log_size = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r') as f:
+                while True:
+                    line = f.readline()
+                    if not line.endswith('\n'):
+                        # End of file or last record of an interrupted write (ignored, it will be overwritten)
+                        break
+                    try:
+                        sound_id, tags = json.loads(line)
+                    except ValueError:
+                        break
+                    self.index[sound_id] = tags
+                    self.n_log_records += 1
+                    self._log_size += len(line)
+        self.biggest_id = max([int(key) for key in self.index]) if self.index else 0
+        return self
+
+    def move_files_aside(self):
+        """Renames the snapshot and log files (e.g. because they could not be loaded) so that they are kept for
+        inspection, and empties the index. Returns the new paths of the moved files."""
+        self.close()
+        suffix = '.unreadable-%s' % time.strftime('%Y%m%d%H%M%S')
+        moved_paths = []
+        for path in [self.snapshot_path, self.log_path]:
+            if os.path.exists(path):
+                os.rename(path, path + suffix)
+                moved_paths.append(path + suffix)
+        self.index = dict()
+        self.biggest_id = 0
+        self.n_log_records = 0
+        self._log_size = 0
+        return moved_paths
+
+    def add(self, sound_ids, sound_tagss):
+        if self._log_size is None:
+            if os.path.exists(self.snapshot_path) or os.path.exists(self.log_path):
+                raise IOError('Index files in %s have not been loaded' % os.path.dirname(self.snapshot_path))
+            self._log_size = 0
+        if self._log_file is None:
+            self._log_file = open(self.log_path, 'a')
+            self._log_file.truncate(self._log_size)
+        lines = ''.join([json.dumps([str(sound_id), tags]) + '\n' for sound_id, tags in zip(sound_ids, sound_tagss)])
+        self._log_file.write(lines)
+        self._log_file.flush()
+        os.fsync(self._log_file.fileno())
+        self._log_size += len(lines)
+        self.n_log_records += len(sound_ids)
+
+        for sound_id, tags in zip(sound_ids, sound_tagss):
+            self.index[str(sound_id)] = tags
+        if sound_ids:
+            self.biggest_id = max(self.biggest_id, max([int(sound_id) for sound_id in sound_ids]))
+
+        if self.n_log_records >= self.compaction_threshold:
+            self.compact()
+
+    def compact(self):
+        """Writes the whole index to a new snapshot and empties the log"""
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.snapshot_path)
+        # If the process stops before the log is truncated, replaying it over the new snapshot gives the same index
+        self.close()
+        open(self.log_path, 'w').close()
+        self.n_log_records = 0
+        self._log_size = 0
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
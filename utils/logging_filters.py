@@ -35,7 +35,9 @@ class GenericDataFilter(logging.Filter):
 class APILogsFilter(logging.Filter):
 
     def filter(self, record):
-        message = record.getMessage().encode('utf8')
+        message = record.getMessage()
+        if isinstance(message, unicode):
+            message = message.encode('utf8')
         try:
             (message, data, info) = message.split(' #!# ')
             if ':' in message:
@@ -0,0 +1,115 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import Queue
+import logging
+import os
+import threading
+
+
+class QueueHandler(logging.Handler):
+    """
+    Handler that puts log records in a bounded in-process queue which is consumed by a background thread. The thread
+    passes the records to the handlers of 'target_logger', so filtering, formatting and sending the records (e.g. to
+    graylog) happens outside of the thread that logs them. Records keep the name of the logger they were logged with.
+
+    If the queue is full, records are dropped instead of blocking the logging thread. The number of dropped records is
+    available in 'dropped' and is also reported with a warning through the target logger once the queue has room again.
+
+    Example configuration:
+
+        'handlers': {
+            'api_queue': {
+                'class': 'utils.logging_handlers.QueueHandler',
+                'target_logger': 'api_emit',
+            },
+        },
+        'loggers': {
+            'api': {'handlers': ['api_queue'], 'propagate': False},
+            'api_emit': {'handlers': ['graylog'], 'propagate': False},
+        }
+    """
+
+    def __init__(self, target_logger, capacity=10000):
+        logging.Handler.__init__(self)
+        self.target_logger = logging.getLogger(target_logger)
+        self.queue = Queue.Queue(maxsize=capacity)
+        self.enqueued = 0
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.thread = None
+        self.pid = None
+        # Guards the start of the consumer thread and the updates of the counters, emit() can be called concurrently
+        # from several threads
+        self.thread_lock = threading.Lock()
+        self.counters_lock = threading.Lock()
+
+    def ensure_thread(self):
+        # The thread is started lazily (and started again in forked processes, where it does not exist) so that
+        # records logged by web server workers are consumed in the worker process
+        if self.thread is None or self.pid != os.getpid():
+            with self.thread_lock:
+                # Check again, another thread might have started the consumer while waiting for the lock
+                if self.thread is None or self.pid != os.getpid():
+                    self.queue = Queue.Queue(maxsize=self.queue.maxsize)
+                    self.thread = threading.Thread(target=self.consume,
+                                                   name='logging-queue-%s' % self.target_logger.name)
+                    self.thread.daemon = True
+                    self.thread.start()
+                    # pid is set last so other threads do not use the queue before the consumer is started
+                    self.pid = os.getpid()
+
+    def emit(self, record):
+        self.ensure_thread()
+        try:
+            self.queue.put_nowait(record)
+            with self.counters_lock:
+                self.enqueued += 1
+        except Queue.Full:
+            with self.counters_lock:
+                self.dropped += 1
+
+    def consume(self):
+        queue = self.queue
+        while True:
+            record = queue.get()
+            try:
+                if record is None:
+                    return
+                self.target_logger.handle(record)
+                if self.dropped != self.reported_dropped:
+                    self.target_logger.warning('Logging queue was full, %i log records dropped so far' % self.dropped)
+                    self.reported_dropped = self.dropped
+            except Exception:
+                self.handleError(record)
+            finally:
+                queue.task_done()
+
+    def flush(self):
+        """Waits until all the records in the queue have been passed to the target handlers"""
+        if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+            self.queue.join()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+        self.thread = None
+        logging.Handler.close(self)
@@ -30,13 +30,16 @@ from utils.encryption import create_hash
 
 web_logger = logging.getLogger('web')
 
+# Maximum number of sounds included in a single request to get sound descriptors from the similarity service
+SIMILARITY_DESCRIPTORS_MAX_SOUNDS_PER_REQUEST = 50
+
 
 def get_similar_sounds(sound, preset=DEFAULT_PRESET, num_results=settings.SOUNDS_PER_PAGE, offset=0):
 
     if preset not in PRESETS:
         preset = DEFAULT_PRESET
 
-    cache_key = "similar-for-sound-%s-%s-%i" % (sound.id, preset, offset)
+    cache_key = get_similar_sounds_cache_key(sound.id, preset, offset)
 
     # Don't use the cache when we're debugging
     if settings.DEBUG:
@@ -69,13 +72,76 @@ def get_similar_sounds(sound, preset=DEFAULT_PRESET, num_results=settings.SOUNDS
     return similar_sounds[0:num_results], count
 
 
+def get_similar_sounds_many(sound_ids, preset=DEFAULT_PRESET, num_results=settings.SOUNDS_PER_PAGE, offset=0):
+    """Gets similar sounds for a list of sounds using at most one request to the similarity service.
+
+    Results are first looked up in the cache using the same per-sound cache keys as `get_similar_sounds` (with a
+    single `cache.get_many` call), and only the sounds not found in the cache are sent to the similarity service in a
+    single `Similarity.search_many` request. This is meant for pages and API clients needing similar sounds for
+    several sounds at once. With the PCA preset `search_many` ranks the whole PCA index exactly, so single sound
+    requests should keep using `get_similar_sounds`, which can use the approximate index of the similarity service.
+
+    Args:
+        sound_ids (List[int]): IDs of the sounds for which to get similar sounds.
+        preset (str): similarity preset to use.
+        num_results (int): maximum number of similar sounds to return for each sound.
+        offset (int): offset of the first similar sound to return.
+
+    Returns:
+        Dict[int, Tuple(List[List[int, float]], int)]: dictionary with one entry per sound ID containing a tuple with
+            a list of [sound_id, distance] pairs for the similar sounds and the total number of similar sounds. Sounds
+            that could not be found in the similarity service get an empty list and a count of 0.
+    """
+    if preset not in PRESETS:
+        preset = DEFAULT_PRESET
+
+    sound_ids = [int(sound_id) for sound_id in sound_ids]
+    cache_keys = {get_similar_sounds_cache_key(sound_id, preset, offset): sound_id for sound_id in sound_ids}
+
+    # Don't use the cache when we're debugging
+    if settings.DEBUG:
+        results = dict()
+    else:
+        results = {cache_keys[key]: result for key, result in cache.get_many(cache_keys.keys()).items() if result}
+
+    not_cached_sound_ids = [sound_id for sound_id in sound_ids if sound_id not in results]
+    if not_cached_sound_ids:
+        try:
+            returned_results = Similarity.search_many(
+                not_cached_sound_ids, preset=preset, num_results=num_results, offset=offset)
+        except Exception as e:
+            web_logger.error('Could not get a response from the similarity service (%s)\n\t%s' % \
+                             (e, traceback.format_exc()))
+            returned_results = dict()
+
+        returned_results = {int(sound_id): result for sound_id, result in returned_results.items()}
+        results.update(returned_results)
+        if returned_results:
+            cache.set_many({get_similar_sounds_cache_key(sound_id, preset, offset): result
+                            for sound_id, result in returned_results.items()}, SIMILARITY_CACHE_TIME)
+
+    similar_sounds = dict()
+    for sound_id in sound_ids:
+        if sound_id in results:
+            result = results[sound_id]
+            similar_sounds[sound_id] = ([[int(x[0]), float(x[1])] for x in result['results']][0:num_results],
+                                        result['count'])
+        else:
+            similar_sounds[sound_id] = ([], 0)
+    return similar_sounds
+
+
+def get_similar_sounds_cache_key(sound_id, preset, offset):
+    return "similar-for-sound-%s-%s-%i" % (sound_id, preset, offset)
+
+
 def api_search(target=None, filter=None, preset=None, metric_descriptor_names=None, num_results=None, offset=None, target_file=None, in_ids=None):
 
     cache_key = 'api-search-t-%s-f-%s-nr-%s-o-%s' % (str(target).replace(" ", ""), str(filter).replace(" ", ""), num_results, offset)
     cache_key = hash_cache_key(cache_key)
     note = False
     if in_ids:
-        in_ids = ','.join([str(sid) for sid in in_ids if sid])
+        in_ids = [sid for sid in in_ids if sid]
 
     # Don't use the cache when we're debugging
     if settings.DEBUG or len(cache_key) >= 250 or in_ids:
@@ -126,32 +192,118 @@ def api_search(target=None, filter=None, preset=None, metric_descriptor_names=No
 
 
 def get_sounds_descriptors(sound_ids, descriptor_names, normalization=True, only_leaf_descriptors=False):
-    cache_key = "analysis-sound-id-%s-descriptors-%s-normalization-%s"
-
-    cached_data = {}
-    # Check if at least some sound analysis data is already on cache
-    not_cached_sound_ids = sound_ids[:]
-    for id in sound_ids:
-        analysis_data = cache.get(hash_cache_key(cache_key % (str(id), ",".join(sorted(descriptor_names)), str(normalization))))
-        if analysis_data:
-            cached_data[unicode(id)] = analysis_data
-            # remove id form list so it is not included in similarity request
-            not_cached_sound_ids.remove(id)
-    try:
-        returned_data = Similarity.get_sounds_descriptors(not_cached_sound_ids, descriptor_names, normalization, only_leaf_descriptors)
-    except Exception as e:
-        web_logger.error('Something wrong occurred with the "get sound descriptors" request (%s)\n\t%s' %\
-                         (e, traceback.format_exc()))
-        raise
+    """Gets descriptor values for a list of sounds, using the cache when possible.
+
+    Values are cached per sound and descriptor name (and normalization/only_leaf_descriptors flags) so that
+    requests with overlapping lists of descriptors share cache entries. All cache entries are read with a single
+    `cache.get_many` call and written with a single `cache.set_many` call. Descriptors missing from the cache are
+    requested from the similarity service in chunks of at most `SIMILARITY_DESCRIPTORS_MAX_SOUNDS_PER_REQUEST` sounds.
+
+    Args:
+        sound_ids (List[int]): IDs of the sounds for which to get descriptors.
+        descriptor_names (List[str]): names of the descriptors to get. If empty, all descriptors are returned
+            (these are requested directly to the similarity service without using the cache).
+        normalization (bool): whether to return normalized descriptor values.
+        only_leaf_descriptors (bool): whether to only expand descriptor names to their statistics.
+
+    Returns:
+        Dict[unicode, dict]: dictionary with the (nested) descriptor values of each sound keyed by sound ID. Sounds
+            not found in the similarity service are not included.
+    """
+    descriptor_names = [name[1:] if name.startswith('.') else name for name in descriptor_names if name]
+    if not descriptor_names:
+        # All descriptors are requested, these are not cached per descriptor name
+        data = dict()
+        for i in range(0, len(sound_ids), SIMILARITY_DESCRIPTORS_MAX_SOUNDS_PER_REQUEST):
+            try:
+                returned_data = Similarity.get_sounds_descriptors(
+                    sound_ids[i:i + SIMILARITY_DESCRIPTORS_MAX_SOUNDS_PER_REQUEST], [], normalization,
+                    only_leaf_descriptors)
+            except Exception as e:
+                web_logger.error('Something wrong occurred with the "get sound descriptors" request (%s)\n\t%s' %\
+                                 (e, traceback.format_exc()))
+                raise
+            data.update({unicode(sound_id): sound_data for sound_id, sound_data in returned_data.items()})
+        return data
+
+    cache_keys = dict()
+    for sound_id in sound_ids:
+        for name in descriptor_names:
+            cache_keys[get_sound_descriptor_cache_key(sound_id, name, normalization, only_leaf_descriptors)] = \
+                (unicode(sound_id), name)
+    cached_values = cache.get_many(cache_keys.keys())
+
+    data = dict()
+    missing_descriptor_names = dict()
+    for key, (sound_id, name) in cache_keys.items():
+        if cached_values.get(key) is not None:
+            _set_nested_descriptor_value(data.setdefault(sound_id, dict()), name, cached_values[key])
+        else:
+            missing_descriptor_names.setdefault(sound_id, set()).add(name)
+
+    # Group sounds requiring the same descriptors so each group can be requested together
+    sound_ids_per_missing_names = dict()
+    for sound_id, names in missing_descriptor_names.items():
+        sound_ids_per_missing_names.setdefault(frozenset(names), list()).append(sound_id)
+
+    values_to_cache = dict()
+    for names, group_sound_ids in sound_ids_per_missing_names.items():
+        for i in range(0, len(group_sound_ids), SIMILARITY_DESCRIPTORS_MAX_SOUNDS_PER_REQUEST):
+            try:
+                returned_data = Similarity.get_sounds_descriptors(
+                    group_sound_ids[i:i + SIMILARITY_DESCRIPTORS_MAX_SOUNDS_PER_REQUEST], sorted(names),
+                    normalization, only_leaf_descriptors)
+            except Exception as e:
+                web_logger.error('Something wrong occurred with the "get sound descriptors" request (%s)\n\t%s' %\
+                                 (e, traceback.format_exc()))
+                raise
+
+            for sound_id, sound_data in returned_data.items():
+                sound_id = unicode(sound_id)
+                for name in names:
+                    value = _get_nested_descriptor_value(sound_data, name)
+                    if value is not None:
+                        values_to_cache[get_sound_descriptor_cache_key(
+                            sound_id, name, normalization, only_leaf_descriptors)] = value
+                _merge_descriptor_values(data.setdefault(sound_id, dict()), sound_data)
 
     # save sound analysis information in cache
-    for key, item in returned_data.items():
-        cache.set(hash_cache_key(cache_key % (key, ",".join(sorted(descriptor_names)), str(normalization))),
-                  item, SIMILARITY_CACHE_TIME)
+    if values_to_cache:
+        cache.set_many(values_to_cache, SIMILARITY_CACHE_TIME)
+
+    return data
+
+
+def get_sound_descriptor_cache_key(sound_id, descriptor_name, normalization, only_leaf_descriptors):
+    return hash_cache_key("analysis-sound-id-%s-descriptor-%s-normalization-%s-leaf-%s" % (
+        str(sound_id), descriptor_name, str(normalization), str(only_leaf_descriptors)))
+
 
-    returned_data.update(cached_data)
+def _get_nested_descriptor_value(sound_data, descriptor_name):
+    value = sound_data
+    for key in descriptor_name.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
 
-    return returned_data
+
+def _set_nested_descriptor_value(sound_data, descriptor_name, value):
+    keys = descriptor_name.split('.')
+    for key in keys[:-1]:
+        sound_data = sound_data.setdefault(key, dict())
+    if isinstance(value, dict) and isinstance(sound_data.get(keys[-1]), dict):
+        _merge_descriptor_values(sound_data[keys[-1]], value)
+    else:
+        sound_data[keys[-1]] = value
+
+
+def _merge_descriptor_values(sound_data, new_data):
+    for key, value in new_data.items():
+        if isinstance(value, dict) and isinstance(sound_data.get(key), dict):
+            _merge_descriptor_values(sound_data[key], value)
+        else:
+            sound_data[key] = value
 
 
 def delete_sound_from_gaia(sound):
@@ -112,7 +112,8 @@ def create_sound(user,
     license = License.objects.get(name=sound_fields['license'])
     sound.type = get_sound_type(sound.original_path)
     sound.license = license
-    sound.md5 = md5file(sound.original_path)
+    # md5 might have already been computed when receiving the file (see utils.upload_handlers)
+    sound.md5 = sound_fields.get('md5', None) or md5file(sound.original_path)
 
     sound_already_exists = Sound.objects.filter(md5=sound.md5).exists()
     if sound_already_exists:
@@ -21,11 +21,13 @@
 import json
 import logging
 import traceback
-import urllib2
 from hashlib import md5
 from math import ceil
 
+import requests
+
 from django.conf import settings
+from django.contrib.postgres.aggregates import ArrayAgg
 from django.core.cache import cache
 from django.http import HttpResponse
 
@@ -35,25 +37,42 @@ from utils.tags import clean_and_split_tags
 web_logger = logging.getLogger('web')
 
 
-def get_recommended_tags(input_tags, max_number_of_tags=30):
-
+def _get_recommended_tags_cache_key(input_tags):
     hashed_tags = md5(",".join(sorted(input_tags)))
-    cache_key = "recommended-tags-for-%s" % (hashed_tags.hexdigest())
+    return "recommended-tags-for-%s" % (hashed_tags.hexdigest())
+
 
-    recommended_tags = False
+def get_recommended_tags_many(input_tagss, max_number_of_tags=30):
+    """
+    Returns the recommended tags and community for several lists of input tags (in the same order). Recommendations
+    are read from the cache and the ones which are not cached are computed with a single request to the tag
+    recommendation service.
+    """
+    cache_keys = [_get_recommended_tags_cache_key(input_tags) for input_tags in input_tagss]
+
+    cached_recommendations = dict()
     # Don't use the cache when we're debugging
     if not settings.DEBUG:
-        recommended_tags = cache.get(cache_key)
+        cached_recommendations = cache.get_many(cache_keys)
 
-    if not recommended_tags:
-        recommended_tags = TagRecommendation.recommend_tags(input_tags)
+    missing = [(cache_key, input_tags) for cache_key, input_tags in zip(cache_keys, input_tagss)
+               if cache_key not in cached_recommendations]
+    if missing:
+        new_recommendations = dict()
+        for (cache_key, _), recommended_tags in zip(
+                missing, TagRecommendation.recommend_tags_many([input_tags for _, input_tags in missing])):
+            if not recommended_tags['tags']:
+                recommended_tags['community'] = "-"
+            new_recommendations[cache_key] = recommended_tags
+        cache.set_many(new_recommendations, settings.TAGRECOMMENDATION_CACHE_TIME)
+        cached_recommendations.update(new_recommendations)
 
-        if not recommended_tags['tags']:
-            recommended_tags['community'] = "-"
+    return [(cached_recommendations[cache_key]['tags'][:max_number_of_tags],
+             cached_recommendations[cache_key]['community']) for cache_key in cache_keys]
 
-        cache.set(cache_key, recommended_tags, settings.TAGRECOMMENDATION_CACHE_TIME)
 
-    return recommended_tags['tags'][:max_number_of_tags], recommended_tags['community']
+def get_recommended_tags(input_tags, max_number_of_tags=30):
+    return get_recommended_tags_many([input_tags], max_number_of_tags=max_number_of_tags)[0]
 
 
 def get_recommended_tags_view(request):
@@ -65,7 +84,7 @@ def get_recommended_tags_view(request):
                 try:
                     tags, community = get_recommended_tags(input_tags)
                     return HttpResponse(json.dumps([tags, community]), content_type='application/javascript')
-                except urllib2.URLError as e:
+                except requests.RequestException as e:
                     web_logger.error('Could not get a response from the tagrecommendation service (%s)\n\t%s' % \
                                      (e, traceback.format_exc()))
                     return HttpResponseUnavailabileError()
@@ -82,29 +101,29 @@ def get_id_of_last_indexed_sound():
         return -1
 
 
-def post_sounds_to_tagrecommendation_service(sound_qs):
-    data_to_post = []
-    N_SOUNDS_PER_CALL = 10
-    total_calls = int(ceil(float(len(sound_qs))/N_SOUNDS_PER_CALL))
+def post_sounds_to_tagrecommendation_service(sound_qs, n_sounds_per_call=5000):
+    """
+    Sends the tags of the sounds in sound_qs to the tag recommendation index. (sound_id, tags) pairs are read from a
+    single query that aggregates the tag names of every sound, iterated with a server-side cursor so the queryset is
+    never fully loaded in memory, and are posted as JSON in batches of n_sounds_per_call sounds.
+    """
+    total_calls = int(ceil(float(sound_qs.count()) / n_sounds_per_call))
+    sound_tags = sound_qs.annotate(tag_names=ArrayAgg('tags__tag__name')).values_list('id', 'tag_names').iterator()
     print "Sending recommendation data..."
     idx = 1
-    for count, sound in enumerate(sound_qs):
-        data_to_post.append(
-            (sound.id, list(sound.tags.select_related("tag").values_list('tag__name', flat=True)))
-        )
-        if (count + 1) % N_SOUNDS_PER_CALL == 0:
-            ids = [element[0] for element in data_to_post]
-            tagss = [element[1] for element in data_to_post]
-            print "\tSending group of sounds %i of %i (%i sounds)" % (idx, total_calls, len(ids))
+    data_to_post = []
+    for sound_id, tag_names in sound_tags:
+        # Sounds without tags get [None] because of the outer join with the tags table
+        data_to_post.append((sound_id, [tag for tag in tag_names if tag is not None]))
+        if len(data_to_post) == n_sounds_per_call:
+            print "\tSending group of sounds %i of %i (%i sounds)" % (idx, total_calls, len(data_to_post))
             idx += 1
-            TagRecommendation.add_to_index(ids, tagss)
+            TagRecommendation.add_to_index_bulk(data_to_post)
             data_to_post = []
 
     if data_to_post:
-        ids = [element[0] for element in data_to_post]
-        tagss = [element[1] for element in data_to_post]
-        print "\tSending group of sounds %i of %i (%i sounds)" % (idx, total_calls, len(ids))
-        TagRecommendation.add_to_index(ids, tagss)
+        print "\tSending group of sounds %i of %i (%i sounds)" % (idx, total_calls, len(data_to_post))
+        TagRecommendation.add_to_index_bulk(data_to_post)
 
     print "Finished!"
 
@@ -139,6 +139,12 @@ override_analysis_path_with_temp_directory = \
 override_sounds_path_with_temp_directory = \
     partial(override_path_with_temp_directory, settings_path_name='SOUNDS_PATH')
 
+override_file_upload_temp_dir_with_temp_directory = \
+    partial(override_path_with_temp_directory, settings_path_name='FILE_UPLOAD_TEMP_DIR')
+
+override_upload_proxy_store_path_with_temp_directory = \
+    partial(override_path_with_temp_directory, settings_path_name='UPLOAD_PROXY_STORE_PATH')
+
 override_previews_path_with_temp_directory = \
     partial(override_path_with_temp_directory, settings_path_name='PREVIEWS_PATH')
 
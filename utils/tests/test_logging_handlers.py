@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+import logging
+import threading
+
+import mock
+from django.test import SimpleTestCase
+
+from apiv2.apiv2_utils import LogMessage
+from utils.logging_filters import APILogsFilter
+from utils.logging_handlers import QueueHandler
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self, block=None):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.threads = []
+        self.block = block
+
+    def emit(self, record):
+        if self.block is not None:
+            self.block.wait()
+        self.records.append(record)
+        self.threads.append(threading.current_thread())
+
+
+class QueueHandlerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.target = RecordingHandler()
+        self.target_logger = logging.getLogger('test_queue_handler_target')
+        self.target_logger.propagate = False
+        self.target_logger.addHandler(self.target)
+        self.addCleanup(self.target_logger.removeHandler, self.target)
+
+        self.logger = logging.getLogger('test_queue_handler')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def add_queue_handler(self, capacity=100):
+        handler = QueueHandler('test_queue_handler_target', capacity=capacity)
+        self.logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        self.addCleanup(self.logger.removeHandler, handler)
+        return handler
+
+    def test_records_emitted_in_background_thread(self):
+        handler = self.add_queue_handler()
+        for i in range(10):
+            self.logger.info('message %i', i)
+        handler.flush()
+
+        self.assertEqual([record.getMessage() for record in self.target.records],
+                         ['message %i' % i for i in range(10)])
+        self.assertTrue(all(record.name == 'test_queue_handler' for record in self.target.records))
+        self.assertNotIn(threading.current_thread(), self.target.threads)
+        self.assertEqual(handler.enqueued, 10)
+        self.assertEqual(handler.dropped, 0)
+
+    def test_records_dropped_when_queue_is_full(self):
+        block = threading.Event()
+        self.target.block = block
+        handler = self.add_queue_handler(capacity=5)
+        for i in range(20):
+            self.logger.info('message %i', i)
+        block.set()
+        handler.flush()
+
+        # The first record might have been taken by the consumer thread before the queue got full
+        self.assertIn(handler.enqueued, [5, 6])
+        self.assertEqual(handler.enqueued + handler.dropped, 20)
+        warnings = [record.getMessage() for record in self.target.records if record.levelno == logging.WARNING]
+        self.assertEqual(warnings, ['Logging queue was full, %i log records dropped so far' % handler.dropped])
+
+    def test_concurrent_emit(self):
+        handler = self.add_queue_handler(capacity=1000)
+        start = threading.Event()
+
+        def log_messages(thread_number):
+            start.wait()
+            for i in range(50):
+                # Call emit directly so calls are not serialized by the lock of logging.Handler.handle
+                handler.emit(self.logger.makeRecord(
+                    self.logger.name, logging.INFO, __file__, 0, 'message %i %i', (thread_number, i), None))
+
+        with mock.patch('utils.logging_handlers.threading.Thread', wraps=threading.Thread) as thread_class:
+            threads = [threading.Thread(target=log_messages, args=(thread_number,)) for thread_number in range(10)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+        handler.flush()
+
+        # A single consumer thread is started and no record is lost
+        self.assertEqual(len([call for call in thread_class.call_args_list
+                              if call[1].get('target') == handler.consume]), 1)
+        self.assertEqual(handler.enqueued, 500)
+        self.assertEqual(len(self.target.records), 500)
+
+    def test_api_log_message_formatted_when_emitted(self):
+        handler = self.add_queue_handler()
+        self.target.addFilter(APILogsFilter())
+        self.logger.info(LogMessage(u'user:ñandú instance', {'fields': 'id'}, {'api_client_id': 'client'}))
+        handler.flush()
+
+        record = self.target.records[0]
+        self.assertEqual(record.getMessage(),
+                         'user:\xc3\xb1and\xc3\xba instance #!# {"fields": "id"} #!# {"api_client_id": "client"}')
+        self.assertEqual(record.api_resource, 'user instance')
+        self.assertEqual(record.fields, 'id')
+        self.assertEqual(record.api_client_id, 'client')
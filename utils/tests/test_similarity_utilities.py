@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+import mock
+from django.core.cache import cache
+from django.test import TestCase
+
+from utils.similarity_utilities import get_similar_sounds, get_similar_sounds_many, get_sounds_descriptors
+
+
+class SimilarSoundsManyTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @mock.patch('utils.similarity_utilities.Similarity.search')
+    @mock.patch('utils.similarity_utilities.Similarity.search_many')
+    def test_get_similar_sounds_many_only_requests_misses(self, search_many, search):
+        # Populate the cache for sound 1 using the single sound function
+        search.return_value = {'results': [['1', 0.0], ['5', 0.5]], 'count': 2}
+        get_similar_sounds(mock.Mock(id=1), num_results=10)
+
+        search_many.return_value = {
+            '2': {'results': [['2', 0.0], ['7', 1.5]], 'count': 2},
+        }
+        with mock.patch('utils.similarity_utilities.cache.get_many', wraps=cache.get_many) as get_many:
+            similar_sounds = get_similar_sounds_many([1, 2, 3], num_results=10)
+            get_many.assert_called_once()
+        search_many.assert_called_once_with([2, 3], preset='pca', num_results=10, offset=0)
+        self.assertEqual(similar_sounds, {
+            1: ([[1, 0.0], [5, 0.5]], 2),
+            2: ([[2, 0.0], [7, 1.5]], 2),
+            3: ([], 0),
+        })
+
+        # Results for sound 2 are now in the cache and shared with get_similar_sounds
+        search.reset_mock()
+        self.assertEqual(get_similar_sounds(mock.Mock(id=2), num_results=10), ([[2, 0.0], [7, 1.5]], 2))
+        search.assert_not_called()
+
+        # When all sounds are cached no request is made to the similarity service
+        search_many.reset_mock()
+        get_similar_sounds_many([1, 2], num_results=10)
+        search_many.assert_not_called()
+
+    @mock.patch('utils.similarity_utilities.Similarity.search_many', side_effect=Exception('Unreachable'))
+    def test_get_similar_sounds_many_service_error(self, search_many):
+        self.assertEqual(get_similar_sounds_many([1, 2]), {1: ([], 0), 2: ([], 0)})
+
+
+class SoundsDescriptorsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @staticmethod
+    def fake_get_sounds_descriptors(sound_ids, descriptor_names, normalization, only_leaf_descriptors):
+        data = dict()
+        for sound_id in sound_ids:
+            sound_data = data.setdefault(str(sound_id), dict())
+            for name in descriptor_names:
+                category, descriptor = name.split('.')
+                sound_data.setdefault(category, dict())[descriptor] = {'mean': float(sound_id)}
+        return data
+
+    @mock.patch('utils.similarity_utilities.SIMILARITY_DESCRIPTORS_MAX_SOUNDS_PER_REQUEST', 2)
+    @mock.patch('utils.similarity_utilities.Similarity.get_sounds_descriptors')
+    def test_get_sounds_descriptors_cache_calls(self, similarity_get_sounds_descriptors):
+        similarity_get_sounds_descriptors.side_effect = self.fake_get_sounds_descriptors
+        sound_ids = [1, 2, 3]
+
+        with mock.patch('utils.similarity_utilities.cache', wraps=cache) as wrapped_cache:
+            data = get_sounds_descriptors(sound_ids, ['lowlevel.pitch', 'lowlevel.dissonance'], False,
+                                          only_leaf_descriptors=True)
+            self.assertEqual(wrapped_cache.get_many.call_count, 1)
+            self.assertEqual(wrapped_cache.set_many.call_count, 1)
+            wrapped_cache.get.assert_not_called()
+            wrapped_cache.set.assert_not_called()
+
+        # Missing sounds are requested in chunks of SIMILARITY_DESCRIPTORS_MAX_SOUNDS_PER_REQUEST sounds
+        self.assertEqual(similarity_get_sounds_descriptors.call_count, 2)
+        self.assertEqual(sorted(len(call[0][0]) for call in similarity_get_sounds_descriptors.call_args_list),
+                         [1, 2])
+        self.assertEqual(data[u'3'], {'lowlevel': {'pitch': {'mean': 3.0}, 'dissonance': {'mean': 3.0}}})
+
+        # An overlapping list of descriptors only requests the descriptors which are not cached yet
+        similarity_get_sounds_descriptors.reset_mock()
+        data = get_sounds_descriptors(sound_ids, ['lowlevel.pitch', 'lowlevel.spectral_centroid'], False,
+                                      only_leaf_descriptors=True)
+        for call in similarity_get_sounds_descriptors.call_args_list:
+            self.assertEqual(call[0][1], ['lowlevel.spectral_centroid'])
+        self.assertEqual(data[u'1'], {'lowlevel': {'pitch': {'mean': 1.0}, 'spectral_centroid': {'mean': 1.0}}})
+
+        # When everything is cached no request is made to the similarity service
+        similarity_get_sounds_descriptors.reset_mock()
+        data = get_sounds_descriptors(sound_ids, ['lowlevel.pitch'], False, only_leaf_descriptors=True)
+        similarity_get_sounds_descriptors.assert_not_called()
+        self.assertEqual(data[u'2'], {'lowlevel': {'pitch': {'mean': 2.0}}})
+
+        # Cache entries are not shared between normalized and non-normalized values
+        get_sounds_descriptors(sound_ids, ['lowlevel.pitch'], True, only_leaf_descriptors=True)
+        self.assertTrue(similarity_get_sounds_descriptors.called)
+
+    @mock.patch('utils.similarity_utilities.Similarity.get_sounds_descriptors')
+    def test_get_sounds_descriptors_all_descriptors(self, similarity_get_sounds_descriptors):
+        similarity_get_sounds_descriptors.return_value = {'1': {'lowlevel': {'pitch': {'mean': 1.0}}}}
+
+        # When no descriptor names are given all descriptors are requested with a single call and without cache
+        with mock.patch('utils.similarity_utilities.cache', wraps=cache) as wrapped_cache:
+            data = get_sounds_descriptors([1], [], False, only_leaf_descriptors=True)
+            wrapped_cache.get_many.assert_not_called()
+            wrapped_cache.set_many.assert_not_called()
+        similarity_get_sounds_descriptors.assert_called_once_with([1], [], False, True)
+        self.assertEqual(data, {u'1': {'lowlevel': {'pitch': {'mean': 1.0}}}})
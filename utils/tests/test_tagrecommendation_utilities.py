@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+import mock
+from django.core.cache import cache
+from django.test import TestCase
+
+from utils.tagrecommendation_utilities import get_recommended_tags, get_recommended_tags_many
+
+
+class RecommendedTagsManyTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @staticmethod
+    def fake_recommend_tags_many(input_tagss, max_number_of_tags=None):
+        return [{'tags': ['%s-recommended' % tag for tag in input_tags], 'community': 'Community%i' % len(input_tags)}
+                for input_tags in input_tagss]
+
+    @mock.patch('utils.tagrecommendation_utilities.TagRecommendation.recommend_tags_many')
+    def test_get_recommended_tags_many_only_requests_misses(self, recommend_tags_many):
+        recommend_tags_many.side_effect = self.fake_recommend_tags_many
+
+        # Populate the cache for one set of tags (the order of the input tags does not matter)
+        self.assertEqual(get_recommended_tags(['piano', 'field']),
+                         (['piano-recommended', 'field-recommended'], 'Community2'))
+        recommend_tags_many.reset_mock()
+
+        with mock.patch('utils.tagrecommendation_utilities.cache', wraps=cache) as wrapped_cache:
+            recommendations = get_recommended_tags_many([['birds'], ['field', 'piano'], ['drum', 'loop', 'kick']],
+                                                        max_number_of_tags=2)
+            self.assertEqual(wrapped_cache.get_many.call_count, 1)
+            self.assertEqual(wrapped_cache.set_many.call_count, 1)
+
+        # Cached and new recommendations are merged in the order of the input
+        self.assertEqual(recommendations, [
+            (['birds-recommended'], 'Community1'),
+            (['piano-recommended', 'field-recommended'], 'Community2'),
+            (['drum-recommended', 'loop-recommended'], 'Community3'),
+        ])
+        # A single request is made for the sets of tags which were not cached
+        recommend_tags_many.assert_called_once_with([['birds'], ['drum', 'loop', 'kick']])
+
+        # When all sets are cached no request is made
+        recommend_tags_many.reset_mock()
+        get_recommended_tags_many([['birds'], ['kick', 'drum', 'loop']])
+        recommend_tags_many.assert_not_called()
+
+    @mock.patch('utils.tagrecommendation_utilities.TagRecommendation.recommend_tags_many')
+    def test_get_recommended_tags_without_recommendations(self, recommend_tags_many):
+        recommend_tags_many.return_value = [{'tags': [], 'community': 'Community1'}]
+        self.assertEqual(get_recommended_tags(['unknowntag']), ([], '-'))
@@ -0,0 +1,165 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from utils.filesystem import create_directories, md5file
+from utils.mirror_files import copy_uploaded_file_to_mirror_locations
+
+upload_logger = logging.getLogger("file_upload")
+
+
+class StreamedUploadedFile(UploadedFile):
+    """
+    A file which has been completely received and stored in disk while being uploaded. Besides the usual UploadedFile
+    properties it has the 'path' where the file is stored and its 'md5' (computed while the file was received). The
+    file can be moved to the uploads directory of a user with 'move_to_uploads_directory'. If 'remove_on_close' is
+    set, the file is removed when closed unless it has been moved (Django closes uploaded files when the request
+    finishes, so files of uploads which are not accepted do not accumulate).
+    """
+
+    def __init__(self, path, name, content_type, size, charset, md5, content_type_extra=None, remove_on_close=True):
+        super(StreamedUploadedFile, self).__init__(open(path, 'rb'), name, content_type, size, charset,
+                                                   content_type_extra)
+        self.path = path
+        self.md5 = md5
+        self.remove_on_close = remove_on_close
+
+    def temporary_file_path(self):
+        return self.path
+
+    def move_to_uploads_directory(self, user_id):
+        """Moves the file to the uploads directory of the user (and copies it to mirror locations). If the stored
+        file and the uploads directory are in the same filesystem this is a rename and no data is copied.
+
+        Args:
+            user_id (int): id of the user that uploaded the file
+
+        Returns:
+            unicode: new path of the file
+        """
+        self.file.close()
+        directory = os.path.join(settings.UPLOADS_PATH, str(user_id))
+        create_directories(directory, exist_ok=True)
+        path = os.path.join(directory, os.path.basename(self.name))
+        if not isinstance(path, unicode):
+            path = path.decode('utf-8')
+        shutil.move(self.path, path.encode('utf-8'))
+        copy_uploaded_file_to_mirror_locations(path)
+        self.path = path
+        self.remove_on_close = False
+        upload_logger.info("\tmoved streamed file upload to: %s" % path)
+        return path
+
+    def close(self):
+        try:
+            return self.file.close()
+        finally:
+            if self.remove_on_close and os.path.exists(self.path):
+                os.remove(self.path)
+                self.remove_on_close = False
+
+
+class StreamingFileUploadHandler(FileUploadHandler):
+    """
+    Upload handler that streams uploaded files to FILE_UPLOAD_TEMP_DIR computing their md5 while these are received.
+    Unlike Django's TemporaryFileUploadHandler, the resulting StreamedUploadedFile can be moved (instead of copied) to
+    the uploads directory and its md5 does not need to be computed again, so files are only written to disk once.
+
+    If an uploaded file is bigger than max_file_size, the upload is stopped as soon as this is detected, the partially
+    received file is removed and 'file_too_big' is set.
+    """
+
+    def __init__(self, max_file_size=None, request=None):
+        super(StreamingFileUploadHandler, self).__init__(request)
+        self.max_file_size = max_file_size
+        self.file_too_big = False
+        self.file = None
+        self.partial_path = None
+        self.md5 = None
+
+    def new_file(self, *args, **kwargs):
+        super(StreamingFileUploadHandler, self).new_file(*args, **kwargs)
+        create_directories(settings.FILE_UPLOAD_TEMP_DIR, exist_ok=True)
+        self.partial_path = os.path.join(settings.FILE_UPLOAD_TEMP_DIR, '%s.upload' % uuid.uuid4().hex)
+        self.file = open(self.partial_path, 'wb')
+        self.md5 = hashlib.md5()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.max_file_size is not None and start + len(raw_data) > self.max_file_size:
+            self.file_too_big = True
+            raise StopUpload(connection_reset=True)
+        self.file.write(raw_data)
+        self.md5.update(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.file.close()
+        path = self.partial_path
+        self.partial_path = None
+        return StreamedUploadedFile(path, self.file_name, self.content_type, file_size, self.charset,
+                                    self.md5.hexdigest(), self.content_type_extra)
+
+    def upload_complete(self):
+        # If the upload was interrupted, remove the partially received file
+        if self.partial_path is not None:
+            self.file.close()
+            if os.path.exists(self.partial_path):
+                os.remove(self.partial_path)
+            self.partial_path = None
+
+
+def get_file_uploaded_by_proxy(data, field_name):
+    """Returns a file which has been received and stored by the front-end proxy (e.g. nginx upload module)
+
+    The proxy stores the file in settings.UPLOAD_PROXY_STORE_PATH and replaces the file in the request with the fields
+    '<field_name>.name', '<field_name>.path' and '<field_name>.content_type'. The proxy must be configured so that these
+    fields can not be set by clients. The md5 of the file is computed from the stored file, a '<field_name>.md5' field is
+    not trusted. The returned file is not removed when closed (the proxy takes care of its stored files) but it can be
+    moved to the uploads directory like any other streamed file.
+
+    Args:
+        data (QueryDict): request data
+        field_name (str): name of the file field
+
+    Returns:
+        StreamedUploadedFile or None: the uploaded file or None if no file uploaded by the proxy is found (or uploads
+            through the proxy are not enabled)
+    """
+    if not settings.UPLOAD_PROXY_STORE_PATH or '%s.path' % field_name not in data:
+        return None
+
+    # Only files placed in the proxy store directory can be used
+    path = os.path.realpath(data['%s.path' % field_name])
+    store_path = os.path.join(os.path.realpath(settings.UPLOAD_PROXY_STORE_PATH), '')
+    if not path.startswith(store_path) or not os.path.isfile(path):
+        return None
+
+    return StreamedUploadedFile(path, data.get('%s.name' % field_name, os.path.basename(path)),
+                                data.get('%s.content_type' % field_name, None), os.path.getsize(path), None,
+                                md5file(path), remove_on_close=False)